@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import open3d as o3d
+
+import profiling
+import render
+
+try:
+    import resource
+except ImportError:  # Windows không có module resource
+    resource = None
+
+# Benchmark từng giai đoạn của pipeline trên cloud tổng hợp có thể tái lập (cùng seed -> cùng dữ liệu).
+# Ví dụ:
+#   python benchmark.py                                   # bộ nhanh: 10k, 100k, 1M điểm
+#   python benchmark.py --preset full --json out.json     # 10k -> 50M điểm
+#   python benchmark.py --baseline base.json              # so sánh, exit code 1 nếu chậm hơn ngưỡng
+#   python benchmark.py --save-baseline base.json         # lưu kết quả làm baseline
+
+SIZES_QUICK = [10000, 100000, 1000000]
+SIZES_FULL = [10000, 100000, 1000000, 10000000, 50000000]
+SHAPES = ["plane", "sphere", "noisy_scan"]
+STAGES = ["load_point_cloud", "avg_dist", "estimate_normals", "orientation", "shading_diffuse", "shading_specular"]
+SEED = 12345
+REGRESSION_THRESHOLD = 0.10  # Chậm hơn baseline quá 10% được coi là hồi quy
+REGRESSION_MIN_SECONDS = 0.005  # Bỏ qua chênh lệch tuyệt đối nhỏ hơn mức nhiễu đo
+
+
+def make_synthetic_cloud(shape, num_points, seed=SEED):
+    rng = np.random.default_rng(seed)
+    if shape == "plane":
+        points = np.column_stack([rng.random(num_points) * 10.0, rng.random(num_points) * 10.0,
+                                  rng.normal(scale=0.001, size=num_points)])
+    elif shape == "sphere":
+        points = rng.normal(size=(num_points, 3))
+        points /= np.linalg.norm(points, axis=1, keepdims=True)
+    elif shape == "noisy_scan":
+        # Địa hình gợn sóng + nhiễu đo + 1% điểm ngoại lai, giống dữ liệu quét thực tế
+        xy = rng.random((num_points, 2)) * 20.0
+        z = 0.5 * np.sin(xy[:, 0]) * np.cos(0.7 * xy[:, 1]) + rng.normal(scale=0.01, size=num_points)
+        points = np.column_stack([xy, z])
+        outliers = rng.random(num_points) < 0.01
+        points[outliers, 2] += rng.normal(scale=1.0, size=np.count_nonzero(outliers))
+    else:
+        raise ValueError(f"Hình dạng không hợp lệ: {shape}")
+    colors = rng.integers(0, 256, size=(num_points, 3), dtype=np.uint8)
+    return points, colors
+
+
+def _peak_rss_mb():
+    peak = profiling.peak_rss_mb()
+    if peak is not None:
+        return peak
+    # Không có /proc: ru_maxrss là đỉnh toàn tiến trình (KB trên Linux, byte trên macOS)
+    if resource is None:
+        return float("nan")
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024.0 ** 2 if sys.platform == "darwin" else 1024.0)
+
+
+def time_stage(fn, verbose):
+    profiling.clear_peak_rss() # Đặt lại VmHWM để đo đỉnh RSS theo từng giai đoạn
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        _start_time = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - _start_time
+    return result, elapsed, _peak_rss_mb()
+
+
+def run_case(shape, num_points, orient_mode, workdir, verbose):
+    points, colors = make_synthetic_cloud(shape, num_points)
+    path = os.path.join(workdir, f"{shape}_{num_points}.ply")
+    render.write_binary_ply(path, points, None, colors)
+    del points, colors
+    render.NORMAL_CACHE_ENABLED = False  # Luôn đo đường tính thật, không đọc cache pháp tuyến
+    np.random.seed(SEED)
+
+    timings = {}
+    pcd, timings["load_point_cloud"], rss = time_stage(lambda: render.load_point_cloud(path), verbose)
+    rss_by_stage = {"load_point_cloud": rss}
+
+    radius, timings["avg_dist"], rss_by_stage["avg_dist"] = time_stage(
+        lambda: render.estimate_normal_radius(pcd, render.NORMAL_ESTIMATION_RADIUS_FACTOR,
+                                              render.NORMAL_ESTIMATION_MAX_NN), verbose)
+    search_param = o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=render.NORMAL_ESTIMATION_MAX_NN)
+    _, timings["estimate_normals"], rss_by_stage["estimate_normals"] = time_stage(
+        lambda: pcd.estimate_normals(search_param=search_param), verbose)
+    _, timings["orientation"], rss_by_stage["orientation"] = time_stage(
+        lambda: render.orient_normals(pcd, orient_mode, render.ORIENT_NORMALS_K, radius), verbose)
+
+    normals = np.asarray(pcd.normals)
+    cloud_points = np.asarray(pcd.points)
+    base_color = render.BASE_COLORS_LIST[0][1].reshape(1, 3)
+    view_pos = render.estimate_default_view_position(pcd)
+    for stage, use_specular in (("shading_diffuse", False), ("shading_specular", True)):
+        def shade():
+            state = render.build_shading_state(normals, render.SUN_DIRECTION,
+                                               render.AMBIENT_STRENGTH, render.DIFFUSE_STRENGTH)
+            return render.compute_shaded_colors(state, cloud_points, base_color, view_pos,
+                                                render.SPECULAR_STRENGTH, render.SHININESS_FACTOR, use_specular)
+        _, timings[stage], rss_by_stage[stage] = time_stage(shade, verbose)
+    os.remove(path)
+    return [{"shape": shape, "num_points": num_points, "stage": stage,
+             "seconds": round(timings[stage], 6), "peak_rss_mb": round(rss_by_stage[stage], 1)}
+            for stage in STAGES]
+
+
+def compare_with_baseline(results, baseline, threshold):
+    base_index = {(r["shape"], r["num_points"], r["stage"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        base = base_index.get((r["shape"], r["num_points"], r["stage"]))
+        if base is None:
+            continue
+        delta = r["seconds"] - base["seconds"]
+        if delta > REGRESSION_MIN_SECONDS and r["seconds"] > base["seconds"] * (1.0 + threshold):
+            regressions.append((r, base))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các giai đoạn của render.py trên cloud tổng hợp")
+    parser.add_argument("--preset", choices=["quick", "full"], default="quick")
+    parser.add_argument("--sizes", help="Danh sách số điểm, phân tách bằng dấu phẩy (ghi đè --preset)")
+    parser.add_argument("--shapes", default=",".join(SHAPES))
+    parser.add_argument("--orient-mode", default="viewpoint",
+                        help="Chế độ định hướng pháp tuyến (tangent_plane rất chậm với cloud lớn)")
+    parser.add_argument("--json", help="Ghi kết quả dạng JSON ra file")
+    parser.add_argument("--baseline", help="File JSON baseline để so sánh")
+    parser.add_argument("--save-baseline", help="Ghi kết quả hiện tại làm baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--verbose", action="store_true", help="Giữ log của render.py")
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(",")] if args.sizes else (
+        SIZES_FULL if args.preset == "full" else SIZES_QUICK)
+    shapes = args.shapes.split(",")
+
+    results = []
+    print(f"{'Hình dạng':<12}{'Số điểm':>12}  {'Giai đoạn':<18}{'Thời gian (s)':>14}{'Đỉnh RSS (MB)':>15}")
+    with tempfile.TemporaryDirectory(prefix="pcd_bench_") as workdir:
+        for num_points in sizes:
+            for shape in shapes:
+                for r in run_case(shape, num_points, args.orient_mode, workdir, args.verbose):
+                    results.append(r)
+                    print(f"{r['shape']:<12}{r['num_points']:>12,}  {r['stage']:<18}"
+                          f"{r['seconds']:>14.3f}{r['peak_rss_mb']:>15.1f}")
+
+    report = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "open3d": o3d.__version__,
+                 "platform": platform.platform(), "cpu_count": os.cpu_count(), "seed": SEED,
+                 "orient_mode": args.orient_mode, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"Đã ghi kết quả: {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nPHÁT HIỆN {len(regressions)} HỒI QUY (ngưỡng {args.threshold:.0%}):")
+            for r, base in regressions:
+                print(f"  {r['shape']} {r['num_points']:,} {r['stage']}: "
+                      f"{base['seconds']:.3f}s -> {r['seconds']:.3f}s (+{r['seconds'] / base['seconds'] - 1:.0%})")
+            sys.exit(1)
+        print(f"\nKhông có hồi quy so với baseline (ngưỡng {args.threshold:.0%}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import sys
+import time
+import tracemalloc
+import numpy as np
+import open3d as o3d
+
+import render
+
+# So sánh kernel shading float32 (render.compute_shaded_colors, mọi backend) với bản float64 gốc.
+# Kèm so sánh cách đưa màu lên cloud hiển thị: Vector3dVector mới mỗi lần với render.upload_colors (ghi tại chỗ).
+# Chạy: python benchmark_shading.py [số_điểm ...]   (mặc định 1M và 10M điểm)
+
+REPEATS = 3
+
+
+def legacy_shading(normals, points, base_color, sun_dir, view_pos,
+                   ambient_s, diffuse_s, specular_s, shininess, use_specular_flag):
+    # Bản sao thuật toán apply_enhanced_sun_shading() trước khi có kernel float32 (tham chiếu)
+    light_vector = -np.array(sun_dir) / np.linalg.norm(sun_dir)
+    norm_lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    valid_normals_mask = norm_lengths.flatten() > 1e-9
+    normals_normalized = np.zeros_like(normals)
+    if np.any(valid_normals_mask):
+        normals_normalized[valid_normals_mask] = normals[valid_normals_mask] / norm_lengths[valid_normals_mask]
+    diffuse_intensity = np.sum(normals_normalized * light_vector, axis=1)
+    shaded_intensities = ambient_s + np.maximum(0, diffuse_intensity) * diffuse_s
+    if use_specular_flag:
+        view_vector_to_points = view_pos - points
+        view_vector_norm = view_vector_to_points / (np.linalg.norm(view_vector_to_points, axis=1, keepdims=True) + 1e-9)
+        half_vector = (light_vector + view_vector_norm)
+        half_vector_norm = half_vector / (np.linalg.norm(half_vector, axis=1, keepdims=True) + 1e-9)
+        spec_angle = np.sum(normals_normalized * half_vector_norm, axis=1)
+        shaded_intensities += specular_s * np.power(np.maximum(0, spec_angle), shininess)
+    shaded_intensities = np.clip(shaded_intensities, 0, 1)
+    base_colors_tiled = np.tile(base_color, (len(points), 1))
+    return np.clip(base_colors_tiled * shaded_intensities[:, np.newaxis], 0, 1)
+
+
+def measure(fn):
+    # Trả về (thời gian tốt nhất, đỉnh bộ nhớ cấp phát thêm) qua REPEATS lần chạy
+    best_time = float("inf")
+    peak_bytes = 0
+    for _ in range(REPEATS):
+        tracemalloc.start()
+        _start_time = time.perf_counter()
+        fn()
+        best_time = min(best_time, time.perf_counter() - _start_time)
+        peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best_time, peak_bytes
+
+
+def run(num_points):
+    rng = np.random.default_rng(0)
+    points = rng.random((num_points, 3))
+    normals = rng.normal(size=(num_points, 3))
+    base_color = render.BASE_COLORS_LIST[1][1]
+    view_pos = np.array([0.5, 0.5, 3.0])
+    args = (render.SUN_DIRECTION, view_pos, render.AMBIENT_STRENGTH, render.DIFFUSE_STRENGTH,
+            render.SPECULAR_STRENGTH, render.SHININESS_FACTOR)
+
+    print(f"\n--- {num_points:,} điểm ---")
+    print(f"{'Trường hợp':<34}{'Thời gian (s)':>14}{'Đỉnh bộ nhớ (MB)':>18}")
+    for use_specular in (False, True):
+        label = "specular" if use_specular else "diffuse"
+        legacy_time, legacy_peak = measure(lambda: legacy_shading(normals, points, base_color, *args, use_specular))
+
+        def cold():
+            state = render.build_shading_state(normals, render.SUN_DIRECTION,
+                                               render.AMBIENT_STRENGTH, render.DIFFUSE_STRENGTH)
+            render.compute_shaded_colors(state, points, base_color.reshape(1, 3), view_pos,
+                                         render.SPECULAR_STRENGTH, render.SHININESS_FACTOR, use_specular)
+        cold_time, cold_peak = measure(cold)
+
+        rows = [(f"float64 gốc ({label})", legacy_time, legacy_peak),
+                (f"float32 lần đầu ({label})", cold_time, cold_peak)]
+        for backend in render.SHADING_BACKENDS:
+            # Làm mới khi camera thay đổi: buffer đã có sẵn, chỉ tính lại specular/màu
+            state = render.build_shading_state(normals, render.SUN_DIRECTION,
+                                               render.AMBIENT_STRENGTH, render.DIFFUSE_STRENGTH,
+                                               backend=backend)
+            moving_view = [view_pos.copy()]
+
+            def refresh():
+                moving_view[0] = moving_view[0] + 0.01
+                render.compute_shaded_colors(state, points, base_color.reshape(1, 3), moving_view[0],
+                                             render.SPECULAR_STRENGTH, render.SHININESS_FACTOR, use_specular)
+            refresh_time, refresh_peak = measure(refresh)
+            rows.append((f"{backend} làm mới ({label})", refresh_time, refresh_peak))
+
+        for name, t, peak in rows:
+            print(f"{name:<34}{t:>14.3f}{peak / 1024 ** 2:>18.1f}")
+        best_name, best_time, best_peak = min(rows[2:], key=lambda row: row[1])
+        print(f"  -> Tăng tốc làm mới ({best_name.split()[0]}): {legacy_time / best_time:.1f}x, "
+              f"giảm đỉnh bộ nhớ: {legacy_peak / max(best_peak, 1):.1f}x")
+
+
+def run_color_upload(num_points):
+    # tracemalloc không thấy cấp phát C++ của Open3D: cột bộ nhớ chỉ gồm phần NumPy (bản clip/float64)
+    rng = np.random.default_rng(0)
+    colors = rng.random((num_points, 3), dtype=np.float32) # Như buffer màu float32 của shading state
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    pcd.colors = o3d.utility.Vector3dVector(np.zeros((num_points, 3)))
+
+    def legacy_upload():
+        pcd.colors = o3d.utility.Vector3dVector(np.clip(colors, 0, 1))
+
+    def float64_upload():
+        pcd.colors = o3d.utility.Vector3dVector(colors.astype(np.float64))
+
+    print(f"\n--- Tải màu lên cloud, {num_points:,} điểm ---")
+    print(f"{'Cách tải':<34}{'Thời gian (s)':>14}{'Đỉnh bộ nhớ (MB)':>18}")
+    rows = [("Vector3dVector(np.clip) gốc", *measure(legacy_upload)),
+            ("Vector3dVector(float64)", *measure(float64_upload)),
+            ("upload_colors (tại chỗ)", *measure(lambda: render.upload_colors(pcd, colors)))]
+    for name, t, peak in rows:
+        print(f"{name:<34}{t:>14.4f}{peak / 1024 ** 2:>18.1f}")
+    assert np.allclose(np.asarray(pcd.colors), colors)
+    print(f"  -> Tăng tốc: {rows[0][1] / rows[-1][1]:.1f}x")
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000000, 10000000]
+    for size in sizes:
+        run(size)
+    for size in sizes:
+        run_color_upload(size)
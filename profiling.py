@@ -0,0 +1,296 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+# Đo đạc tập trung cho render.py: timer giai đoạn lồng nhau, đỉnh bộ nhớ (tracemalloc + RSS) và bộ đếm.
+#
+#   with profiling.stage("load_point_cloud") as st:
+#       ...
+#       st.count("points", n)
+#   print(f"... (trong {st.elapsed:.2f}s)")
+#
+#   @profiling.profiled("estimate_normals")
+#   def f(...): ...
+#
+# Khi chưa gọi enable(), stage() chỉ là một timer perf_counter (không ghi sự kiện, không đo bộ nhớ).
+# Đỉnh tracemalloc/RSS là của cả tiến trình: chỉ stage trên luồng chính mới đặt lại đỉnh và có
+# peak_traced_mb/peak_rss_mb riêng. Stage trên luồng khác (shading nền, nạp tile) không đặt lại (sẽ xóa đỉnh
+# của stage đang mở ở luồng chính) và ghi process_peak_traced_mb/process_peak_rss_mb: đỉnh của cả tiến trình
+# kể từ lần đặt lại gần nhất, không riêng stage đó; process_bytes_allocated cũng gồm cấp phát của luồng khác.
+
+_enabled = False
+_trace_memory = False
+_events = []
+_counter_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def enable(trace_memory=True):
+    global _enabled, _trace_memory
+    _enabled = True
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _events.clear()
+        _counter_totals.clear()
+
+
+def clear_peak_rss():
+    # Linux: ghi "5" vào clear_refs để đặt lại VmHWM (đỉnh RSS) của tiến trình
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def rss_mb():
+    # RSS hiện tại (VmRSS), None nếu không có /proc
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _Timer:
+    # Dùng khi profiling tắt: chỉ đo thời gian để các dòng log vẫn in được elapsed
+    __slots__ = ("start", "end")
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        return False
+
+    @property
+    def elapsed(self):
+        # Đọc được cả khi stage còn đang chạy (để in log ngay trong khối with)
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def count(self, name, value=1):
+        pass
+
+
+class _Stage(_Timer):
+    __slots__ = ("name", "counters", "depth", "mem_start", "child_mem_peak", "child_rss_peak", "owns_peaks")
+
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = dict(counters)
+        # Bộ đếm truyền lúc mở stage cũng vào tổng toàn cục như count()
+        with _lock:
+            for key, value in counters.items():
+                if isinstance(value, (int, float)):
+                    _counter_totals[key] = _counter_totals.get(key, 0) + value
+
+    def __enter__(self):
+        stack = _stack()
+        parent = stack[-1] if stack else None
+        self.depth = len(stack)
+        self.child_mem_peak = 0
+        self.child_rss_peak = 0.0
+        self.owns_peaks = threading.current_thread() is threading.main_thread()
+        if not self.owns_peaks:
+            self.mem_start = tracemalloc.get_traced_memory()[0] if _trace_memory and tracemalloc.is_tracing() else None
+            stack.append(self)
+            return _Timer.__enter__(self)
+        if _trace_memory and tracemalloc.is_tracing():
+            # Đỉnh trước khi reset thuộc về stage cha: lưu lại để cha không mất nó
+            self.mem_start, peak_before = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.child_mem_peak = max(parent.child_mem_peak, peak_before)
+            tracemalloc.reset_peak()
+        else:
+            self.mem_start = None
+        rss_before = peak_rss_mb()
+        if parent is not None and rss_before is not None:
+            parent.child_rss_peak = max(parent.child_rss_peak, rss_before)
+        clear_peak_rss()
+        stack.append(self)
+        return _Timer.__enter__(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        _Timer.__exit__(self, exc_type, exc, tb)
+        stack = _stack()
+        stack.pop()
+        parent = stack[-1] if stack else None
+        args = dict(self.counters)
+        if not self.owns_peaks:
+            if self.mem_start is not None and tracemalloc.is_tracing():
+                mem_now, mem_peak = tracemalloc.get_traced_memory()
+                args["process_bytes_allocated"] = mem_now - self.mem_start
+                args["process_peak_traced_mb"] = round(mem_peak / 1024 ** 2, 3)
+            rss_peak = peak_rss_mb()
+            if rss_peak is not None:
+                args["process_peak_rss_mb"] = round(rss_peak, 1)
+        elif self.mem_start is not None and tracemalloc.is_tracing():
+            mem_now, mem_peak = tracemalloc.get_traced_memory()
+            mem_peak = max(mem_peak, self.child_mem_peak)
+            args["bytes_allocated"] = mem_now - self.mem_start
+            args["peak_traced_mb"] = round(mem_peak / 1024 ** 2, 3)
+            if parent is not None:
+                parent.child_mem_peak = max(parent.child_mem_peak, mem_peak)
+        rss_peak = peak_rss_mb() if self.owns_peaks else None
+        if rss_peak is not None:
+            rss_peak = max(rss_peak, self.child_rss_peak)
+            args["peak_rss_mb"] = round(rss_peak, 1)
+            if parent is not None:
+                parent.child_rss_peak = max(parent.child_rss_peak, rss_peak)
+        event = {"name": self.name, "ts": (self.start - _origin) * 1e6, "dur": self.elapsed * 1e6,
+                 "tid": threading.get_ident(), "depth": self.depth, "args": args}
+        with _lock:
+            _events.append(event)
+        return False
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        with _lock:
+            _counter_totals[name] = _counter_totals.get(name, 0) + value
+
+
+def stage(name, **counters):
+    if not _enabled:
+        return _Timer()
+    return _Stage(name, counters)
+
+
+def count(name, value=1):
+    # Cộng bộ đếm vào stage hiện tại của luồng (và tổng toàn cục)
+    if not _enabled:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].count(name, value)
+    else:
+        with _lock:
+            _counter_totals[name] = _counter_totals.get(name, 0) + value
+
+
+def profiled(name=None):
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Stage(stage_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def export_chrome_trace(filepath):
+    # Định dạng Trace Event JSON: mở bằng chrome://tracing hoặc ui.perfetto.dev
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+    trace_events = [{"name": e["name"], "cat": "stage", "ph": "X", "ts": round(e["ts"], 3),
+                     "dur": round(e["dur"], 3), "pid": pid, "tid": e["tid"], "args": e["args"]}
+                    for e in events]
+    for e in events:
+        memory = {k: e["args"][k] for k in ("peak_traced_mb", "peak_rss_mb") if k in e["args"]}
+        if memory:
+            trace_events.append({"name": "memory", "ph": "C", "ts": round(e["ts"] + e["dur"], 3),
+                                 "pid": pid, "args": memory})
+    with open(filepath, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms",
+                   "otherData": {"counters": dict(_counter_totals)}}, f)
+    return filepath
+
+
+def summary():
+    # Gộp theo tên stage, giữ thứ tự xuất hiện đầu tiên
+    rows = {}
+    with _lock:
+        events = sorted(_events, key=lambda e: e["ts"])
+    for e in events:
+        row = rows.setdefault(e["name"], {"name": e["name"], "depth": e["depth"], "calls": 0, "total_s": 0.0,
+                                          "max_s": 0.0, "peak_traced_mb": None, "peak_rss_mb": None,
+                                          "process_peak_traced_mb": None, "process_peak_rss_mb": None,
+                                          "counters": {}})
+        seconds = e["dur"] / 1e6
+        row["calls"] += 1
+        row["total_s"] += seconds
+        row["max_s"] = max(row["max_s"], seconds)
+        for key in ("peak_traced_mb", "peak_rss_mb", "process_peak_traced_mb", "process_peak_rss_mb"):
+            if key in e["args"]:
+                row[key] = max(row[key] or 0.0, e["args"][key])
+        for key, value in e["args"].items():
+            if key in ("peak_traced_mb", "peak_rss_mb", "process_peak_traced_mb", "process_peak_rss_mb"):
+                continue
+            if isinstance(value, (int, float)):
+                row["counters"][key] = row["counters"].get(key, 0) + value
+            else:
+                row["counters"][key] = value # Nhãn (vd. mode="viewpoint"): giữ giá trị cuối
+    return list(rows.values())
+
+
+def _format_peak(row, key):
+    # Dấu * = đỉnh của cả tiến trình (stage chạy ngoài luồng chính)
+    if row[key] is not None:
+        return f"{row[key]:.1f}"
+    if row["process_" + key] is not None:
+        return f"{row['process_' + key]:.1f}*"
+    return "-"
+
+
+def format_summary():
+    lines = [f"{'Giai đoạn':<40}{'Lần':>6}{'Tổng (s)':>10}{'TB (ms)':>10}{'Max (ms)':>10}"
+             f"{'Đỉnh py (MB)':>14}{'Đỉnh RSS (MB)':>15}  Bộ đếm"]
+    for row in summary():
+        name = ("  " * row["depth"] + row["name"])[:39]
+        traced = _format_peak(row, "peak_traced_mb")
+        rss = _format_peak(row, "peak_rss_mb")
+        counters = ", ".join(f"{k}={v}" for k, v in row["counters"].items())
+        lines.append(f"{name:<40}{row['calls']:>6}{row['total_s']:>10.3f}{row['total_s'] / row['calls'] * 1e3:>10.1f}"
+                     f"{row['max_s'] * 1e3:>10.1f}{traced:>14}{rss:>15}  {counters}")
+    if any(row["peak_traced_mb"] is None and row["process_peak_traced_mb"] is not None for row in summary()):
+        lines.append("(*) đỉnh bộ nhớ của cả tiến trình: stage chạy ngoài luồng chính không đo riêng")
+    return "\n".join(lines)
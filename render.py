@@ -2,6 +2,20 @@ import open3d as o3d
 import numpy as np
 import os
 import time
+import argparse
+import hashlib
+import heapq
+import io
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import numpy.lib.recfunctions as rfn
+from scipy.spatial import cKDTree
+
+import profiling
 
 # --- CÀI ĐẶT THAM SỐ ---
 POINT_CLOUD_FILE_PATH = "1M_cloud.ply"
@@ -9,13 +23,119 @@ POINT_CLOUD_FILE_PATH = "1M_cloud.ply"
 NORMAL_ESTIMATION_RADIUS_FACTOR = 1.0
 NORMAL_ESTIMATION_MAX_NN = 30
 ORIENT_NORMALS_K = 15
+# Chế độ định hướng pháp tuyến:
+#   "tangent_plane" - MST của Open3D (chậm, đơn luồng, chất lượng cao)
+#   "viewpoint"     - quay về phía ORIENTATION_VIEWPOINT (vị trí máy quét/camera)
+#   "centroid_out" / "centroid_in" - quay ra xa / về phía trọng tâm
+#   "propagation"   - MST cục bộ theo khối song song + lan truyền dấu giữa các khối
+NORMAL_ORIENTATION_MODE = "tangent_plane"
+ORIENTATION_VIEWPOINT = None # None: ước lượng phía trên bounding box như camera ban đầu
+ORIENTATION_CHUNK_POINTS = 200000
+ORIENTATION_WORKERS = None # None: dùng toàn bộ số lõi
+# Giảm mẫu theo voxel trước khi ước lượng pháp tuyến (xem nhanh cloud lớn)
+DOWNSAMPLE_POINT_BUDGET = None     # Số điểm tối đa; None: giữ toàn bộ cloud (hoặc --point-budget)
+DOWNSAMPLE_SEARCH_SAMPLE = 250000  # Số điểm mẫu dùng để dò kích thước voxel
+# Khoảng cách điểm TB: các điểm mẫu được truy vấn trên KD-tree của TOÀN BỘ cloud (không lệch do mẫu thưa)
+SPACING_SAMPLE_POINTS = 100000
+KDTREE_WORKERS = -1 # Số luồng truy vấn cKDTree; -1: mọi lõi
+# Bán kính pháp tuyến thích ứng theo mật độ cục bộ (hoặc --adaptive-normals):
+# r_i = NORMAL_ESTIMATION_RADIUS_FACTOR * khoảng cách tới lân cận thứ ADAPTIVE_NORMAL_K, tối đa NORMAL_ESTIMATION_MAX_NN điểm
+ADAPTIVE_NORMAL_RADIUS = False
+ADAPTIVE_NORMAL_K = 16
+ADAPTIVE_NORMAL_CHUNK_POINTS = 100000 # Số điểm mỗi lượt PCA (giới hạn bộ nhớ lân cận tạm)
+
+# Cache pháp tuyến trên đĩa (khóa theo nội dung file + tham số ước lượng)
+NORMAL_CACHE_ENABLED = True
+NORMAL_CACHE_DIR = ".normal_cache"
+NORMAL_CACHE_MAX_BYTES = 2 * 1024 ** 3  # Giới hạn tổng dung lượng thư mục cache
+NORMAL_CACHE_VERSION = 2
+
+# Đọc PLY nhị phân bằng np.memmap (không parse toàn bộ file); định dạng khác sẽ dùng Open3D
+USE_MEMMAP_PLY_LOADER = True
+# Cloud nén .pcc (ghi bằng --save-compact, đọc lại bằng --input file.pcc): vị trí lượng tử 16 bit theo bounding
+# box từng khối (điểm sắp theo Morton), màu uint8, pháp tuyến mã hóa bát diện 2x16 bit: 13 byte/điểm
+COMPACT_CHUNK_POINTS = 65536
+# Nạp file ASCII (XYZ/PTS/PLY ASCII) song song: chia file thành các khoảng byte cắt ở đầu dòng, parse trong process
+# pool, ghi nối tiếp ra PLY nhị phân trong INGEST_CACHE_DIR (lần sau đọc thẳng bằng memmap, không parse lại)
+ASCII_INGEST_ENABLED = True
+ASCII_POINT_EXTENSIONS = (".xyz", ".xyzn", ".xyzrgb", ".pts", ".txt", ".csv", ".ply")
+INGEST_CHUNK_BYTES = 64 * 1024 ** 2
+INGEST_WORKERS = None # None: dùng toàn bộ số lõi
+INGEST_CACHE_DIR = ".ingest_cache"
+INGEST_CACHE_MAX_BYTES = 16 * 1024 ** 3 # Mỗi file là bản PLY nhị phân đầy đủ (nhiều GB với 10-100M điểm): xóa cũ nhất trước
+
+# Tiền xử lý theo khối (out-of-core) cho cloud không vừa bộ nhớ: ghi các tile PLY + manifest rồi thoát
+RUN_TILED_PREPROCESS = False   # Hoặc --tiled-preprocess
+TILED_OUTPUT_DIR = "tiles_out" # Hoặc --tiled-output
+TILED_BLOCK_POINTS = 2000000   # Số điểm mục tiêu mỗi khối (chưa tính halo), hoặc --tile-points
+TILED_STREAM_CHUNK = 5000000   # Số điểm đọc mỗi lượt khi quét file
+TILED_HALO_FACTOR = 1.5        # Halo = radius pháp tuyến * hệ số này
+TILED_WORKERS = None
+# Bộ dữ liệu nhiều tile (--input là thư mục các tile PLY): manifest bounding box, chỉ nạp tile giao với khung nhìn/ROI
+DATASET_MEMORY_BUDGET_MB = 4096  # Giới hạn bộ nhớ các tile đã nạp + cloud hiển thị ghép từ chúng (hoặc --memory-budget);
+                                 # tile ít dùng nhất bị đẩy ra trước
+DATASET_VIEW_MARGIN = 0.25       # Nới bounding box tile (tỉ lệ kích thước) khi so với frustum: nạp trước tile sắp vào khung nhìn
+DATASET_DISPLAY_INTERVAL = 0.5   # Số giây tối thiểu giữa hai lần ghép lại cloud hiển thị (trên luồng nạp tile)
 
 APPLY_ENHANCED_SHADING = True
+# Kiểu shading thủ công (hoặc --shading):
+#   "sun" - mặt trời Lambert + specular, cần pháp tuyến
+#   "edl" - Eye-Dome Lighting trong không gian màn hình từ depth buffer, bỏ qua ước lượng/định hướng pháp tuyến
+SHADING_MODE = "sun"
+EDL_STRENGTH = 8.0   # Độ tối ở vùng sâu hơn lân cận (hệ số trong exp(-strength * obscurance))
+EDL_RADIUS = 2       # Khoảng cách (pixel) tới 8 điểm lân cận khi so độ sâu
+EDL_SETTLE_SECONDS = 0.15 # Camera đứng yên bao lâu thì chụp depth và tô EDL lại (cửa sổ tương tác)
 SUN_DIRECTION = np.array([-0.6, -0.7, -1.0])
 AMBIENT_STRENGTH = 0.15
 DIFFUSE_STRENGTH = 0.85
 SPECULAR_STRENGTH = 0.5
 SHININESS_FACTOR = 50
+# Bóng đổ của mặt trời (hoặc --shadows): depth map trực giao theo SUN_DIRECTION, mỗi điểm so độ sâu với nó.
+# Kết quả (độ sáng 0..1 mỗi điểm) nhân vào diffuse/specular và chỉ tính lại khi hướng mặt trời đổi.
+SUN_SHADOWS = False
+SHADOW_MAP_RESOLUTION = 4096 # Cạnh tối đa của depth map (texel)
+SHADOW_POINTS_PER_TEXEL = 2.0 # Cloud ít điểm dùng lưới thô hơn để bề mặt không bị thủng (ánh sáng lọt qua)
+SHADOW_SPLAT_RADIUS = 1      # Mỗi điểm phủ (2r+1)^2 texel của depth map (lọc min) để lấp khe giữa các điểm
+SHADOW_PCF_RADIUS = 1        # Lọc PCF (2r+1)^2 mẫu cho biên bóng mềm; 0: tắt
+SHADOW_BIAS_TEXELS = 1.0     # Độ lệch hằng (texel) chống tự đổ bóng; cộng thêm phần theo độ nghiêng mặt
+SHADOW_MAX_SLOPE = 4.0       # Giới hạn tan(góc tới) dùng cho độ lệch theo độ nghiêng
+# Che khuất môi trường (AO) theo lân cận KD-tree, nhân vào thành phần ambient (hoặc --ambient-occlusion).
+# Mỗi điểm xét AO_SAMPLES lân cận (lấy từ cloud thưa để phủ hết bán kính) và đo độ cao horizon lớn nhất
+# trong AO_SECTORS hướng quanh pháp tuyến; kết quả được cache cạnh pháp tuyến.
+AMBIENT_OCCLUSION = False
+AO_RADIUS_FACTOR = 10.0  # Bán kính xét = hệ số * khoảng cách điểm TB
+AO_SAMPLES = 32
+AO_SECTORS = 8
+AO_ANGLE_BIAS = 0.1      # sin góc horizon bỏ qua (nhiễu bề mặt không tự che chính nó)
+AO_STRENGTH = 1.0        # 0: tắt, 1: che khuất đầy đủ
+AO_CHUNK_POINTS = 16384  # Số điểm mỗi khối (mỗi luồng giữ buffer lân cận k x 3 của khối)
+AO_WORKERS = None        # Số luồng; None: dùng toàn bộ số lõi
+# Chiếu sáng (hoặc --lighting):
+#   "direct" - tính max(0, n.l) trực tiếp; đổi hướng mặt trời phải dựng lại toàn bộ shading state
+#   "sh"     - mỗi điểm giữ 9 hệ số SH bậc 2 của cos kẹp quanh pháp tuyến; đổi mặt trời/đèn phụ chỉ còn
+#              một tích (n, 9) x (9,) float32 theo khối (xoay mặt trời bằng phím mũi tên)
+LIGHTING_MODE = "direct"
+FILL_LIGHTS = [] # Đèn phụ khuếch tán: [(hướng chiếu như SUN_DIRECTION, cường độ), ...]
+SUN_ROTATE_STEP_DEG = 10.0 # Mỗi lần nhấn phím mũi tên: trái/phải đổi phương vị, lên/xuống đổi độ cao
+SHADING_CHUNK_POINTS = 65536 # Số điểm mỗi khối shading (buffer tạm float32 vừa cache L2)
+SHADING_BACKEND = "threaded" # "numpy-serial" hoặc "threaded" (ufunc NumPy nhả GIL nên chạy song song được)
+SHADING_WORKERS = None       # Số luồng cho backend "threaded"; None: os.cpu_count()
+COLOR_UPLOAD_IN_PLACE = True # Ghi màu thẳng vào buffer màu sẵn có của cloud (một lượt chép, không tạo Vector3dVector mới)
+BACKGROUND_SHADING = True    # Tính lại shading trên luồng nền: phím bấm không làm đứng cửa sổ
+SPECULAR_FOLLOW_CAMERA = True        # Highlight specular bám theo camera khi xoay (cần BACKGROUND_SHADING)
+SPECULAR_FOLLOW_MIN_MOVE = 0.002     # Camera dịch quá tỉ lệ này của đường chéo bbox mới tính lại specular
+SPECULAR_FOLLOW_FRAME_BUDGET = 0.02  # Giây cho mỗi lần cập nhật khi đang di chuyển (chọn bước lấy mẫu điểm)
+SPECULAR_FOLLOW_SETTLE_SECONDS = 0.2 # Camera đứng yên bao lâu thì tính specular đầy đủ cho mọi điểm
+FRUSTUM_CULLING = True       # Luồng nền chỉ tô các điểm trong tầm nhìn; điểm ngoài màn hình tô khi lọt vào
+CULL_CELL_POINTS = 16384     # Số điểm trung bình mỗi ô của lưới chỉ mục không gian dùng để loại theo frustum
+CULL_MAX_VISIBLE_FRACTION = 0.35 # Thấy nhiều hơn tỉ lệ này thì tô toàn bộ (gom/ghi theo chỉ số không còn lợi)
+
+# Level-of-detail (octree) cho cloud rất lớn: hiển thị mức thô khi camera đang di chuyển
+LOD_ENABLED = True
+LOD_POINT_BUDGET = 2000000   # Số điểm tối đa của mức thô (cloud nhỏ hơn sẽ không dùng LOD)
+LOD_MAX_DEPTH = 16           # Độ sâu octree tối đa (<= 21 để mã Morton vừa 64 bit)
+LOD_SETTLE_SECONDS = 0.3     # Camera đứng yên bao lâu thì tinh chỉnh lên độ phân giải đầy đủ
+LOD_MOTION_EPSILON = 1e-6    # Ngưỡng thay đổi extrinsic được coi là camera đang di chuyển
 
 INITIAL_POINT_SIZE = 2.0
 WINDOW_WIDTH = 1600
@@ -23,6 +143,17 @@ WINDOW_HEIGHT = 900
 INITIAL_BACKGROUND_IS_DARK = True
 CAMERA_FIELD_OF_VIEW_DEG = 60
 
+# Kết xuất không cửa sổ (--headless): rasterizer NumPy ghi PNG
+HEADLESS_OUTPUT_PATH = "render.png"
+HEADLESS_ORBIT_ELEVATION_DEG = 35 # Góc ngẩng camera khi kết xuất nhiều góc nhìn quanh cloud (--orbit)
+RASTER_CHUNK_POINTS = 2000000     # Số điểm chiếu mỗi lượt (giới hạn bộ nhớ tạm)
+
+# Đo đạc (module profiling): thời gian lồng nhau, đỉnh bộ nhớ, bộ đếm -> bảng tổng kết + trace Chrome
+PROFILING_ENABLED = False                 # Hoặc bật bằng --profile
+PROFILING_TRACE_MEMORY = True             # tracemalloc: đo cấp phát Python/NumPy (chậm hơn ~10-30%)
+PROFILING_TRACE_PATH = "profile_trace.json" # Mở bằng chrome://tracing hoặc ui.perfetto.dev
+MEMORY_REPORT_ENABLED = True # In bảng bộ nhớ từng mảng (cloud, màu gốc, shading state, LOD, ...) sau khi khởi động
+
 # --- BIẾN TOÀN CỤC CHO CALLBACKS ---
 global_vis = None
 global_pcd_display = None
@@ -30,6 +161,19 @@ global_pcd_original_colors = None
 global_current_base_color_index = 0
 global_bg_is_dark = INITIAL_BACKGROUND_IS_DARK
 global_specular_on = True
+global_normal_cache_key = None
+global_shading_state = {} # Cache các thành phần chiếu sáng giữa các lần làm mới shading
+global_shading_executor = None # ThreadPoolExecutor dùng chung cho backend "threaded"
+global_shading_executor_workers = 0
+global_pcd_full = None # Cloud đầy đủ khi dùng LOD (global_pcd_display chỉ chứa mức đang hiển thị)
+global_lod = None
+global_animation_handlers = [] # Open3D chỉ nhận một animation callback: các handler được gọi lần lượt
+global_shading_worker = None # Luồng shading nền (dict, xem start_background_shading)
+global_camera_follow = None # Trạng thái theo dõi camera (vị trí/extrinsic đã gửi, thời điểm di chuyển cuối)
+global_cull_indices = {} # Chỉ mục lưới cho frustum culling, theo mức LOD (None khi không dùng LOD)
+global_edl = None # Trạng thái EDL tương tác (extrinsic lần cuối, thời điểm di chuyển, cần tô lại)
+global_dataset = None # Bộ dữ liệu nhiều tile (dict, xem open_tile_dataset); None khi --input là một file
+global_ambient_occlusion = None # Hệ số AO (float32, theo thứ tự điểm của cloud đầy đủ); None khi tắt
 
 DARK_BG_COLOR = np.array([0.08, 0.08, 0.08])
 LIGHT_BG_COLOR = np.array([0.92, 0.92, 0.92])
@@ -43,148 +187,2634 @@ BASE_COLORS_LIST = [
 ]
 
 # --- HÀM TIỆN ÍCH ---
-def load_point_cloud(filepath):
-    global global_pcd_original_colors # Cần global để gán
-    if not os.path.exists(filepath):
-        print(f"Lỗi: File không tồn tại tại '{filepath}'")
+def _normal_cache_params(orient_mode=None, viewpoint=None):
+    # Các tham số ảnh hưởng tới kết quả pháp tuyến; đổi bất kỳ tham số nào sẽ sinh khóa mới.
+    # orient_mode/viewpoint: chế độ định hướng thực sự dùng khi khác cấu hình chung (tile luôn dùng viewpoint)
+    orient_mode = NORMAL_ORIENTATION_MODE if orient_mode is None else orient_mode
+    viewpoint = ORIENTATION_VIEWPOINT if viewpoint is None else viewpoint
+    viewpoint = None if viewpoint is None else tuple(np.asarray(viewpoint, dtype=np.float64).tolist())
+    return (NORMAL_CACHE_VERSION, NORMAL_ESTIMATION_RADIUS_FACTOR,
+            NORMAL_ESTIMATION_MAX_NN, ORIENT_NORMALS_K, orient_mode, viewpoint,
+            DOWNSAMPLE_POINT_BUDGET, ADAPTIVE_NORMAL_K if ADAPTIVE_NORMAL_RADIUS else None)
+
+def compute_normal_cache_key(filepath, sample_bytes=1 << 20, orient_mode=None, viewpoint=None):
+    # Băm kích thước + mtime + 3 đoạn mẫu (đầu/giữa/cuối) thay vì cả file nhiều GB
+    st = os.stat(filepath)
+    h = hashlib.sha1()
+    h.update(f"{st.st_size}|{st.st_mtime_ns}|{_normal_cache_params(orient_mode, viewpoint)}".encode("utf-8"))
+    with open(filepath, "rb") as f:
+        for offset in (0, max(0, st.st_size // 2 - sample_bytes // 2), max(0, st.st_size - sample_bytes)):
+            f.seek(offset)
+            h.update(f.read(sample_bytes))
+    return h.hexdigest()
+
+def _normal_cache_path(key):
+    return os.path.join(NORMAL_CACHE_DIR, f"{key}.npz")
+
+def _load_cached_array(key, field, shape, label):
+    path = _normal_cache_path(key)
+    if not os.path.exists(path):
         return None
-    print(f"Đang tải point cloud từ: {filepath}...")
-    _start_time = time.time()
     try:
-        pcd = o3d.io.read_point_cloud(filepath)
-        if not pcd.has_points():
-            print("Lỗi: Point cloud rỗng sau khi tải.")
-            return None
-        
-        if pcd.has_colors():
-            global_pcd_original_colors = np.asarray(pcd.colors).copy()
-            print("  Đã lưu màu gốc của point cloud.")
-        else:
-            global_pcd_original_colors = None
-        
-        _end_time = time.time()
-        print(f"Tải thành công: {len(pcd.points)} điểm (trong {_end_time - _start_time:.2f}s).")
-        return pcd
+        with np.load(path) as data:
+            stored_key = str(data["key"])
+            values = data[field]
+        if stored_key != key or values.shape != shape or not np.all(np.isfinite(values)):
+            raise ValueError("dữ liệu cache không khớp với point cloud")
     except Exception as e:
-        _end_time = time.time()
-        print(f"Lỗi khi tải point cloud (sau {_end_time - _start_time:.2f}s): {e}")
+        print(f"  Cache {label} không hợp lệ ({e}). Xóa và tính lại.")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
         return None
+    os.utime(path)  # Đánh dấu vừa dùng cho chính sách LRU
+    return values
 
-def preprocess_point_cloud_for_shading(pcd, radius_factor, max_nn, orient_k):
-    print("\n[Bước Tiền Xử Lý PCD]")
-    _total_preprocess_time_start = time.time()
+def load_normals_from_cache(key, num_points):
+    return _load_cached_array(key, "normals", (num_points, 3), "pháp tuyến")
 
-    if not pcd.has_normals():
-        print("Point cloud chưa có pháp tuyến. Đang ước lượng...")
-        _start_normals_time = time.time()
-        if len(pcd.points) > max_nn:
+def _evict_cache_dir(directory, suffix, max_bytes, keep_path=None):
+    # Xóa file cũ nhất (theo mtime, được cập nhật khi dùng) tới khi tổng dung lượng các file `suffix` <= max_bytes
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            print(f"  Đã xóa cache cũ: {os.path.basename(path)} ({size / 1024 ** 2:.1f} MB)")
+        except OSError:
+            pass
+
+def _save_cached_array(key, field, values, label):
+    with profiling.stage(f"save_{field}_to_cache") as cache_stage:
+        try:
+            os.makedirs(NORMAL_CACHE_DIR, exist_ok=True)
+            path = _normal_cache_path(key)
+            # Đuôi .tmp (không phải .npz): _evict_cache_dir của tiến trình khác không coi file đang ghi là cache
+            # mà xóa mất trước os.replace. Truyền file handle để np.savez không tự thêm đuôi .npz.
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, key=np.array(key), **{field: values})
+            os.replace(tmp_path, path)  # Ghi nguyên tử để tiến trình khác không đọc file dở dang
+            _evict_cache_dir(NORMAL_CACHE_DIR, ".npz", NORMAL_CACHE_MAX_BYTES, keep_path=path)
+            print(f"  Đã ghi cache {label}: {path} (trong {cache_stage.elapsed:.2f}s).")
+        except Exception as e:
+            print(f"  Lỗi khi ghi cache {label}: {e}")
+
+def save_normals_to_cache(key, normals):
+    _save_cached_array(key, "normals", np.asarray(normals, dtype=np.float32), "pháp tuyến")
+
+def compute_ambient_occlusion_cache_key(normal_key):
+    # AO phụ thuộc pháp tuyến (đã nằm trong khóa pháp tuyến) và các tham số AO
+    params = (AO_RADIUS_FACTOR, AO_SAMPLES, AO_SECTORS, AO_ANGLE_BIAS, AO_STRENGTH)
+    return hashlib.sha1(f"{normal_key}|ao|{params}".encode("utf-8")).hexdigest()
+
+PLY_DTYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+def read_binary_ply_header(filepath):
+    # Trả về None nếu file không phải PLY nhị phân với vertex có kích thước cố định
+    with open(filepath, "rb") as f:
+        if f.readline().strip() != b"ply":
+            return None
+        endian = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                return None
+            tokens = line.decode("ascii", errors="replace").split()
+            if not tokens or tokens[0] in ("comment", "obj_info"):
+                continue
+            if tokens[0] == "end_header":
+                break
+            if tokens[0] == "format":
+                endian = {"binary_little_endian": "<", "binary_big_endian": ">"}.get(tokens[1])
+            elif tokens[0] == "element":
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == "property":
+                if not elements:
+                    return None
+                # Thuộc tính list/kiểu lạ -> None: chỉ chấp nhận nếu nằm sau element vertex
+                code = PLY_DTYPES.get(tokens[1]) if tokens[1] != "list" else None
+                elements[-1][2].append((tokens[-1], code))
+        header_size = f.tell()
+    if endian is None:
+        return None
+    offset = header_size
+    for name, count, props in elements:
+        if any(code is None for _, code in props):
+            return None
+        dtype = np.dtype([(prop_name, endian + code) for prop_name, code in props])
+        if name == "vertex":
+            return {"num_vertices": count, "vertex_dtype": dtype, "vertex_offset": offset}
+        offset += count * dtype.itemsize
+    return None
+
+def _ply_field_view(vertices, names):
+    if not all(name in vertices.dtype.names for name in names):
+        return None
+    # structured_to_unstructured trả về view khi các trường cùng kiểu và cách đều nhau
+    return rfn.structured_to_unstructured(vertices[list(names)])
+
+def memmap_binary_ply(filepath):
+    header = read_binary_ply_header(filepath)
+    if header is None or header["num_vertices"] == 0:
+        return None
+    vertices = np.memmap(filepath, dtype=header["vertex_dtype"], mode="r",
+                         offset=header["vertex_offset"], shape=(header["num_vertices"],))
+    points = _ply_field_view(vertices, ("x", "y", "z"))
+    if points is None:
+        return None
+    colors = None
+    for names in (("red", "green", "blue"), ("r", "g", "b"), ("diffuse_red", "diffuse_green", "diffuse_blue")):
+        colors = _ply_field_view(vertices, names)
+        if colors is not None:
+            break
+    return {"vertices": vertices, "points": points, "colors": colors,
+            "normals": _ply_field_view(vertices, ("nx", "ny", "nz"))}
+
+def ply_colors_to_float(colors, dtype=np.float32):
+    if np.issubdtype(colors.dtype, np.integer):
+        return colors.astype(dtype) / np.iinfo(colors.dtype).max
+    return colors.astype(dtype)
+
+def _is_number_line(line):
+    try:
+        [float(token) for token in line.replace(b",", b" ").split()]
+        return bool(line.strip())
+    except ValueError:
+        return False
+
+def read_ascii_layout(filepath, sample_lines=1000):
+    # Vị trí bắt đầu dữ liệu, số cột và cột x/y/z, pháp tuyến, màu; None nếu không nhận dạng được
+    ext = os.path.splitext(filepath)[1].lower()
+    layout = {"num_points": None, "delimiter": None, "normals": None, "colors": None, "color_scale": 1.0,
+              "color_scale_source": None}
+    with open(filepath, "rb") as f:
+        first = f.readline()
+        if ext == ".ply":
+            if first.strip() != b"ply":
+                return None
+            names, types, elements = [], [], 0
+            while True:
+                line = f.readline()
+                if not line:
+                    return None # Hết file trước end_header (file cụt): để Open3D đọc
+                tokens = line.decode("ascii", errors="replace").split()
+                if not tokens:
+                    continue
+                if tokens[0] == "end_header":
+                    break
+                if tokens[0] == "format" and tokens[1] != "ascii":
+                    return None
+                if tokens[0] == "element":
+                    elements += 1
+                    if elements == 1 and tokens[1] == "vertex":
+                        layout["num_points"] = int(tokens[2])
+                elif tokens[0] == "property" and elements == 1:
+                    if tokens[1] == "list" or tokens[1] not in PLY_DTYPES:
+                        return None
+                    names.append(tokens[-1])
+                    types.append(tokens[1])
+            if elements != 1 or layout["num_points"] is None or not all(n in names for n in ("x", "y", "z")):
+                return None # Có face/element khác sau vertex: để Open3D đọc
+            layout["data_offset"] = f.tell()
+            layout["num_columns"] = len(names)
+            layout["xyz"] = [names.index(n) for n in ("x", "y", "z")]
+            if all(n in names for n in ("nx", "ny", "nz")):
+                layout["normals"] = [names.index(n) for n in ("nx", "ny", "nz")]
+            for color_names in (("red", "green", "blue"), ("r", "g", "b"), ("diffuse_red", "diffuse_green", "diffuse_blue")):
+                if all(n in names for n in color_names):
+                    layout["colors"] = [names.index(n) for n in color_names]
+                    # Header đã khai báo kiểu màu: số nguyên theo thang của kiểu (uchar đã là 0..255), số thực 0..1
+                    color_type = types[layout["colors"][0]]
+                    color_dtype = np.dtype(PLY_DTYPES[color_type])
+                    layout["color_scale"] = (255.0 / np.iinfo(color_dtype).max if np.issubdtype(color_dtype, np.integer)
+                                             else 255.0)
+                    layout["color_scale_source"] = f"kiểu {color_type} trong header PLY"
+                    break
+        else:
+            data_offset = 0
+            if not _is_number_line(first) or (ext == ".pts" and len(first.split()) == 1):
+                data_offset = len(first) # Dòng tiêu đề hoặc số điểm (PTS)
+                if ext == ".pts" and first.strip().isdigit():
+                    layout["num_points"] = int(first)
+                first = f.readline()
+            layout["data_offset"] = data_offset
+            if b"," in first:
+                layout["delimiter"] = ","
+            num_columns = len(first.replace(b",", b" ").split())
+            layout["num_columns"] = num_columns
+            layout["xyz"] = [0, 1, 2]
+            if num_columns < 3:
+                return None
+            if ext == ".xyzn" and num_columns >= 6:
+                layout["normals"] = [3, 4, 5]
+            elif num_columns in (6, 7):
+                layout["colors"] = [3, 4, 5] if num_columns == 6 else [4, 5, 6] # PTS: x y z cường_độ r g b
+            elif num_columns >= 9:
+                layout["colors"], layout["normals"] = [3, 4, 5], [6, 7, 8] # x y z r g b nx ny nz
+        if layout["colors"] is not None and layout["color_scale_source"] is None:
+            # XYZ/PTS không khai báo kiểu màu: đoán 0..255 hay 0..1 một lần trên mẫu đầu file để mọi khoảng byte dùng
+            # chung thang (vùng đầu toàn màu tối <= 1 sẽ bị coi là 0..1)
+            f.seek(layout["data_offset"])
+            sample = b"".join(f.readline() for _ in range(sample_lines))
+            values = np.loadtxt(io.BytesIO(sample), delimiter=layout["delimiter"], ndmin=2)
+            layout["color_scale"] = 1.0 if values[:, layout["colors"]].max(initial=0.0) > 1.0 else 255.0
+            layout["color_scale_source"] = f"ước lượng từ {len(values)} dòng đầu"
+    return layout
+
+def _ingest_vertex_dtype(layout):
+    fields = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")] # float64: tọa độ georeference lớn không mất độ chính xác
+    if layout["normals"] is not None:
+        fields += [("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")]
+    if layout["colors"] is not None:
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    return np.dtype(fields)
+
+def _parse_ascii_range(args):
+    filepath, start, end, layout = args
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if not data.strip():
+        return np.empty(0, dtype=_ingest_vertex_dtype(layout))
+    table = np.loadtxt(io.BytesIO(data), delimiter=layout["delimiter"], ndmin=2)
+    if table.shape[1] != layout["num_columns"]:
+        raise ValueError(f"số cột {table.shape[1]} khác {layout['num_columns']} (byte {start}-{end})")
+    vertices = np.empty(len(table), dtype=_ingest_vertex_dtype(layout))
+    for name, column in zip(("x", "y", "z"), layout["xyz"]):
+        vertices[name] = table[:, column]
+    if layout["normals"] is not None:
+        for name, column in zip(("nx", "ny", "nz"), layout["normals"]):
+            vertices[name] = table[:, column]
+    if layout["colors"] is not None:
+        for name, column in zip(("red", "green", "blue"), layout["colors"]):
+            vertices[name] = np.clip(np.round(table[:, column] * layout["color_scale"]), 0, 255)
+    return vertices
+
+def _ascii_byte_ranges(filepath, start, chunk_bytes):
+    # Ranh giới khoảng được dời tới ngay sau ký tự xuống dòng kế tiếp: không dòng nào bị cắt đôi
+    size = os.path.getsize(filepath)
+    bounds = [start]
+    with open(filepath, "rb") as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _ingest_cache_path(filepath):
+    st = os.stat(filepath)
+    key = hashlib.sha1(f"{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return os.path.join(INGEST_CACHE_DIR, f"{key}.ply")
+
+def ingest_ascii_point_cloud(filepath, chunk_bytes=INGEST_CHUNK_BYTES, workers=INGEST_WORKERS):
+    # Trả về đường dẫn PLY nhị phân tương đương (đã có sẵn hoặc vừa ghi), None nếu không nhận dạng được định dạng
+    cache_path = _ingest_cache_path(filepath)
+    if os.path.exists(cache_path):
+        os.utime(cache_path) # Đánh dấu vừa dùng cho chính sách LRU
+        print(f"  Dùng bản nhị phân đã nạp trước: {cache_path}")
+        return cache_path
+    layout = read_ascii_layout(filepath)
+    if layout is None:
+        return None
+    size = os.path.getsize(filepath)
+    ranges = _ascii_byte_ranges(filepath, layout["data_offset"], chunk_bytes)
+    vertex_dtype = _ingest_vertex_dtype(layout)
+    ply_types = {"<f8": "double", "<f4": "float", "|u1": "uchar"}
+    print(f"  Nạp ASCII song song: {size / 1024 ** 2:.1f} MB, {len(ranges)} khoảng byte, {layout['num_columns']} cột.")
+    if layout["colors"] is not None:
+        print(f"  Thang màu: nhân {layout['color_scale']:g} để về 0..255 ({layout['color_scale_source']}).")
+    with profiling.stage("ingest_ascii", bytes=size) as ingest_stage:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        # Số điểm chưa biết trước với XYZ: header có trường đếm độ rộng cố định, ghi đè khi xong
+        count_field = "element vertex {:0>20d}\n"
+        header = ["ply", "format binary_little_endian 1.0", "comment ingest " + os.path.basename(filepath)]
+        header_text = "\n".join(header) + "\n"
+        props = "".join(f"property {ply_types[vertex_dtype[name].str]} {name}\n" for name in vertex_dtype.names)
+        num_points = 0
+        parsed_bytes = 0
+        try:
+            with open(tmp_path, "wb") as out, ProcessPoolExecutor(max_workers=workers) as executor:
+                out.write((header_text + count_field.format(0) + props + "end_header\n").encode("ascii"))
+                # Cửa sổ giới hạn số khoảng đang chạy: bộ nhớ chỉ giữ vài khối, kết quả ghi theo đúng thứ tự file
+                window = 2 * (workers or os.cpu_count() or 1)
+                pending = [executor.submit(_parse_ascii_range, (filepath, a, b, layout)) for a, b in ranges[:window]]
+                for i, (a, b) in enumerate(ranges):
+                    vertices = pending.pop(0).result()
+                    if i + window < len(ranges):
+                        c, d = ranges[i + window]
+                        pending.append(executor.submit(_parse_ascii_range, (filepath, c, d, layout)))
+                    vertices.tofile(out)
+                    num_points += len(vertices)
+                    parsed_bytes += b - a
+                    print(f"    {parsed_bytes / 1024 ** 2:.0f}/{size / 1024 ** 2:.0f} MB, {num_points} điểm "
+                          f"({parsed_bytes / 1024 ** 2 / max(ingest_stage.elapsed, 1e-9):.1f} MB/s)", end="\r")
+                out.seek(len(header_text))
+                out.write(count_field.format(num_points).encode("ascii"))
+            ingest_stage.count("points", num_points)
+            if layout["num_points"] is not None and layout["num_points"] != num_points:
+                print(f"\n  Cảnh báo: header khai báo {layout['num_points']} điểm, đọc được {num_points}.")
+        except BaseException:
+            # Worker lỗi hoặc Ctrl+C: không để file dở dang trong cache
             try:
-                print("  Tính toán khoảng cách lân cận...")
-                _start_dist_time = time.time()
-                sample_count_for_dist = min(len(pcd.points), 100000)
-                if len(pcd.points) > sample_count_for_dist:
-                    print(f"  PCD có {len(pcd.points)} điểm, ước lượng avg_dist trên {sample_count_for_dist} điểm ngẫu nhiên.")
-                    indices = np.random.choice(len(pcd.points), sample_count_for_dist, replace=False)
-                    pcd_sample_for_dist = pcd.select_by_index(indices)
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        os.replace(tmp_path, cache_path)
+    print(f"\n  Đã nạp {num_points} điểm ASCII ({size / 1024 ** 2 / max(ingest_stage.elapsed, 1e-9):.1f} MB/s, "
+          f"trong {ingest_stage.elapsed:.2f}s) -> {cache_path}")
+    _evict_cache_dir(INGEST_CACHE_DIR, ".ply", INGEST_CACHE_MAX_BYTES, keep_path=cache_path)
+    return cache_path
+
+def _load_point_cloud_memmap(filepath):
+    # Mọi trường đều được chép ra khi chuyển kiểu: memmap được giải phóng khi hàm trả về (không giữ trang file trong RSS)
+    mapping = memmap_binary_ply(filepath)
+    if mapping is None:
+        return None, None
+    pcd = o3d.geometry.PointCloud()
+    # Open3D legacy chỉ nhận float64: chuyển kiểu một lần duy nhất ở ranh giới này
+    pcd.points = o3d.utility.Vector3dVector(mapping["points"].astype(np.float64))
+    if mapping["normals"] is not None:
+        pcd.normals = o3d.utility.Vector3dVector(mapping["normals"].astype(np.float64))
+    colors = None
+    if mapping["colors"] is not None:
+        colors = ply_colors_to_float(mapping["colors"])
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+    return pcd, colors
+
+def _load_point_cloud_compact(filepath):
+    # Nạp toàn bộ (không lười): PointCloud của Open3D và shading cần điểm/pháp tuyến float64 trong bộ nhớ, nên cloud
+    # nạp từ .pcc lớn ngang cloud nạp từ PLY. .pcc chỉ tiết kiệm đĩa và thời gian mở lại (không parse, không ước lượng
+    # pháp tuyến). Giải mã từng khối thẳng vào mảng float64 đích, không qua bản float32 đầy đủ.
+    cloud = open_compact_cloud(filepath)
+    if cloud is None:
+        raise ValueError("không phải file .pcc hợp lệ")
+    points, normals, colors = decode_compact_cloud(cloud, normals_dtype=np.float64)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    del points
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(normals)
+        del normals
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+    return pcd, colors
+
+def read_point_cloud(filepath, point_budget=None, orient_mode=None, viewpoint=None):
+    # Không gán biến toàn cục (dùng được từ luồng nạp tile): trả về (pcd, màu gốc, khóa cache pháp tuyến).
+    # orient_mode/viewpoint: định hướng sẽ dùng cho pháp tuyến, khi khác cấu hình chung (xem _normal_cache_params)
+    if not os.path.exists(filepath):
+        print(f"Lỗi: File không tồn tại tại '{filepath}'")
+        return None, None, None
+    print(f"Đang tải point cloud từ: {filepath}...")
+    with profiling.stage("load_point_cloud") as load_stage:
+        try:
+            pcd, mapped_colors = None, None
+            if filepath.lower().endswith(".pcc"):
+                pcd, mapped_colors = _load_point_cloud_compact(filepath)
+                print("  Đã đọc cloud nén (.pcc).")
+            elif USE_MEMMAP_PLY_LOADER and filepath.lower().endswith(".ply"):
+                pcd, mapped_colors = _load_point_cloud_memmap(filepath)
+                if pcd is not None:
+                    print("  Đã đọc PLY nhị phân qua memmap.")
+            if pcd is None and ASCII_INGEST_ENABLED and filepath.lower().endswith(ASCII_POINT_EXTENSIONS):
+                ingest_path = ingest_ascii_point_cloud(filepath)
+                if ingest_path is not None:
+                    pcd, mapped_colors = _load_point_cloud_memmap(ingest_path)
+            if pcd is None:
+                pcd = o3d.io.read_point_cloud(filepath)
+            if not pcd.has_points():
+                print("Lỗi: Point cloud rỗng sau khi tải.")
+                return None, None, None
+
+            original_colors = None
+            if mapped_colors is not None:
+                original_colors = mapped_colors # Đã là bản float32 riêng, không cần copy thêm
+                print("  Đã lưu màu gốc của point cloud.")
+            elif pcd.has_colors():
+                original_colors = np.asarray(pcd.colors).astype(np.float32) # Cùng kiểu với đường memmap, nửa bộ nhớ
+                print("  Đã lưu màu gốc của point cloud.")
+
+            normal_cache_key = None
+            if NORMAL_CACHE_ENABLED and SHADING_MODE == "sun" and not pcd.has_normals():
+                cache_key = compute_normal_cache_key(filepath, orient_mode=orient_mode, viewpoint=viewpoint)
+                if point_budget is not None and len(pcd.points) > point_budget:
+                    normal_cache_key = cache_key # Cache lưu pháp tuyến của cloud đã giảm mẫu: tra sau bước đó
                 else:
-                    pcd_sample_for_dist = pcd
-                distances = pcd_sample_for_dist.compute_nearest_neighbor_distance()
-                avg_dist = np.mean(distances)
-                radius = avg_dist * radius_factor
-                _end_dist_time = time.time()
-                print(f"  Khoảng cách lân cận TB (ước lượng): {avg_dist:.4f}, Radius pháp tuyến: {radius:.4f} (tính trong {_end_dist_time - _start_dist_time:.2f}s)")
-                if radius < 0.0001:
-                    print(f"  Cảnh báo: Radius tính toán quá nhỏ ({radius:.6f}). Sử dụng fallback 0.005.")
-                    radius = 0.005
-            except Exception as e_dist:
-                print(f"  Lỗi tính avg_dist: {e_dist}. Sử dụng radius mặc định (0.01).")
-                radius = 0.01
+                    cached_normals = load_normals_from_cache(cache_key, len(pcd.points))
+                    if cached_normals is not None:
+                        pcd.normals = o3d.utility.Vector3dVector(cached_normals.astype(np.float64))
+                        print("  Đã nạp pháp tuyến từ cache (bỏ qua ước lượng).")
+                    else:
+                        normal_cache_key = cache_key
+                        print("  Không có cache pháp tuyến hợp lệ, sẽ ước lượng và ghi cache.")
+
+            load_stage.count("points", len(pcd.points))
+            print(f"Tải thành công: {len(pcd.points)} điểm (trong {load_stage.elapsed:.2f}s).")
+            return pcd, original_colors, normal_cache_key
+        except Exception as e:
+            print(f"Lỗi khi tải point cloud (sau {load_stage.elapsed:.2f}s): {e}")
+            return None, None, None
+
+def load_point_cloud(filepath):
+    global global_pcd_original_colors, global_normal_cache_key # Cần global để gán
+    pcd, global_pcd_original_colors, global_normal_cache_key = read_point_cloud(filepath, DOWNSAMPLE_POINT_BUDGET)
+    return pcd
+
+def _default_view_position_from_bounds(min_bound, max_bound):
+    center = (np.asarray(min_bound) + np.asarray(max_bound)) / 2.0
+    extent_max = np.max(np.asarray(max_bound) - np.asarray(min_bound))
+    if extent_max < 1e-6 : extent_max = 1.0
+    return center + np.array([0.0, 0.0, extent_max * 2.5])
+
+def estimate_default_view_position(pcd):
+    bbox = pcd.get_axis_aligned_bounding_box()
+    return _default_view_position_from_bounds(bbox.get_min_bound(), bbox.get_max_bound())
+
+def _cell_size_for_target(extent, num_points, points_per_cell):
+    # Các chiều ngắn hơn cạnh khối (ví dụ bề dày của mặt phẳng) chỉ có 1 khối: loại khỏi phép chia
+    extent = np.asarray(extent, dtype=np.float64)
+    num_cells_target = max(1, num_points // points_per_cell)
+    active = extent > 0
+    cell_size = float(np.max(extent)) if np.any(active) else 1.0
+    while np.any(active):
+        cell_size = float((np.prod(extent[active]) / num_cells_target) ** (1.0 / np.count_nonzero(active)))
+        too_thin = active & (extent < cell_size)
+        if not np.any(too_thin):
+            break
+        active &= ~too_thin
+    return max(cell_size, 1e-9)
+
+def _orient_chunk_worker(args):
+    points, normals, k = args
+    chunk = o3d.geometry.PointCloud()
+    chunk.points = o3d.utility.Vector3dVector(points)
+    chunk.normals = o3d.utility.Vector3dVector(normals)
+    if len(points) > k:
+        chunk.orient_normals_consistent_tangent_plane(k)
+    return np.asarray(chunk.normals)
+
+def _propagate_chunk_signs(num_chunks, chunk_a, chunk_b, votes, chunk_sizes):
+    # Prim trên đồ thị khối: luôn đi theo cạnh có độ đồng thuận mạnh nhất trước
+    adjacency = [[] for _ in range(num_chunks)]
+    for a, b, v in zip(chunk_a.tolist(), chunk_b.tolist(), votes.tolist()):
+        adjacency[a].append((b, v))
+        adjacency[b].append((a, v))
+    signs = np.zeros(num_chunks)
+    for root in np.argsort(-chunk_sizes):
+        if signs[root] != 0:
+            continue
+        signs[root] = 1.0
+        heap = [(-abs(v), root, b, v) for b, v in adjacency[root]]
+        heapq.heapify(heap)
+        while heap:
+            _, a, b, v = heapq.heappop(heap)
+            if signs[b] != 0:
+                continue
+            signs[b] = signs[a] if v >= 0 else -signs[a]
+            for c, w in adjacency[b]:
+                if signs[c] == 0:
+                    heapq.heappush(heap, (-abs(w), b, c, w))
+    return signs
+
+def orient_normals_chunked_propagation(points, normals, k, radius, chunk_points, workers=None):
+    n = len(points)
+    bbox_min = points.min(axis=0)
+    cell_size = _cell_size_for_target(points.max(axis=0) - bbox_min, n, chunk_points)
+
+    grid = np.floor((points - bbox_min) / cell_size).astype(np.int64)
+    cell_ids = np.ravel_multi_index(grid.T, tuple(grid.max(axis=0) + 1))
+    unique_cells, chunk_of_point = np.unique(cell_ids, return_inverse=True)
+    num_chunks = len(unique_cells)
+    order = np.argsort(chunk_of_point, kind="stable")
+    bounds = np.searchsorted(chunk_of_point[order], np.arange(num_chunks + 1))
+    chunks = [order[bounds[i]:bounds[i + 1]] for i in range(num_chunks)]
+    print(f"    Chia thành {num_chunks} khối (cạnh {cell_size:.4f}), định hướng cục bộ song song...")
+
+    oriented = np.empty_like(normals)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_orient_chunk_worker, ((points[idx], normals[idx], k) for idx in chunks))
+        for idx, chunk_normals in zip(chunks, results):
+            oriented[idx] = chunk_normals
+
+    if num_chunks > 1:
+        # Chỉ các điểm gần biên khối mới bỏ phiếu cho độ đồng thuận giữa hai khối kề nhau
+        local = (points - bbox_min) / cell_size - grid
+        margin = min(0.5, 2.0 * radius / cell_size)
+        boundary = np.flatnonzero(np.any((local < margin) | (local > 1.0 - margin), axis=1))
+        if len(boundary) > 1:
+            tree = cKDTree(points[boundary])
+            _, nbr = tree.query(points[boundary], k=min(k, len(boundary)), workers=-1)
+            src = np.repeat(boundary, nbr.shape[1])
+            dst = boundary[nbr.ravel()]
+            ca, cb = chunk_of_point[src], chunk_of_point[dst]
+            cross = ca != cb
+            dots = np.einsum("ij,ij->i", oriented[src[cross]], oriented[dst[cross]])
+            lo = np.minimum(ca[cross], cb[cross])
+            hi = np.maximum(ca[cross], cb[cross])
+            pair_keys, inverse = np.unique(lo * num_chunks + hi, return_inverse=True)
+            votes = np.bincount(inverse, weights=dots)
+            signs = _propagate_chunk_signs(num_chunks, pair_keys // num_chunks, pair_keys % num_chunks,
+                                           votes, np.diff(bounds))
+            oriented *= signs[chunk_of_point][:, np.newaxis]
+
+    # Dấu toàn cục tùy ý sau lan truyền: chọn quy ước đa số hướng ra xa trọng tâm
+    if np.einsum("ij,ij->", oriented, points - points.mean(axis=0)) < 0:
+        oriented *= -1.0
+    return oriented
+
+def orient_normals(pcd, mode, orient_k, radius, viewpoint=None):
+    with profiling.stage("orientation", mode=mode) as orient_stage:
+        print(f"  Đang định hướng pháp tuyến (chế độ: {mode})...")
+        if mode == "tangent_plane":
+            pcd.orient_normals_consistent_tangent_plane(orient_k)
+        elif mode == "viewpoint":
+            if viewpoint is None:
+                viewpoint = ORIENTATION_VIEWPOINT if ORIENTATION_VIEWPOINT is not None else estimate_default_view_position(pcd)
+            pcd.orient_normals_towards_camera_location(camera_location=np.asarray(viewpoint, dtype=np.float64))
+        elif mode in ("centroid_out", "centroid_in"):
+            points = np.asarray(pcd.points)
+            normals = np.asarray(pcd.normals).copy()
+            outward = np.einsum("ij,ij->i", normals, points - points.mean(axis=0)) < 0
+            flip = outward if mode == "centroid_out" else ~outward
+            normals[flip] *= -1.0
+            pcd.normals = o3d.utility.Vector3dVector(normals)
+        elif mode == "propagation":
+            oriented = orient_normals_chunked_propagation(np.asarray(pcd.points), np.asarray(pcd.normals),
+                                                          orient_k, radius, ORIENTATION_CHUNK_POINTS,
+                                                          workers=ORIENTATION_WORKERS)
+            pcd.normals = o3d.utility.Vector3dVector(oriented)
         else:
-            print(f"  PCD quá ít điểm. Sử dụng radius mặc định (0.01).")
-            radius = 0.01
-        
-        _start_est_norm_time = time.time()
-        pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn))
-        _end_est_norm_time = time.time()
-        print(f"  Ước lượng pháp tuyến cơ bản hoàn thành (trong {_end_est_norm_time - _start_est_norm_time:.2f}s).")
-
-        _start_orient_norm_time = time.time()
-        print("  Đang định hướng pháp tuyến...")
-        pcd.orient_normals_consistent_tangent_plane(orient_k)
-        _end_orient_norm_time = time.time()
-        print(f"  Định hướng pháp tuyến hoàn thành (trong {_end_orient_norm_time - _start_orient_norm_time:.2f}s).")
-        
-        _end_normals_time = time.time()
-        if not pcd.has_normals():
-            print(f"  Ước lượng pháp tuyến thất bại (tổng thời gian: {_end_normals_time - _start_normals_time:.2f}s).")
+            print(f"  Cảnh báo: Chế độ định hướng không hợp lệ '{mode}'. Dùng 'tangent_plane'.")
+            pcd.orient_normals_consistent_tangent_plane(orient_k)
+    print(f"  Định hướng pháp tuyến hoàn thành (trong {orient_stage.elapsed:.2f}s).")
+
+def write_binary_ply(filepath, points, normals=None, colors=None):
+    fields = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    if normals is not None:
+        fields += [("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")]
+    if colors is not None:
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    vertices = np.empty(len(points), dtype=fields)
+    vertices["x"], vertices["y"], vertices["z"] = points[:, 0], points[:, 1], points[:, 2]
+    if normals is not None:
+        vertices["nx"], vertices["ny"], vertices["nz"] = normals[:, 0], normals[:, 1], normals[:, 2]
+    if colors is not None:
+        if not np.issubdtype(colors.dtype, np.integer):
+            colors = np.round(np.clip(colors, 0, 1) * 255)
+        vertices["red"], vertices["green"], vertices["blue"] = colors[:, 0], colors[:, 1], colors[:, 2]
+    ply_types = {"<f4": "float", "u1": "uchar"}
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(points)}"]
+    header += [f"property {ply_types[code]} {name}" for name, code in fields]
+    header.append("end_header")
+    with open(filepath, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        vertices.tofile(f)
+
+COMPACT_MAGIC = b"PCC1"
+COMPACT_ALIGN = 64
+
+def oct_encode_normals(normals):
+    # Chiếu lên bát diện |x|+|y|+|z|=1, gập nửa dưới lên trên, lượng tử mỗi thành phần 16 bit
+    normals = np.asarray(normals, dtype=np.float32)
+    l1 = np.sum(np.abs(normals), axis=1, keepdims=True)
+    octa = normals[:, :2] / np.where(l1 > 1e-12, l1, 1.0)
+    lower = normals[:, 2] < 0
+    signs = np.where(octa[lower] >= 0, 1.0, -1.0)
+    octa[lower] = (1.0 - np.abs(octa[lower][:, ::-1])) * signs
+    return np.round((np.clip(octa, -1.0, 1.0) * 0.5 + 0.5) * 65535.0).astype(np.uint16)
+
+def oct_decode_normals(encoded, out=None):
+    # out có thể là float32 hoặc float64 (ghi thẳng vào mảng cho Vector3dVector)
+    octa = encoded.astype(np.float32) * np.float32(2.0 / 65535.0) - np.float32(1.0)
+    if out is None:
+        out = np.empty((len(encoded), 3), dtype=np.float32)
+    out[:, :2] = octa
+    out[:, 2] = 1.0 - np.abs(octa[:, 0]) - np.abs(octa[:, 1])
+    fold = np.maximum(-out[:, 2], 0.0)
+    out[:, 0] -= np.copysign(fold, out[:, 0])
+    out[:, 1] -= np.copysign(fold, out[:, 1])
+    out /= np.linalg.norm(out, axis=1, keepdims=True)
+    return out
+
+def write_compact_cloud(filepath, points, normals=None, colors=None, chunk_points=COMPACT_CHUNK_POINTS):
+    with profiling.stage("write_compact_cloud", points=len(points)) as write_stage:
+        n = len(points)
+        order = np.argsort(morton_codes(points, 21), kind="stable") # Khối liền nhau trong không gian: bbox nhỏ
+        num_chunks = (n + chunk_points - 1) // chunk_points
+        sections = [("positions", np.dtype("<u2"), 3), ("chunk_min", np.dtype("<f8"), 3), ("chunk_scale", np.dtype("<f8"), 3)]
+        if normals is not None:
+            sections.append(("normals", np.dtype("<u2"), 2))
+        if colors is not None:
+            sections.append(("colors", np.dtype("u1"), 3))
+        header = {"version": 1, "num_points": int(n), "chunk_points": int(chunk_points),
+                  "bbox_min": points.min(axis=0).tolist(), "bbox_max": points.max(axis=0).tolist(), "sections": {}}
+        offset = 0
+        for name, dtype, width in sections:
+            rows = num_chunks if name.startswith("chunk_") else n
+            header["sections"][name] = {"offset": offset, "dtype": dtype.str, "shape": [rows, width]}
+            offset += -(-rows * width * dtype.itemsize // COMPACT_ALIGN) * COMPACT_ALIGN
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_offset = -(-(len(COMPACT_MAGIC) + 4 + len(header_bytes)) // COMPACT_ALIGN) * COMPACT_ALIGN
+        tmp_path = filepath + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(COMPACT_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            f.truncate(data_offset + offset)
+        out = {name: np.memmap(tmp_path, dtype=np.dtype(info["dtype"]), mode="r+",
+                               offset=data_offset + info["offset"], shape=tuple(info["shape"]))
+               for name, info in header["sections"].items()}
+        for chunk in range(num_chunks):
+            rows = order[chunk * chunk_points:(chunk + 1) * chunk_points]
+            chunk_slice = slice(chunk * chunk_points, chunk * chunk_points + len(rows))
+            chunk_points_xyz = points[rows]
+            chunk_min = chunk_points_xyz.min(axis=0)
+            scale = (chunk_points_xyz.max(axis=0) - chunk_min) / 65535.0
+            scale[scale <= 0] = 1.0
+            out["chunk_min"][chunk] = chunk_min
+            out["chunk_scale"][chunk] = scale
+            out["positions"][chunk_slice] = np.round((chunk_points_xyz - chunk_min) / scale)
+            if normals is not None:
+                out["normals"][chunk_slice] = oct_encode_normals(normals[rows])
+            if colors is not None:
+                chunk_colors = colors[rows]
+                if not np.issubdtype(chunk_colors.dtype, np.integer):
+                    chunk_colors = np.round(np.clip(chunk_colors, 0, 1) * 255)
+                out["colors"][chunk_slice] = chunk_colors
+        for array in out.values():
+            array.flush()
+        del out
+        os.replace(tmp_path, filepath)
+    size = os.path.getsize(filepath)
+    print(f"Đã ghi cloud nén: {filepath} ({size / 1024 ** 2:.1f} MB, {size / max(n, 1):.1f} byte/điểm, "
+          f"trong {write_stage.elapsed:.2f}s).")
+    return filepath
+
+def open_compact_cloud(filepath):
+    # Chỉ đọc header và memmap các section: giải mã theo khối khi cần (decode_compact_chunk)
+    with open(filepath, "rb") as f:
+        if f.read(len(COMPACT_MAGIC)) != COMPACT_MAGIC:
+            return None
+        header_length = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_offset = -(-(len(COMPACT_MAGIC) + 4 + header_length) // COMPACT_ALIGN) * COMPACT_ALIGN
+    cloud = {"header": header, "num_points": header["num_points"], "chunk_points": header["chunk_points"],
+             "normals": None, "colors": None}
+    for name, info in header["sections"].items():
+        cloud[name] = np.memmap(filepath, dtype=np.dtype(info["dtype"]), mode="r",
+                                offset=data_offset + info["offset"], shape=tuple(info["shape"]))
+    cloud["num_chunks"] = len(cloud["chunk_min"])
+    return cloud
+
+def decode_compact_chunk(cloud, chunk, points_out=None, normals_out=None, colors_out=None):
+    # Giải mã một khối; *_out (nếu có) là lát của mảng đích để không cấp phát thêm
+    rows = slice(chunk * cloud["chunk_points"], min((chunk + 1) * cloud["chunk_points"], cloud["num_points"]))
+    positions = cloud["positions"][rows]
+    if points_out is None:
+        points_out = np.empty(positions.shape, dtype=np.float64)
+    np.multiply(positions, cloud["chunk_scale"][chunk], out=points_out)
+    points_out += cloud["chunk_min"][chunk]
+    if cloud["normals"] is not None:
+        normals_out = oct_decode_normals(cloud["normals"][rows], out=normals_out)
+    if cloud["colors"] is not None:
+        colors_out = ply_colors_to_float(cloud["colors"][rows]) if colors_out is None else np.multiply(
+            cloud["colors"][rows], np.float32(1.0 / 255.0), out=colors_out)
+    return points_out, normals_out, colors_out
+
+def decode_compact_cloud(cloud, normals_dtype=np.float32):
+    n = cloud["num_points"]
+    points = np.empty((n, 3), dtype=np.float64)
+    normals = np.empty((n, 3), dtype=normals_dtype) if cloud["normals"] is not None else None
+    colors = np.empty((n, 3), dtype=np.float32) if cloud["colors"] is not None else None
+    for chunk in range(cloud["num_chunks"]):
+        rows = slice(chunk * cloud["chunk_points"], min((chunk + 1) * cloud["chunk_points"], n))
+        decode_compact_chunk(cloud, chunk, points[rows], None if normals is None else normals[rows],
+                             None if colors is None else colors[rows])
+    return points, normals, colors
+
+def _estimate_spacing_from_sample(points_sample, total_points):
+    # Khoảng cách NN trên mẫu thưa hơn cloud thật; với bề mặt (2D) khoảng cách tỉ lệ ~ sqrt(mật độ)
+    distances, _ = cKDTree(points_sample).query(points_sample, k=2, workers=-1)
+    sample_spacing = float(np.mean(distances[:, 1]))
+    return sample_spacing * np.sqrt(len(points_sample) / max(total_points, 1))
+
+def _tile_block_worker(args):
+    (spill_path, source_path, block_coord, bbox_min, block_size, radius, max_nn,
+     orient_mode, orient_reference, output_path) = args
+    records = np.fromfile(spill_path, dtype=[("idx", "<i8"), ("xyz", "<f8", (3,))])
+    os.remove(spill_path)
+    if len(records) == 0:
+        return None
+    points = records["xyz"]
+    block_pcd = o3d.geometry.PointCloud()
+    block_pcd.points = o3d.utility.Vector3dVector(points)
+    block_pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn))
+    normals = np.asarray(block_pcd.normals).copy()
+    # Chỉ định hướng theo tham chiếu toàn cục để dấu pháp tuyến nhất quán giữa các khối
+    if orient_mode == "viewpoint":
+        flip = np.einsum("ij,ij->i", normals, orient_reference - points) < 0
+    else:
+        outward = np.einsum("ij,ij->i", normals, points - orient_reference) < 0
+        flip = outward if orient_mode == "centroid_out" else ~outward
+    normals[flip] *= -1.0
+
+    grid = np.floor((points - bbox_min) / block_size).astype(np.int64)
+    core = np.all(grid == np.asarray(block_coord), axis=1)
+    if not np.any(core):
+        return None
+    core_idx = records["idx"][core]
+    order = np.argsort(core_idx)
+    core_idx = core_idx[order]
+    core_points = points[core][order]
+    core_normals = normals[core][order]
+    mapping = memmap_binary_ply(source_path)
+    colors = mapping["colors"][core_idx] if mapping["colors"] is not None else None
+    write_binary_ply(output_path, core_points, core_normals, colors)
+    return {"file": os.path.basename(output_path), "num_points": int(core.sum()),
+            "bbox_min": core_points.min(axis=0).tolist(), "bbox_max": core_points.max(axis=0).tolist()}
+
+def preprocess_tiled_normals(filepath, output_dir, radius_factor, max_nn, orient_mode=NORMAL_ORIENTATION_MODE,
+                             block_points=TILED_BLOCK_POINTS, stream_chunk=TILED_STREAM_CHUNK, workers=TILED_WORKERS):
+    print("\n[Bước Tiền Xử Lý Theo Khối (out-of-core)]")
+    with profiling.stage("preprocess_tiled_normals") as tiled_stage:
+        mapping = memmap_binary_ply(filepath)
+        if mapping is None:
+            print("Lỗi: Chế độ theo khối cần file PLY nhị phân (x/y/z kích thước cố định).")
+            return None
+        points_mm = mapping["points"]
+        n = len(points_mm)
+
+        # Lượt 1: bounding box, trọng tâm và khoảng cách lân cận trên mẫu
+        with profiling.stage("tiled_scan") as scan_stage:
+            bbox_min = np.full(3, np.inf)
+            bbox_max = np.full(3, -np.inf)
+            coord_sum = np.zeros(3)
+            for start in range(0, n, stream_chunk):
+                chunk = points_mm[start:start + stream_chunk].astype(np.float64)
+                bbox_min = np.minimum(bbox_min, chunk.min(axis=0))
+                bbox_max = np.maximum(bbox_max, chunk.max(axis=0))
+                coord_sum += chunk.sum(axis=0)
+            # Mẫu cách đều như estimate_point_spacing: np.random.choice(n, ...) hoán vị cả n chỉ số (int64, ~1.6 GB
+            # ở 200M điểm), phá giới hạn bộ nhớ của chế độ out-of-core
+            sample = points_mm[::max(1, n // 100000)]
+            spacing = _estimate_spacing_from_sample(np.asarray(sample, dtype=np.float64), n)
+            radius = max(spacing * radius_factor, 0.0001)
+            halo = radius * TILED_HALO_FACTOR
+            block_size = max(_cell_size_for_target(bbox_max - bbox_min, n, block_points), 2.0 * halo)
+            grid_dims = np.floor((bbox_max - bbox_min) / block_size).astype(np.int64) + 1
+        print(f"  {n} điểm, radius pháp tuyến {radius:.4f}, halo {halo:.4f}, khối cạnh {block_size:.4f} "
+              f"({int(np.prod(grid_dims))} khối) (trong {scan_stage.elapsed:.2f}s).")
+
+        if orient_mode == "viewpoint":
+            orient_reference = np.asarray(ORIENTATION_VIEWPOINT if ORIENTATION_VIEWPOINT is not None
+                                          else _default_view_position_from_bounds(bbox_min, bbox_max), dtype=np.float64)
+        elif orient_mode in ("centroid_out", "centroid_in"):
+            orient_reference = coord_sum / n
         else:
-            print(f"  Đã ước lượng và định hướng pháp tuyến (tổng thời gian: {_end_normals_time - _start_normals_time:.2f}s).")
+            print(f"  Cảnh báo: Chế độ '{orient_mode}' không nhất quán giữa các khối. Dùng 'viewpoint'.")
+            orient_mode = "viewpoint"
+            orient_reference = _default_view_position_from_bounds(bbox_min, bbox_max)
+
+        # Lượt 2: phân phối điểm (kèm halo) vào file tạm của từng khối
+        with profiling.stage("tiled_bucket") as bucket_stage:
+            os.makedirs(output_dir, exist_ok=True)
+            for name in os.listdir(output_dir):
+                if name.endswith(".spill"):
+                    os.remove(os.path.join(output_dir, name)) # File tạm sót lại từ lần chạy bị ngắt
+            spill_dtype = np.dtype([("idx", "<i8"), ("xyz", "<f8", (3,))])
+            used_blocks = set()
+            for start in range(0, n, stream_chunk):
+                chunk = points_mm[start:start + stream_chunk].astype(np.float64)
+                lo = np.clip(np.floor((chunk - bbox_min - halo) / block_size).astype(np.int64), 0, grid_dims - 1)
+                hi = np.clip(np.floor((chunk - bbox_min + halo) / block_size).astype(np.int64), 0, grid_dims - 1)
+                # halo < cạnh khối nên mỗi trục chỉ lệch tối đa 1 khối: tối đa 8 khối chứa một điểm
+                for offset in np.ndindex(2, 2, 2):
+                    target = lo + np.array(offset)
+                    selected = np.flatnonzero(np.all(target <= hi, axis=1))
+                    if len(selected) == 0:
+                        continue
+                    block_ids = np.ravel_multi_index(target[selected].T, tuple(grid_dims))
+                    order = np.argsort(block_ids, kind="stable")
+                    block_ids, selected = block_ids[order], selected[order]
+                    unique_ids, starts = np.unique(block_ids, return_index=True)
+                    for block_id, rows in zip(unique_ids, np.split(selected, starts[1:])):
+                        records = np.empty(len(rows), dtype=spill_dtype)
+                        records["idx"] = rows + start
+                        records["xyz"] = chunk[rows]
+                        with open(os.path.join(output_dir, f"block_{block_id}.spill"), "ab") as f:
+                            records.tofile(f)
+                        used_blocks.add(int(block_id))
+        print(f"  Đã phân phối điểm vào {len(used_blocks)} khối (trong {bucket_stage.elapsed:.2f}s).")
+
+        # Lượt 3: ước lượng pháp tuyến từng khối song song, chỉ giữ điểm lõi
+        with profiling.stage("tiled_normals") as tiled_normals_stage:
+            jobs = []
+            for block_id in sorted(used_blocks):
+                block_coord = np.unravel_index(block_id, tuple(grid_dims))
+                jobs.append((os.path.join(output_dir, f"block_{block_id}.spill"), filepath, tuple(int(c) for c in block_coord),
+                             bbox_min, block_size, radius, max_nn, orient_mode, orient_reference,
+                             os.path.join(output_dir, f"tile_{block_id}.ply")))
+            tiles = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for i, tile in enumerate(executor.map(_tile_block_worker, jobs), 1):
+                    if tile is not None:
+                        tiles.append(tile)
+                    print(f"    Khối {i}/{len(jobs)} xong.", end="\r")
+            tiled_normals_stage.count("points", n)
+        print(f"\n  Ước lượng pháp tuyến theo khối hoàn thành (trong {tiled_normals_stage.elapsed:.2f}s).")
+
+        manifest = {"source": os.path.abspath(filepath), "num_points": int(sum(t["num_points"] for t in tiles)),
+                    "radius": radius, "orientation_mode": orient_mode, "tiles": tiles}
+        with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+    print(f"Hoàn thành tiền xử lý theo khối: {len(tiles)} tile trong '{output_dir}' (trong {tiled_stage.elapsed:.2f}s).")
+    return manifest
+
+def _voxel_keys(points, origin, voxel_size):
+    grid = np.floor((points - origin) / voxel_size).astype(np.int64)
+    dims = grid.max(axis=0) + 1
+    return (grid[:, 0] * dims[1] + grid[:, 1]) * dims[2] + grid[:, 2]
+
+def find_voxel_size_for_budget(points, point_budget, sample_size=DOWNSAMPLE_SEARCH_SAMPLE, iterations=10):
+    # Chia đôi theo thang log trên một mẫu điểm: voxel nhỏ nhất mà số voxel có điểm <= point_budget
+    origin = points.min(axis=0)
+    extent = max(float(np.max(points.max(axis=0) - origin)), 1e-9)
+    # Mẫu cách đều (không ngẫu nhiên): cùng cloud luôn cho cùng voxel, nên khóa cache pháp tuyến vẫn dùng được
+    sample = points[::max(1, -(-len(points) // sample_size))]
+    lo, hi = extent / (1 << 20), extent # Tối đa 2^20 ô mỗi trục để khóa voxel vừa int64
+    for _ in range(iterations):
+        mid = np.sqrt(lo * hi)
+        occupied = len(np.unique(_voxel_keys(sample, origin, mid)))
+        if occupied > point_budget:
+            lo = mid
+        else:
+            hi = mid
+            if occupied >= 0.95 * point_budget:
+                break
+    return hi, origin
+
+def _voxel_average(values, inverse, counts):
+    out = np.empty((len(counts), values.shape[1]), dtype=np.float64)
+    for axis in range(values.shape[1]):
+        out[:, axis] = np.bincount(inverse, weights=values[:, axis], minlength=len(counts))
+    out /= counts[:, np.newaxis]
+    return out
+
+def downsample_to_point_budget(pcd, point_budget):
+    global global_pcd_original_colors
+    points = np.asarray(pcd.points)
+    num_points = len(points)
+    with profiling.stage("downsample", points=num_points) as downsample_stage:
+        voxel_size, origin = find_voxel_size_for_budget(points, point_budget)
+        for _ in range(8):
+            # Mẫu bỏ sót một phần voxel thưa: nếu cloud đầy đủ vẫn vượt ngân sách thì nới voxel và thử lại
+            _, inverse, counts = np.unique(_voxel_keys(points, origin, voxel_size), return_inverse=True, return_counts=True)
+            if len(counts) <= point_budget:
+                break
+            voxel_size *= np.sqrt(len(counts) / point_budget) * 1.02
+        inverse = inverse.reshape(-1)
+        reduced = o3d.geometry.PointCloud()
+        reduced.points = o3d.utility.Vector3dVector(_voxel_average(points, inverse, counts))
+        if pcd.has_normals():
+            normals = _voxel_average(np.asarray(pcd.normals), inverse, counts)
+            length = np.linalg.norm(normals, axis=1, keepdims=True)
+            np.divide(normals, length, out=normals, where=length > 1e-12)
+            reduced.normals = o3d.utility.Vector3dVector(normals)
+        source_colors = global_pcd_original_colors if global_pcd_original_colors is not None else (
+            np.asarray(pcd.colors) if pcd.has_colors() else None)
+        if source_colors is not None:
+            colors = _voxel_average(source_colors, inverse, counts)
+            reduced.colors = o3d.utility.Vector3dVector(colors)
+            if global_pcd_original_colors is not None:
+                # Màu gốc phải cùng thứ tự/số điểm với cloud hiển thị (chế độ màu "Original")
+                global_pcd_original_colors = colors.astype(global_pcd_original_colors.dtype)
+    print(f"  Giảm mẫu voxel {voxel_size:.4f}: {num_points} -> {len(counts)} điểm "
+          f"(tỉ lệ {num_points / len(counts):.1f}x, trong {downsample_stage.elapsed:.2f}s).")
+    return reduced, downsample_stage.elapsed
+
+def build_point_tree(points):
+    # Cây không cân bằng/không nén node: dựng nhanh hơn nhiều với cloud lớn, truy vấn chậm hơn không đáng kể
+    return cKDTree(points, balanced_tree=False, compact_nodes=False)
+
+def estimate_point_spacing(points, tree=None, sample_count=SPACING_SAMPLE_POINTS, workers=KDTREE_WORKERS):
+    # Mẫu cách đều (tất định) nhưng lân cận được tìm trong toàn bộ cloud
+    if tree is None:
+        tree = build_point_tree(points)
+    sample = points[::max(1, len(points) // sample_count)]
+    distances, _ = tree.query(sample, k=2, workers=workers)
+    return float(np.mean(distances[:, 1])), len(sample)
+
+def estimate_normal_radius(pcd, radius_factor, max_nn, tree=None):
+    if len(pcd.points) > max_nn:
+        try:
+            print("  Tính toán khoảng cách lân cận...")
+            with profiling.stage("avg_dist") as dist_stage:
+                avg_dist, sample_count = estimate_point_spacing(np.asarray(pcd.points), tree=tree)
+                radius = avg_dist * radius_factor
+            print(f"  Khoảng cách lân cận TB ({sample_count} điểm mẫu, KD-tree toàn cloud): {avg_dist:.4f}, "
+                  f"Radius pháp tuyến: {radius:.4f} (tính trong {dist_stage.elapsed:.2f}s)")
+            if radius < 0.0001:
+                print(f"  Cảnh báo: Radius tính toán quá nhỏ ({radius:.6f}). Sử dụng fallback 0.005.")
+                radius = 0.005
+        except Exception as e_dist:
+            print(f"  Lỗi tính avg_dist: {e_dist}. Sử dụng radius mặc định (0.01).")
+            radius = 0.01
     else:
-        print("Point cloud đã có pháp tuyến (bỏ qua ước lượng).")
+        print(f"  PCD quá ít điểm. Sử dụng radius mặc định (0.01).")
+        radius = 0.01
+    return radius
 
-    if not pcd.has_colors():
-        print("Point cloud chưa có màu gốc. Gán màu xám sáng mặc định làm màu cơ bản.")
-        pcd.paint_uniform_color(BASE_COLORS_LIST[0][1])
-    
-    _total_preprocess_time_end = time.time()
-    print(f"Hoàn thành tiền xử lý PCD (trong {_total_preprocess_time_end - _total_preprocess_time_start:.2f}s).")
+def estimate_normals_adaptive(points, tree, radius_factor, k, max_nn,
+                              chunk_points=ADAPTIVE_NORMAL_CHUNK_POINTS, workers=KDTREE_WORKERS):
+    # PCA trên lân cận trong bán kính riêng từng điểm: vùng dày dùng bán kính nhỏ (không phí lân cận),
+    # vùng thưa dùng bán kính lớn (luôn đủ k điểm, pháp tuyến không bị nhiễu)
+    max_nn = min(max(max_nn, k), len(points))
+    k = min(k, max_nn)
+    # radius_factor <= 1: không lân cận nào ngoài k điểm đầu nằm trong bán kính, không cần truy vấn thêm
+    query_k = k if radius_factor <= 1.0 else max_nn
+    normals = np.empty((len(points), 3), dtype=np.float64)
+    radii = np.empty(len(points), dtype=np.float32)
+    neighbor_total = 0
+    # Duyệt theo thứ tự lá của cây: điểm liền nhau gần nhau trong không gian, truy vấn và gather thân thiện cache
+    order = tree.indices
+    for start in range(0, len(points), chunk_points):
+        rows = order[start:start + chunk_points]
+        distances, indices = tree.query(points[rows], k=query_k, workers=workers)
+        radius = radius_factor * distances[:, k - 1]
+        weights = (distances <= radius[:, np.newaxis]).astype(np.float64)
+        weights[:, :min(3, query_k)] = 1.0 # Mặt phẳng cần ít nhất 3 điểm
+        counts = weights.sum(axis=1)
+        neighbors = points[indices]
+        centered = neighbors - np.einsum("ij,ijk->ik", weights, neighbors)[:, np.newaxis, :] / counts[:, np.newaxis, np.newaxis]
+        centered *= weights[:, :, np.newaxis]
+        covariance = np.matmul(centered.transpose(0, 2, 1), centered)
+        _, eigenvectors = np.linalg.eigh(covariance)
+        normals[rows] = eigenvectors[:, :, 0] # Trị riêng nhỏ nhất
+        radii[rows] = radius
+        neighbor_total += counts.sum()
+    print(f"  Bán kính thích ứng: min {radii.min():.4f}, trung vị {np.median(radii):.4f}, max {radii.max():.4f}; "
+          f"TB {neighbor_total / max(len(points), 1):.1f} lân cận/điểm.")
+    return normals
+
+def _ambient_occlusion_chunk(points, normals, rows, sample_tree, sample_points, radius, k, sectors, bias):
+    # Horizon theo từng hướng quanh pháp tuyến: AO = 1 - TB sin(góc horizon) (đã trừ bias, suy giảm theo khoảng cách)
+    center = points[rows]
+    distances, indices = sample_tree.query(center, k=k, distance_upper_bound=radius, workers=1)
+    found = np.isfinite(distances) & (distances > radius * 1e-6) # Bỏ chính điểm đó (nếu nằm trong mẫu)
+    offsets = (sample_points[np.minimum(indices, len(sample_points) - 1)] - center[:, np.newaxis, :]).astype(np.float32)
+    distances = np.where(found, distances, radius).astype(np.float32)
+    normal = normals[rows].astype(np.float32)
+    length = np.linalg.norm(normal, axis=1)
+    valid = length > 1e-9
+    normal[valid] /= length[valid, np.newaxis]
+    # Cơ sở tiếp tuyến: trục phụ là X, trừ khi pháp tuyến gần song song với X
+    helper = np.zeros_like(normal)
+    helper[np.abs(normal[:, 0]) < 0.9, 0] = 1.0
+    helper[np.abs(normal[:, 0]) >= 0.9, 1] = 1.0
+    tangent = np.cross(normal, helper)
+    tangent /= np.maximum(np.linalg.norm(tangent, axis=1, keepdims=True), 1e-12)
+    bitangent = np.cross(normal, tangent)
+    elevation = np.einsum("ijk,ik->ij", offsets, normal) / distances
+    azimuth = np.arctan2(np.einsum("ijk,ik->ij", offsets, bitangent), np.einsum("ijk,ik->ij", offsets, tangent))
+    sector = ((azimuth + np.pi) * (sectors / (2.0 * np.pi))).astype(np.int64) % sectors
+    falloff = 1.0 - (distances / radius) ** 2
+    weight = np.maximum(elevation - bias, 0.0) * np.maximum(falloff, 0.0) * found
+    horizon = np.zeros((len(rows), sectors), dtype=np.float32)
+    flat = horizon.reshape(-1)
+    row_base = np.arange(len(rows)) * sectors
+    for j in range(weight.shape[1]): # Mỗi cột một lân cận/điểm: không có chỉ số trùng trong một lượt gán
+        cell = row_base + sector[:, j]
+        flat[cell] = np.maximum(flat[cell], weight[:, j])
+    occlusion = horizon.mean(axis=1)
+    occlusion[~valid] = 0.0
+    return rows, occlusion
+
+def compute_ambient_occlusion(points, normals, tree=None, radius_factor=AO_RADIUS_FACTOR, k=AO_SAMPLES,
+                              sectors=AO_SECTORS, bias=AO_ANGLE_BIAS, strength=AO_STRENGTH,
+                              chunk_points=AO_CHUNK_POINTS, workers=AO_WORKERS):
+    n = len(points)
+    with profiling.stage("ambient_occlusion", points=n) as ao_stage:
+        if tree is None:
+            tree = build_point_tree(points)
+        spacing, _ = estimate_point_spacing(points, tree=tree)
+        radius = max(spacing * radius_factor, 1e-9)
+        # Trên bề mặt, hình tròn bán kính radius chứa ~pi*factor^2 điểm: giảm mẫu để k lân cận phủ hết hình tròn
+        stride = max(1, int(np.pi * radius_factor ** 2 / k))
+        if stride > 1:
+            sample_points = points[::stride]
+            sample_tree = build_point_tree(sample_points)
+        else:
+            sample_points, sample_tree = points, tree
+        k = min(k, len(sample_points))
+        print(f"  Tính AO: {n} điểm, bán kính {radius:.4f}, {k} lân cận/điểm (mẫu 1/{stride}), {sectors} hướng...")
+        occlusion = np.zeros(n, dtype=np.float32)
+        order = tree.indices # Theo thứ tự lá: khối điểm liền nhau trong không gian, truy vấn thân thiện cache
+        chunks = [order[start:start + chunk_points] for start in range(0, n, chunk_points)]
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            # cKDTree.query và ufunc NumPy nhả GIL: các luồng chạy song song thật
+            futures = [executor.submit(_ambient_occlusion_chunk, points, normals, rows, sample_tree, sample_points,
+                                       radius, k, sectors, bias) for rows in chunks]
+            for future in futures:
+                rows, chunk_occlusion = future.result()
+                occlusion[rows] = chunk_occlusion
+                done += len(rows)
+                print(f"    AO: {done}/{n} điểm ({done / max(ao_stage.elapsed, 1e-9):,.0f} điểm/s)", end="\r")
+        ambient_occlusion = np.clip(1.0 - strength * occlusion, 0.0, 1.0).astype(np.float32)
+    print(f"\n  AO hoàn thành: TB {ambient_occlusion.mean():.3f}, min {ambient_occlusion.min():.3f} "
+          f"(trong {ao_stage.elapsed:.2f}s).")
+    return ambient_occlusion
+
+def load_or_compute_ambient_occlusion(pcd, normal_key):
+    # normal_key: khóa của file nguồn (compute_normal_cache_key); None thì không dùng cache
+    if not pcd.has_normals():
+        print("  Bỏ qua AO: point cloud chưa có pháp tuyến.")
+        return None
+    num_points = len(pcd.points)
+    cache_key = None
+    if NORMAL_CACHE_ENABLED and normal_key is not None:
+        cache_key = compute_ambient_occlusion_cache_key(normal_key)
+        cached = _load_cached_array(cache_key, "ambient_occlusion", (num_points,), "AO")
+        if cached is not None:
+            print("  Đã nạp AO từ cache (bỏ qua tính toán).")
+            return cached.astype(np.float32)
+    ambient_occlusion = compute_ambient_occlusion(np.asarray(pcd.points), np.asarray(pcd.normals))
+    if cache_key is not None:
+        _save_cached_array(cache_key, "ambient_occlusion", ambient_occlusion.astype(np.float16), "AO")
+    return ambient_occlusion
+
+def preprocess_point_cloud_for_shading(pcd, radius_factor, max_nn, orient_k, orient_mode=NORMAL_ORIENTATION_MODE,
+                                       point_budget=DOWNSAMPLE_POINT_BUDGET, estimate_normals=True,
+                                       normal_cache_key=None, orient_viewpoint=None):
+    print("\n[Bước Tiền Xử Lý PCD]")
+    with profiling.stage("preprocess_point_cloud", points=len(pcd.points)) as preprocess_stage:
+        reduction_ratio, downsample_seconds = 1.0, 0.0
+        if point_budget is not None and len(pcd.points) > point_budget:
+            num_points_before = len(pcd.points)
+            pcd, downsample_seconds = downsample_to_point_budget(pcd, point_budget)
+            reduction_ratio = num_points_before / len(pcd.points)
+            if NORMAL_CACHE_ENABLED and normal_cache_key is not None and not pcd.has_normals():
+                cached_normals = load_normals_from_cache(normal_cache_key, len(pcd.points))
+                if cached_normals is not None:
+                    pcd.normals = o3d.utility.Vector3dVector(cached_normals.astype(np.float64))
+                    normal_cache_key = None
+                    print("  Đã nạp pháp tuyến của cloud giảm mẫu từ cache (bỏ qua ước lượng).")
+
+        if not estimate_normals:
+            print("Bỏ qua ước lượng pháp tuyến (shading EDL chỉ cần depth buffer).")
+        elif not pcd.has_normals():
+            print("Point cloud chưa có pháp tuyến. Đang ước lượng...")
+            with profiling.stage("normals") as normals_stage:
+                points = np.asarray(pcd.points)
+                # Chế độ thích ứng dùng lại cây của bước đo khoảng cách
+                tree = build_point_tree(points) if ADAPTIVE_NORMAL_RADIUS else None
+                radius = estimate_normal_radius(pcd, radius_factor, max_nn, tree=tree)
+
+                mode = "adaptive" if ADAPTIVE_NORMAL_RADIUS else "fixed_radius"
+                with profiling.stage("estimate_normals", mode=mode) as est_norm_stage:
+                    if ADAPTIVE_NORMAL_RADIUS:
+                        pcd.normals = o3d.utility.Vector3dVector(
+                            estimate_normals_adaptive(points, tree, radius_factor, ADAPTIVE_NORMAL_K, max_nn))
+                    else:
+                        pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn))
+                    del tree
+                print(f"  Ước lượng pháp tuyến cơ bản hoàn thành (chế độ {mode}, trong {est_norm_stage.elapsed:.2f}s).")
+
+                orient_normals(pcd, orient_mode, orient_k, radius, viewpoint=orient_viewpoint)
+
+            if not pcd.has_normals():
+                print(f"  Ước lượng pháp tuyến thất bại (tổng thời gian: {normals_stage.elapsed:.2f}s).")
+            else:
+                print(f"  Đã ước lượng và định hướng pháp tuyến (tổng thời gian: {normals_stage.elapsed:.2f}s).")
+                if reduction_ratio > 1.0:
+                    # Ước lượng pháp tuyến tăng gần tuyến tính theo số điểm
+                    saved = normals_stage.elapsed * (reduction_ratio - 1.0) - downsample_seconds
+                    print(f"  Giảm mẫu tiết kiệm khoảng {saved:.2f}s so với ước lượng trên cloud đầy đủ.")
+                if NORMAL_CACHE_ENABLED and normal_cache_key is not None:
+                    save_normals_to_cache(normal_cache_key, np.asarray(pcd.normals))
+        else:
+            print("Point cloud đã có pháp tuyến (bỏ qua ước lượng).")
+
+        if not pcd.has_colors():
+            print("Point cloud chưa có màu gốc. Gán màu xám sáng mặc định làm màu cơ bản.")
+            pcd.paint_uniform_color(BASE_COLORS_LIST[0][1])
+
+    print(f"Hoàn thành tiền xử lý PCD (trong {preprocess_stage.elapsed:.2f}s).")
     return pcd
 
+def _lighting_key(sun_dir, ambient_s, diffuse_s):
+    fill_lights = tuple((tuple(np.asarray(d, dtype=np.float64).tolist()), float(i)) for d, i in FILL_LIGHTS)
+    return (tuple(np.asarray(sun_dir, dtype=np.float64).tolist()), ambient_s, diffuse_s, fill_lights)
+
+# Hệ số SH thực bậc 0..2 và tích chập cos kẹp (pi, 2pi/3, pi/4): max(0, n.l) ~ sum_k A_k Y_k(n) Y_k(l)
+SH_CLAMPED_COSINE = np.array([np.pi] + [2.0 * np.pi / 3.0] * 3 + [np.pi / 4.0] * 5)
+
+def sh_basis(directions, out=None):
+    x, y, z = directions[:, 0], directions[:, 1], directions[:, 2]
+    if out is None:
+        out = np.empty((len(directions), 9), dtype=np.float32)
+    out[:, 0] = 0.282095
+    out[:, 1] = 0.488603 * y
+    out[:, 2] = 0.488603 * z
+    out[:, 3] = 0.488603 * x
+    out[:, 4] = 1.092548 * x * y
+    out[:, 5] = 1.092548 * y * z
+    out[:, 6] = 0.315392 * (3.0 * z * z - 1.0)
+    out[:, 7] = 1.092548 * x * z
+    out[:, 8] = 0.546274 * (x * x - y * y)
+    return out
+
+def sh_light_coefficients(sun_dir, fill_lights=()):
+    # Mọi đèn gộp thành một vector 9 hệ số; đèn chiếu theo hướng d thì chiếu sáng mặt có pháp tuyến -d
+    lights = [(sun_dir, 1.0)] + list(fill_lights)
+    directions = np.array([-np.asarray(d, dtype=np.float64) / np.linalg.norm(d) for d, _ in lights])
+    intensities = np.array([i for _, i in lights], dtype=np.float64)
+    return (intensities @ sh_basis(directions, out=np.empty((len(lights), 9)))).astype(np.float32)
+
+def _light_space_basis(sun_dir):
+    # Hàng: u, v (mặt phẳng depth map) và w (hướng ánh sáng đi, độ sâu tăng theo w)
+    w = np.asarray(sun_dir, dtype=np.float64) / np.linalg.norm(sun_dir)
+    helper = np.array([1.0, 0.0, 0.0]) if abs(w[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(w, helper)
+    u /= np.linalg.norm(u)
+    return np.stack([u, np.cross(w, u), w])
+
+def _rank_filter_2d(depth_map, radius, reduce=np.minimum):
+    # Lọc min/max (2r+1)^2 bằng các lát dịch; ngoài biên là +inf (không che). Lọc min tương đương
+    # splat mỗi điểm ra các texel lân cận
+    if radius <= 0:
+        return depth_map
+    for axis in (0, 1): # Tách được theo hai trục
+        padded = np.pad(depth_map, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)],
+                        constant_values=np.inf)
+        size = depth_map.shape[axis]
+        out = padded.take(range(0, size), axis=axis).copy()
+        for shift in range(1, 2 * radius + 1):
+            reduce(out, padded.take(range(shift, shift + size), axis=axis), out=out)
+        depth_map = out
+    return depth_map
+
+def compute_sun_shadow(points, normals, sun_dir, resolution=SHADOW_MAP_RESOLUTION, splat_radius=SHADOW_SPLAT_RADIUS,
+                       pcf_radius=SHADOW_PCF_RADIUS, chunk_points=RASTER_CHUNK_POINTS):
+    # Trả về độ sáng float32 mỗi điểm: 1 không bị che, 0 nằm hẳn trong bóng (giá trị giữa ở biên bóng khi có PCF)
+    n = len(points)
+    with profiling.stage("sun_shadow", points=n) as shadow_stage:
+        basis = _light_space_basis(sun_dir)
+        origin = points[0] if n else np.zeros(3)
+        light = np.empty((3, n), dtype=np.float32) # Tọa độ u, v, độ sâu (mỗi hàng liền bộ nhớ), tương đối so với origin
+        for start in range(0, n, chunk_points):
+            light[:, start:start + chunk_points] = basis @ (points[start:start + chunk_points] - origin).T
+        uv_min = np.array([light[0].min(), light[1].min()])
+        extent = np.array([light[0].max(), light[1].max()]) - uv_min
+        texels = int(min(resolution, max(16, np.sqrt(n / SHADOW_POINTS_PER_TEXEL))))
+        texel = max(float(extent.max()) / texels, 1e-9)
+        width, height = (np.floor(extent / texel).astype(np.int64) + 1).tolist()
+        ix = np.minimum(((light[0] - uv_min[0]) / texel).astype(np.int64), width - 1)
+        iy = np.minimum(((light[1] - uv_min[1]) / texel).astype(np.int64), height - 1)
+        depth = light[2]
+        depth_map = np.full(width * height, np.inf, dtype=np.float32)
+        np.minimum.at(depth_map, iy * width + ix, depth) # Scatter-min: độ sâu gần mặt trời nhất mỗi texel
+        depth_map = _rank_filter_2d(depth_map.reshape(height, width), splat_radius)
+
+        # Độ lệch theo độ nghiêng: mặt càng xiên so với tia sáng, độ sâu giữa các texel kề nhau càng chênh
+        cos_incidence = np.abs(normals @ basis[2]) / np.maximum(np.linalg.norm(normals, axis=1), 1e-9)
+        tan_incidence = np.sqrt(np.maximum(1.0 - cos_incidence ** 2, 0.0)) / np.maximum(cos_incidence, 1e-3)
+        reach = splat_radius + pcf_radius + 1
+        biased_depth = depth - texel * (SHADOW_BIAS_TEXELS + reach * np.minimum(tan_incidence, SHADOW_MAX_SLOPE))
+        del light, cos_incidence, tan_incidence
+
+        cells = iy * width + ix
+        del ix, iy
+        # Min/max của depth map trong ô PCF: điểm gần hơn min thì sáng hẳn, xa hơn max thì tối hẳn;
+        # chỉ điểm ở biên bóng mới cần (2r+1)^2 lần tra
+        visibility = (biased_depth <= _rank_filter_2d(depth_map, pcf_radius).reshape(-1)[cells]).astype(np.float32)
+        edge = np.flatnonzero(biased_depth <= _rank_filter_2d(depth_map, pcf_radius, np.maximum).reshape(-1)[cells])
+        edge = edge[visibility[edge] == 0.0]
+        visibility[edge] = 0.0
+        if len(edge):
+            padded = np.pad(depth_map, pcf_radius, constant_values=np.inf).reshape(-1)
+            padded_width = width + 2 * pcf_radius
+            edge_cells = cells[edge] + (cells[edge] // width) * 2 * pcf_radius + pcf_radius * (padded_width + 1)
+            edge_depth = biased_depth[edge]
+            edge_visibility = np.zeros(len(edge), dtype=np.float32)
+            for dy in range(-pcf_radius, pcf_radius + 1):
+                for dx in range(-pcf_radius, pcf_radius + 1):
+                    edge_visibility += edge_depth <= padded[edge_cells + (dy * padded_width + dx)]
+            visibility[edge] = edge_visibility / (2 * pcf_radius + 1) ** 2
+        shadow_stage.count("texels", width * height)
+        shadow_stage.count("pcf_points", len(edge))
+    print(f"  Shadow map {width}x{height} (texel {texel:.4f}): {np.mean(visibility < 0.5):.1%} điểm trong bóng "
+          f"(trong {shadow_stage.elapsed:.2f}s).")
+    return visibility
+
+def _new_shading_work_buffers(chunk_points):
+    # Buffer tạm cho một khối điểm: tái sử dụng qua mọi khối và mọi lần làm mới
+    return {"vec": np.empty((chunk_points, 3), dtype=np.float32),
+            "scalar": np.empty(chunk_points, dtype=np.float32)}
+
+class ShadingCancelled(Exception):
+    pass
+
+def _run_chunks_serial(shading_state, start, stop, work, kernel, args):
+    chunk_points = shading_state["chunk_points"]
+    cancel_check = shading_state.get("cancel_check")
+    for chunk_start in range(start, stop, chunk_points):
+        if cancel_check is not None and cancel_check():
+            raise ShadingCancelled()
+        kernel(shading_state, chunk_start, min(chunk_start + chunk_points, stop), work, *args)
+
+def _get_shading_executor(workers):
+    global global_shading_executor, global_shading_executor_workers
+    if global_shading_executor is None or global_shading_executor_workers != workers:
+        if global_shading_executor is not None:
+            global_shading_executor.shutdown(wait=True)
+        global_shading_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shading")
+        global_shading_executor_workers = workers
+    return global_shading_executor
+
+def _run_backend_serial(shading_state, kernel, args):
+    _run_chunks_serial(shading_state, 0, shading_state["num_points"], shading_state["work"][0], kernel, args)
+
+def _run_backend_threaded(shading_state, kernel, args):
+    # Mỗi luồng nhận một dải điểm liên tục và bộ buffer tạm riêng, ghi vào vùng riêng của buffer đầu ra
+    n = shading_state["num_points"]
+    work_buffers = shading_state["work"]
+    if len(work_buffers) == 1 or n <= shading_state["chunk_points"]:
+        _run_backend_serial(shading_state, kernel, args)
+        return
+    bounds = np.linspace(0, n, len(work_buffers) + 1).astype(np.int64)
+    executor = _get_shading_executor(len(work_buffers))
+    futures = [executor.submit(_run_chunks_serial, shading_state, int(bounds[i]), int(bounds[i + 1]),
+                               work_buffers[i], kernel, args)
+               for i in range(len(work_buffers)) if bounds[i] < bounds[i + 1]]
+    wait(futures) # Chờ đủ mọi luồng (kể cả khi một luồng bị hủy) trước khi buffer được dùng lại
+    for future in futures:
+        future.result() # Lan truyền ngoại lệ từ luồng con
+
+SHADING_BACKENDS = {
+    "numpy-serial": _run_backend_serial,
+    "threaded": _run_backend_threaded,
+}
+
+def _for_each_chunk(shading_state, kernel, *args):
+    SHADING_BACKENDS[shading_state["backend"]](shading_state, kernel, args)
+
+def _lambert_kernel(shading_state, start, stop, work, normals_src, ambient_s, diffuse_s):
+    normals = shading_state["normals"][start:stop]
+    length = work["scalar"][:stop - start]
+    np.copyto(normals, normals_src[start:stop], casting="same_kind")
+    np.einsum("ij,ij->i", normals, normals, out=length)
+    np.sqrt(length, out=length)
+    valid = length > 1e-9
+    np.divide(normals, length[:, np.newaxis], out=normals, where=valid[:, np.newaxis])
+    normals[~valid] = 0.0
+    if shading_state["sh_basis"] is not None:
+        basis = shading_state["sh_basis"][start:stop]
+        sh_basis(normals, out=basis)
+        basis *= SH_CLAMPED_COSINE.astype(np.float32)
+        basis[~valid] = 0.0
+        _sh_lambert_kernel(shading_state, start, stop, work, ambient_s, diffuse_s)
+        return
+    lambert = shading_state["lambert"][start:stop]
+    np.dot(normals, shading_state["light_vector"], out=lambert)
+    np.maximum(lambert, 0, out=lambert)
+    if shading_state["shadow"] is not None:
+        lambert *= shading_state["shadow"][start:stop] # Bóng chỉ che mặt trời, không che đèn phụ
+    scalar = work["scalar"][:stop - start]
+    for direction, intensity in FILL_LIGHTS:
+        np.dot(normals, -np.asarray(direction, dtype=np.float32) / np.float32(np.linalg.norm(direction)), out=scalar)
+        np.maximum(scalar, 0, out=scalar)
+        scalar *= intensity
+        lambert += scalar
+    lambert *= diffuse_s
+    _add_ambient(shading_state, lambert, start, stop, work, ambient_s)
+
+def _add_ambient(shading_state, lambert, start, stop, work, ambient_s):
+    ambient_occlusion = shading_state["ambient_occlusion"]
+    if ambient_occlusion is None:
+        lambert += ambient_s
+        return
+    scalar = work["scalar"][:stop - start]
+    np.multiply(ambient_occlusion[start:stop], ambient_s, out=scalar)
+    lambert += scalar
+
+def _sh_lambert_kernel(shading_state, start, stop, work, ambient_s, diffuse_s):
+    lambert = shading_state["lambert"][start:stop]
+    np.dot(shading_state["sh_basis"][start:stop], shading_state["sh_light"], out=lambert)
+    np.maximum(lambert, 0, out=lambert)
+    if shading_state["shadow"] is not None:
+        lambert *= shading_state["shadow"][start:stop] # SH gộp mọi đèn: bóng mặt trời che cả đèn phụ (xấp xỉ)
+    lambert *= diffuse_s
+    _add_ambient(shading_state, lambert, start, stop, work, ambient_s)
+
+def _specular_kernel(shading_state, start, stop, work, points, view_pos, shininess):
+    half_vector = work["vec"][:stop - start]
+    length = work["scalar"][:stop - start]
+    # Hiệu view_pos - points tính ở float64 rồi mới ép float32 để giữ độ chính xác với tọa độ lớn
+    np.subtract(view_pos, points[start:stop], out=half_vector, casting="same_kind")
+    np.einsum("ij,ij->i", half_vector, half_vector, out=length)
+    np.sqrt(length, out=length)
+    length += 1e-9
+    half_vector /= length[:, np.newaxis]
+    half_vector += shading_state["light_vector"]
+    np.einsum("ij,ij->i", half_vector, half_vector, out=length)
+    np.sqrt(length, out=length)
+    length += 1e-9
+    spec_angle = shading_state["specular"][start:stop]
+    np.einsum("ij,ij->i", shading_state["normals"][start:stop], half_vector, out=spec_angle)
+    spec_angle /= length
+    np.maximum(spec_angle, 0, out=spec_angle)
+    np.power(spec_angle, shininess, out=spec_angle)
+    if shading_state["shadow"] is not None:
+        spec_angle *= shading_state["shadow"][start:stop]
+
+def _intensity_kernel(shading_state, start, stop, work, use_specular_flag, specular_s):
+    lambert = shading_state["lambert"][start:stop]
+    if use_specular_flag:
+        intensity = shading_state["intensity_specular"][start:stop]
+        np.multiply(shading_state["specular"][start:stop], specular_s, out=intensity)
+        intensity += lambert
+    else:
+        intensity = shading_state["intensity_diffuse"][start:stop]
+        np.copyto(intensity, lambert)
+    np.clip(intensity, 0, 1, out=intensity)
+
+def _color_kernel(shading_state, start, stop, work, intensity, base_colors):
+    out = shading_state["colors"][start:stop]
+    base = base_colors if base_colors.shape[0] == 1 else base_colors[start:stop]
+    np.multiply(base, intensity[start:stop, np.newaxis], out=out, casting="same_kind")
+    np.clip(out, 0, 1, out=out)
+
+def build_shading_state(normals, sun_dir, ambient_s, diffuse_s, chunk_points=SHADING_CHUNK_POINTS,
+                        backend=SHADING_BACKEND, workers=SHADING_WORKERS, ambient_occlusion=None, points=None):
+    # Các thành phần không phụ thuộc góc nhìn: chỉ tính lại khi pháp tuyến/mặt trời/hệ số thay đổi.
+    # Mọi mảng đều float32 và được cấp phát một lần; các lần làm mới ghi đè tại chỗ.
+    n = len(normals)
+    if backend not in SHADING_BACKENDS:
+        print(f"Cảnh báo: Backend shading không hợp lệ '{backend}'. Dùng 'numpy-serial'.")
+        backend = "numpy-serial"
+    num_workers = (workers or os.cpu_count() or 1) if backend == "threaded" else 1
+    light_vector = -np.array(sun_dir, dtype=np.float64) / np.linalg.norm(sun_dir)
+    shading_state = {
+        "num_points": n,
+        "chunk_points": chunk_points,
+        "lighting_key": _lighting_key(sun_dir, ambient_s, diffuse_s),
+        "light_vector": light_vector.astype(np.float32),
+        "normals": np.empty((n, 3), dtype=np.float32),
+        "lambert": np.empty(n, dtype=np.float32),
+        "specular": None,      # Thành phần specular lần cuối (chưa nhân specular_s)
+        "specular_key": None,  # (view_pos, shininess) ứng với "specular"
+        "intensity_diffuse": None,   # clip(lambert), dùng khi tắt specular
+        "intensity_specular": None,  # clip(lambert + specular_s * specular)
+        "intensity_specular_s": None,
+        "colors": None,              # Buffer màu đầu ra (n, 3) float32
+        "cancel_check": None,        # Hàm trả True khi kết quả đang tính đã lỗi thời (luồng nền)
+        "seconds_per_point": None,   # Chi phí một lần shading đầy đủ (đo trên luồng nền)
+        "preview_offset": 0,         # Điểm bắt đầu của lượt xem trước tiếp theo (xoay vòng theo bước)
+        "backend": backend,
+        "work": [_new_shading_work_buffers(chunk_points) for _ in range(num_workers)], # Mỗi luồng một bộ
+        "lighting_mode": LIGHTING_MODE,
+        "sh_basis": np.empty((n, 9), dtype=np.float32) if LIGHTING_MODE == "sh" else None, # A_k * Y_k(n)
+        "sh_light": sh_light_coefficients(sun_dir, FILL_LIGHTS) if LIGHTING_MODE == "sh" else None,
+        "ambient_occlusion": ambient_occlusion, # Hệ số nhân ambient từng điểm (float32) hoặc None
+        # Độ sáng theo shadow map của mặt trời hiện tại (cần points); đổi màu/specular không tính lại
+        "shadow": compute_sun_shadow(points, normals, sun_dir) if SUN_SHADOWS and points is not None else None,
+    }
+    _for_each_chunk(shading_state, _lambert_kernel, normals, ambient_s, diffuse_s)
+    return shading_state
+
+def relight_shading_state(shading_state, sun_dir, ambient_s, diffuse_s, points=None):
+    # Chế độ SH: pháp tuyến không đổi, chỉ tính lại lambert từ basis có sẵn (và shadow map nếu bật bóng)
+    with profiling.stage("relight_sh", points=shading_state["num_points"]) as relight_stage:
+        shading_state["lighting_key"] = None # Bị ngắt giữa chừng thì lần sau phải tính lại
+        if shading_state["shadow"] is not None:
+            shading_state["shadow"] = compute_sun_shadow(points, shading_state["normals"], sun_dir)
+        light_vector = -np.array(sun_dir, dtype=np.float64) / np.linalg.norm(sun_dir)
+        shading_state["light_vector"] = light_vector.astype(np.float32)
+        shading_state["sh_light"] = sh_light_coefficients(sun_dir, FILL_LIGHTS)
+        _for_each_chunk(shading_state, _sh_lambert_kernel, ambient_s, diffuse_s)
+        _discard_partial_shading(shading_state) # Cường độ/specular cũ theo đèn cũ
+        shading_state["cull_key"] = None
+        shading_state["lighting_key"] = _lighting_key(sun_dir, ambient_s, diffuse_s)
+    print(f"  Chiếu sáng lại bằng SH: {shading_state['num_points']} điểm (trong {relight_stage.elapsed * 1e3:.1f}ms).")
+
+def _ensure_shading_state(shading_state, normals, sun_dir, ambient_s, diffuse_s, ambient_occlusion=None,
+                          points=None):
+    # points: cần cho bóng đổ (SUN_SHADOWS); None thì không tính bóng
+    if (shading_state.get("num_points") != len(normals)
+            or shading_state.get("lighting_mode") != LIGHTING_MODE
+            or shading_state.get("ambient_occlusion") is not ambient_occlusion
+            or (shading_state.get("shadow") is not None) != (SUN_SHADOWS and points is not None)):
+        shading_state.clear()
+        shading_state.update(build_shading_state(normals, sun_dir, ambient_s, diffuse_s,
+                                                 ambient_occlusion=ambient_occlusion, points=points))
+    elif shading_state.get("lighting_key") != _lighting_key(sun_dir, ambient_s, diffuse_s):
+        if shading_state["sh_basis"] is not None:
+            relight_shading_state(shading_state, sun_dir, ambient_s, diffuse_s, points)
+        else:
+            shading_state.clear()
+            shading_state.update(build_shading_state(normals, sun_dir, ambient_s, diffuse_s,
+                                                     ambient_occlusion=ambient_occlusion, points=points))
+    return shading_state
+
+def shaded_intensity(shading_state, points, view_pos, specular_s, shininess, use_specular_flag):
+    n = shading_state["num_points"]
+    if not use_specular_flag:
+        if shading_state["intensity_diffuse"] is None:
+            shading_state["intensity_diffuse"] = np.empty(n, dtype=np.float32)
+            _for_each_chunk(shading_state, _intensity_kernel, False, specular_s)
+        return shading_state["intensity_diffuse"]
+
+    view_pos = np.asarray(view_pos, dtype=np.float64)
+    specular_key = (tuple(view_pos.tolist()), shininess)
+    recomputed = False
+    if shading_state["specular_key"] != specular_key:
+        if shading_state["specular"] is None:
+            shading_state["specular"] = np.empty(n, dtype=np.float32)
+        _for_each_chunk(shading_state, _specular_kernel, points, view_pos, shininess)
+        shading_state["specular_key"] = specular_key
+        recomputed = True
+    if recomputed or shading_state["intensity_specular"] is None or shading_state["intensity_specular_s"] != specular_s:
+        if shading_state["intensity_specular"] is None:
+            shading_state["intensity_specular"] = np.empty(n, dtype=np.float32)
+        _for_each_chunk(shading_state, _intensity_kernel, True, specular_s)
+        shading_state["intensity_specular_s"] = specular_s
+    return shading_state["intensity_specular"]
+
+def compute_shaded_colors(shading_state, points, base_colors, view_pos, specular_s, shininess, use_specular_flag):
+    # base_colors: (1, 3) hoặc (n, 3); kết quả ghi vào buffer shading_state["colors"]
+    intensity = shaded_intensity(shading_state, points, view_pos, specular_s, shininess, use_specular_flag)
+    if shading_state["colors"] is None:
+        shading_state["colors"] = np.empty((shading_state["num_points"], 3), dtype=np.float32)
+    _for_each_chunk(shading_state, _color_kernel, intensity, base_colors)
+    return shading_state["colors"]
+
+def compute_shaded_colors_rows(shading_state, points, base_colors, view_pos, specular_s, shininess,
+                               use_specular_flag, rows):
+    # Chỉ tô các điểm `rows`: gom pháp tuyến/lambert của chúng vào một state con, tính, rồi ghi màu về
+    # buffer đầy đủ. Các cache specular/intensity của shading_state không bị đụng tới.
+    subset_state = dict(shading_state, num_points=len(rows), # Cùng backend, buffer tạm và cancel_check
+                        normals=np.take(shading_state["normals"], rows, axis=0) if use_specular_flag else None,
+                        lambert=np.take(shading_state["lambert"], rows), specular=None, specular_key=None, intensity_diffuse=None,
+                        intensity_specular=None, intensity_specular_s=None, colors=None,
+                        shadow=None if shading_state["shadow"] is None else np.take(shading_state["shadow"], rows))
+    colors = compute_shaded_colors(subset_state, np.take(points, rows, axis=0),
+                                   base_colors if base_colors.shape[0] == 1 else np.take(base_colors, rows, axis=0),
+                                   view_pos, specular_s, shininess, use_specular_flag)
+    if shading_state["colors"] is None:
+        shading_state["colors"] = np.zeros((shading_state["num_points"], 3), dtype=np.float32)
+    shading_state["colors"][rows] = colors
+    return shading_state["colors"]
+
+def _discard_partial_shading(shading_state):
+    # Kernel bị hủy giữa chừng: các buffer phụ thuộc góc nhìn chỉ được ghi một phần
+    shading_state["specular_key"] = None
+    shading_state["intensity_specular_s"] = None
+    shading_state["intensity_diffuse"] = None
+
+def build_cull_index(points, cell_points=CULL_CELL_POINTS):
+    # Lưới đều: điểm được sắp theo ô, mỗi ô giữ dải chỉ số và AABB; loại theo frustum chỉ duyệt các ô
+    origin = points.min(axis=0)
+    cell_size = _cell_size_for_target(points.max(axis=0) - origin, len(points), cell_points)
+    keys = _voxel_keys(points, origin, cell_size)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    del keys
+    starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    cell_min = np.empty((len(starts), 3))
+    cell_max = np.empty((len(starts), 3))
+    for axis in range(3): # Từng trục để không tạo bản sao (n, 3) của points đã sắp
+        column = points[order, axis]
+        cell_min[:, axis] = np.minimum.reduceat(column, starts)
+        cell_max[:, axis] = np.maximum.reduceat(column, starts)
+    return {"order": order, "starts": starts, "ends": np.append(starts[1:], len(points)),
+            "cell_min": cell_min, "cell_max": cell_max}
+
+def frustum_planes(camera):
+    # 4 mặt bên + mặt gần trong hệ camera (x phải, y xuống, z tới), điểm trong frustum khi n.p >= 0.
+    # Đổi sang hệ thế giới: p_cam = R p + t  =>  (R^T n).p >= -n.t
+    intrinsic = camera["intrinsic"]
+    fx, fy, cx, cy = intrinsic[0, 0], intrinsic[1, 1], intrinsic[0, 2], intrinsic[1, 2]
+    planes_cam = np.array([[fx, 0.0, cx], [-fx, 0.0, camera["width"] - cx],
+                           [0.0, fy, cy], [0.0, -fy, camera["height"] - cy],
+                           [0.0, 0.0, 1.0]])
+    extrinsic = camera["extrinsic"]
+    return planes_cam @ extrinsic[:3, :3], -(planes_cam @ extrinsic[:3, 3])
+
+def cells_in_frustum(cell_min, cell_max, camera):
+    normals, offsets = frustum_planes(camera)
+    visible = np.ones(len(cell_min), dtype=bool)
+    for normal, offset in zip(normals, offsets):
+        # Đỉnh AABB xa nhất theo hướng pháp tuyến: nếu nó vẫn nằm ngoài thì cả ô nằm ngoài
+        corner = np.where(normal >= 0, cell_max, cell_min)
+        visible &= corner @ normal >= offset
+    return visible
+
+def _cell_rows(cull_index, cells):
+    if len(cells) == 0:
+        return np.empty(0, dtype=np.int64)
+    order, starts, ends = cull_index["order"], cull_index["starts"], cull_index["ends"]
+    return np.concatenate([order[starts[c]:ends[c]] for c in cells])
+
+def _frustum_cull(level, points, shading_state, params_key, camera):
+    cull_index = global_cull_indices.get(level)
+    if cull_index is None:
+        with profiling.stage("build_cull_index", points=len(points)):
+            cull_index = global_cull_indices[level] = build_cull_index(points)
+    num_cells = len(cull_index["starts"])
+    if shading_state.get("cull_key") != params_key:
+        # Màu/specular/góc nhìn (khi có specular) đổi: mọi ô phải tô lại, ô ngoài màn hình tô sau
+        shading_state["cull_key"] = params_key
+        shading_state["cull_dirty"] = np.ones(num_cells, dtype=bool)
+    elif shading_state.get("cull_dirty") is None:
+        shading_state["cull_dirty"] = np.zeros(num_cells, dtype=bool) # Lần trước đã tô toàn bộ
+    visible_cells = np.flatnonzero(cells_in_frustum(cull_index["cell_min"], cull_index["cell_max"], camera))
+    return {"index": cull_index, "visible_cells": visible_cells,
+            "dirty_cells": visible_cells[shading_state["cull_dirty"][visible_cells]]}
+
+def upload_colors(pcd, colors, element_index=None):
+    # np.asarray(pcd.colors) là view ghi được vào std::vector của Open3D: khi số điểm không đổi, màu mới chỉ tốn
+    # một lượt chép (ép float32 -> float64), không cấp phát. update_geometry() vẫn cần để đẩy lên GPU.
+    # element_index: chỉ ghi các phần tử này của buffer phẳng (3 * điểm + kênh), các điểm khác giữ màu đang hiển
+    # thị. np.put trên chỉ số phẳng nhanh hơn gán fancy index 2 chiều vài lần.
+    buffer = np.asarray(pcd.colors)
+    if element_index is not None:
+        np.put(buffer.reshape(-1), element_index, colors)
+    elif COLOR_UPLOAD_IN_PLACE and buffer.shape == colors.shape:
+        np.copyto(buffer, colors, casting="same_kind")
+    else:
+        # Vector3dVector chép nhanh (memcpy) khi đầu vào đã là float64 liền bộ nhớ
+        pcd.colors = o3d.utility.Vector3dVector(np.ascontiguousarray(colors, dtype=np.float64))
+
 def apply_enhanced_sun_shading(pcd_target, base_color_rgb_array,
                                sun_dir, view_pos,
                                ambient_s, diffuse_s, specular_s=0.0, shininess=32.0,
-                               use_specular_flag=False):
+                               use_specular_flag=False, shading_state=None, ambient_occlusion=None):
     if not pcd_target.has_normals():
         print("Cảnh báo: Shading cần pháp tuyến.")
         pcd_target.paint_uniform_color(base_color_rgb_array if base_color_rgb_array is not None else [0.7,0.7,0.7])
         return pcd_target
 
     print(f"Đang áp dụng shading (Specular: {use_specular_flag})...")
-    _start_shading_time = time.time()
+    with profiling.stage("apply_shading", points=len(pcd_target.points), specular=int(use_specular_flag)) as shading_stage:
 
-    light_vector = -np.array(sun_dir) / np.linalg.norm(sun_dir)
-    normals = np.asarray(pcd_target.normals)
-    points = np.asarray(pcd_target.points)
+        # shading_state (dict) được cập nhật tại chỗ để lần gọi sau tái sử dụng các thành phần đã tính
+        if shading_state is None:
+            shading_state = {}
+        points = np.asarray(pcd_target.points)
+        _ensure_shading_state(shading_state, np.asarray(pcd_target.normals), sun_dir, ambient_s, diffuse_s,
+                              ambient_occlusion, points)
 
-    norm_lengths = np.linalg.norm(normals, axis=1, keepdims=True)
-    valid_normals_mask = norm_lengths.flatten() > 1e-9
-    normals_normalized = np.zeros_like(normals)
-    if np.any(valid_normals_mask):
-        normals_normalized[valid_normals_mask] = normals[valid_normals_mask] / norm_lengths[valid_normals_mask]
+        if base_color_rgb_array is not None:
+            if base_color_rgb_array.ndim == 1 and base_color_rgb_array.size == 3:
+                base_colors = base_color_rgb_array.reshape(1, 3) # Broadcast thay vì np.tile
+            elif base_color_rgb_array.ndim == 2 and base_color_rgb_array.shape[0] == len(points):
+                base_colors = base_color_rgb_array
+            else:
+                print("Lỗi: base_color_rgb_array không hợp lệ. Dùng màu xám.")
+                base_colors = np.array([[0.7,0.7,0.7]])
+        else:
+            print("Không có màu cơ bản hợp lệ, tạo màu xám dựa trên cường độ shading.")
+            base_colors = np.ones((1, 3))
 
-    diffuse_intensity = np.sum(normals_normalized * light_vector, axis=1)
-    diffuse_contrib = np.maximum(0, diffuse_intensity) * diffuse_s
-    shaded_intensities = ambient_s + diffuse_contrib
+        new_colors = compute_shaded_colors(shading_state, points, base_colors, view_pos,
+                                           specular_s, shininess, use_specular_flag)
+        upload_colors(pcd_target, new_colors)
 
-    if use_specular_flag:
-        view_vector_to_points = view_pos - points
-        view_vector_norm = view_vector_to_points / (np.linalg.norm(view_vector_to_points, axis=1, keepdims=True) + 1e-9)
-        half_vector = (light_vector + view_vector_norm)
-        half_vector_norm = half_vector / (np.linalg.norm(half_vector, axis=1, keepdims=True) + 1e-9)
-        spec_angle = np.sum(normals_normalized * half_vector_norm, axis=1)
-        specular_contrib = specular_s * np.power(np.maximum(0, spec_angle), shininess)
-        shaded_intensities += specular_contrib
-
-    shaded_intensities = np.clip(shaded_intensities, 0, 1)
-
-    if base_color_rgb_array is not None:
-        if base_color_rgb_array.ndim == 1 and base_color_rgb_array.size == 3:
-            base_colors_tiled = np.tile(base_color_rgb_array, (len(points), 1))
-        elif base_color_rgb_array.ndim == 2 and base_color_rgb_array.shape[0] == len(points):
-            base_colors_tiled = base_color_rgb_array
+    print(f"Đã áp dụng shading (trong {shading_stage.elapsed:.2f}s).")
+    return pcd_target
+
+
+def _morton_part1by2(x):
+    # Chèn 2 bit 0 giữa các bit của số 21 bit (mã Morton 3D 63 bit)
+    x = x & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+def morton_codes(points, depth):
+    bbox_min = points.min(axis=0)
+    size = max(float(np.max(points.max(axis=0) - bbox_min)), 1e-9)
+    cells = np.uint64(1) << np.uint64(depth)
+    grid = np.clip((points - bbox_min) / size * float(cells), 0, float(cells) - 1).astype(np.uint64)
+    return (_morton_part1by2(grid[:, 0]) << np.uint64(2)) | (_morton_part1by2(grid[:, 1]) << np.uint64(1)) | _morton_part1by2(grid[:, 2])
+
+def build_lod_pyramid(points, point_budget, max_depth=LOD_MAX_DEPTH):
+    print("\n[Bước Xây Dựng LOD Octree]")
+    with profiling.stage("build_lod_pyramid", points=len(points)) as lod_stage:
+        max_depth = min(max_depth, 21)
+        codes = morton_codes(points, max_depth)
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        del codes
+        levels = []
+        for depth in range(1, max_depth + 1):
+            prefix = sorted_codes >> np.uint64(3 * (max_depth - depth))
+            starts = np.flatnonzero(np.concatenate(([True], prefix[1:] != prefix[:-1])))
+            if len(starts) > point_budget:
+                break
+            # Đại diện mỗi nút: điểm ở giữa nhóm theo thứ tự Morton (gần tâm nút hơn điểm đầu nhóm)
+            ends = np.append(starts[1:], len(sorted_codes))
+            levels.append(np.sort(order[(starts + ends) // 2]))
+            print(f"  Mức {depth}: {len(starts)} nút")
+        levels.append(None) # Mức cuối: toàn bộ điểm
+    print(f"Hoàn thành LOD: {len(levels) - 1} mức thô + mức đầy đủ ({len(points)} điểm) (trong {lod_stage.elapsed:.2f}s).")
+    return {
+        "levels": levels,
+        "coarse_level": max(0, len(levels) - 2), # Mức mịn nhất vẫn nằm trong point_budget
+        "active_level": len(levels) - 1,
+        "requested_level": len(levels) - 1, # Mức đang chờ luồng shading nền (hiển thị khi có màu)
+        "level_arrays": {}, # (points, normals) NumPy của các mức thô
+        "level_ambient_occlusion": {}, # Hệ số AO của các mức thô
+        "states": {}, # Shading state riêng cho từng mức
+        "last_extrinsic": None,
+        "last_move_time": 0.0,
+    }
+
+def _active_lod_indices():
+    if global_lod is None:
+        return None
+    return global_lod["levels"][global_lod["active_level"]]
+
+def _shading_state_for_level(level):
+    if global_lod is None:
+        return global_shading_state
+    return global_lod["states"].setdefault(level, {})
+
+def _active_shading_state():
+    return _shading_state_for_level(None if global_lod is None else global_lod["active_level"])
+
+def _lod_level_arrays(level):
+    # Mảng NumPy riêng của mỗi mức (không phải view vào global_pcd_display) để luồng nền đọc an toàn
+    lod_indices = global_lod["levels"][level]
+    if lod_indices is None:
+        return np.asarray(global_pcd_full.points), np.asarray(global_pcd_full.normals)
+    arrays = global_lod["level_arrays"].get(level)
+    if arrays is None:
+        arrays = (np.asarray(global_pcd_full.points)[lod_indices],
+                  np.asarray(global_pcd_full.normals)[lod_indices] if global_pcd_full.has_normals() else None)
+        global_lod["level_arrays"][level] = arrays
+    return arrays
+
+def _ambient_occlusion_for_level(level):
+    # Cùng một mảng cho mỗi mức qua các lần gọi: shading state so sánh AO theo danh tính
+    if global_ambient_occlusion is None or global_lod is None or global_lod["levels"][level] is None:
+        return global_ambient_occlusion
+    ambient_occlusion = global_lod["level_ambient_occlusion"].get(level)
+    if ambient_occlusion is None:
+        ambient_occlusion = global_ambient_occlusion[global_lod["levels"][level]]
+        global_lod["level_ambient_occlusion"][level] = ambient_occlusion
+    return ambient_occlusion
+
+def _base_color_for(color_index, lod_indices):
+    color_name, color_rgb_data = BASE_COLORS_LIST[color_index]
+    if color_name == "Original" and global_pcd_original_colors is not None:
+        return global_pcd_original_colors if lod_indices is None else global_pcd_original_colors[lod_indices]
+    return color_rgb_data if color_rgb_data is not None else BASE_COLORS_LIST[0][1]
+
+def _resolve_base_color():
+    return _base_color_for(global_current_base_color_index, _active_lod_indices())
+
+def _current_view_position(vis):
+    cam_params = vis.get_view_control().convert_to_pinhole_camera_parameters()
+    ext_inv = np.linalg.inv(cam_params.extrinsic)
+    return ext_inv[:3, 3]
+
+def _current_camera(vis):
+    cam_params = vis.get_view_control().convert_to_pinhole_camera_parameters()
+    return {"extrinsic": np.asarray(cam_params.extrinsic), "intrinsic": np.asarray(cam_params.intrinsic.intrinsic_matrix),
+            "width": cam_params.intrinsic.width, "height": cam_params.intrinsic.height}
+
+def shade_display(view_pos):
+    apply_enhanced_sun_shading(global_pcd_display,
+                               base_color_rgb_array=_resolve_base_color(),
+                               sun_dir=SUN_DIRECTION, view_pos=view_pos,
+                               ambient_s=AMBIENT_STRENGTH, diffuse_s=DIFFUSE_STRENGTH,
+                               specular_s=SPECULAR_STRENGTH, shininess=SHININESS_FACTOR,
+                               use_specular_flag=global_specular_on,
+                               shading_state=_active_shading_state(),
+                               ambient_occlusion=_ambient_occlusion_for_level(
+                                   None if global_lod is None else global_lod["active_level"]))
+
+def _paint_display_base_color():
+    base_color = _resolve_base_color()
+    if base_color.ndim == 2:
+        upload_colors(global_pcd_display, base_color)
+    else:
+        global_pcd_display.paint_uniform_color(base_color)
+
+def _show_lod_level(level):
+    global_lod["active_level"] = level
+    if global_lod["levels"][level] is None:
+        global_pcd_display.points = global_pcd_full.points
+        global_pcd_display.normals = global_pcd_full.normals
+    else:
+        points, normals = _lod_level_arrays(level)
+        global_pcd_display.points = o3d.utility.Vector3dVector(points)
+        if normals is not None:
+            global_pcd_display.normals = o3d.utility.Vector3dVector(normals)
+
+def set_lod_level(level, view_pos):
+    global_lod["requested_level"] = level
+    if global_shading_worker is not None:
+        # Giữ mức cũ trên màn hình cho tới khi luồng nền có màu cho mức mới (đổi hình học + màu cùng lúc)
+        request_background_shading(view_pos, level)
+        return False
+    _show_lod_level(level)
+    if APPLY_ENHANCED_SHADING and SHADING_MODE == "sun":
+        shade_display(view_pos)
+    else:
+        _paint_display_base_color()
+        if global_edl is not None:
+            global_edl["dirty"] = True # Tô EDL lại khi camera dừng
+    return True
+
+def lod_animation_handler(vis):
+    if global_lod is None:
+        return False
+    extrinsic = vis.get_view_control().convert_to_pinhole_camera_parameters().extrinsic
+    now = time.time()
+    last_extrinsic = global_lod["last_extrinsic"]
+    global_lod["last_extrinsic"] = extrinsic
+    full_level = len(global_lod["levels"]) - 1
+    if last_extrinsic is not None and np.max(np.abs(extrinsic - last_extrinsic)) > LOD_MOTION_EPSILON:
+        global_lod["last_move_time"] = now
+        target_level = global_lod["coarse_level"]
+    elif now - global_lod["last_move_time"] >= LOD_SETTLE_SECONDS:
+        target_level = full_level
+    else:
+        return False
+    if target_level == global_lod["requested_level"]:
+        return False
+    if not set_lod_level(target_level, np.linalg.inv(extrinsic)[:3, 3]):
+        return False
+    vis.update_geometry(global_pcd_display)
+    return True
+
+def register_animation_handler(handler):
+    global_animation_handlers.append(handler)
+
+def _animation_dispatch_cb(vis):
+    need_update = False
+    for handler in global_animation_handlers:
+        need_update = handler(vis) or need_update
+    return need_update
+
+def start_background_shading():
+    # Một luồng nền, một ô yêu cầu: yêu cầu mới ghi đè yêu cầu chưa chạy (gộp) và hủy việc đang chạy
+    worker = {
+        "condition": threading.Condition(),
+        "pending": None,   # Yêu cầu mới nhất chưa được nhận
+        "generation": 0,   # Tăng mỗi lần có yêu cầu; kết quả thuộc thế hệ cũ bị bỏ
+        "result": None,    # Kết quả hoàn chỉnh chờ animation callback đưa lên màn hình
+        "busy": False,
+        "stopped": False,
+    }
+    worker["thread"] = threading.Thread(target=_background_shading_loop, args=(worker,),
+                                        name="shading-background", daemon=True)
+    worker["thread"].start()
+    return worker
+
+def stop_background_shading(worker):
+    with worker["condition"]:
+        worker["stopped"] = True
+        worker["generation"] += 1 # Hủy việc đang chạy
+        worker["condition"].notify()
+    worker["thread"].join()
+
+def background_shading_busy(worker):
+    with worker["condition"]:
+        return worker["busy"] or worker["pending"] is not None
+
+def request_background_shading(view_pos, level=None, preview=False, camera=None):
+    # camera (dict từ _current_camera) cho phép luồng nền chỉ tô các điểm trong frustum
+    worker = global_shading_worker
+    if level is None and global_lod is not None:
+        level = global_lod["requested_level"]
+    request = {"view_pos": np.array(view_pos, dtype=np.float64), "level": level, "preview": preview,
+               "camera": camera, "color_index": global_current_base_color_index,
+               "specular_on": global_specular_on}
+    with worker["condition"]:
+        worker["generation"] += 1
+        request["generation"] = worker["generation"]
+        worker["pending"] = request
+        worker["condition"].notify()
+
+def _shade_background_request(worker, request):
+    level = request["level"]
+    if global_lod is None:
+        points, normals = np.asarray(global_pcd_display.points), np.asarray(global_pcd_display.normals)
+        lod_indices = None
+    else:
+        points, normals = _lod_level_arrays(level)
+        lod_indices = global_lod["levels"][level]
+    base_colors = np.asarray(_base_color_for(request["color_index"], lod_indices)).reshape(-1, 3)
+    shading_state = _shading_state_for_level(level)
+    _ensure_shading_state(shading_state, normals, SUN_DIRECTION, AMBIENT_STRENGTH, DIFFUSE_STRENGTH,
+                          _ambient_occlusion_for_level(level), points)
+    view_pos, specular_on = request["view_pos"], request["specular_on"]
+    params_key = (request["color_index"], specular_on, tuple(view_pos.tolist()) if specular_on else None)
+    cull = None
+    # Diffuse đã có cường độ trong cache thì tô toàn bộ chỉ còn một phép nhân màu: không cần culling
+    if FRUSTUM_CULLING and request["camera"] is not None and (specular_on or shading_state["intensity_diffuse"] is None):
+        cull = _frustum_cull(level, points, shading_state, params_key, request["camera"])
+    shading_state["cancel_check"] = lambda: worker["generation"] != request["generation"]
+    seconds_per_point = shading_state["seconds_per_point"]
+    try:
+        if (request["preview"] and specular_on and seconds_per_point is not None
+                and shading_state["colors"] is not None):
+            # Khi camera đang di chuyển: chỉ tô các điểm offset::stride (trong tầm nhìn nếu có culling), điểm
+            # khác giữ màu cũ. offset xoay vòng nên sau `stride` lượt mọi điểm đã được cập nhật.
+            rows = np.arange(len(points)) if cull is None else _cell_rows(cull["index"], cull["visible_cells"])
+            stride = max(1, int(np.ceil(len(rows) * seconds_per_point / SPECULAR_FOLLOW_FRAME_BUDGET)))
+            offset = shading_state["preview_offset"] % stride
+            shading_state["preview_offset"] = offset + 1
+            rows = rows[offset::stride]
+            colors = compute_shaded_colors_rows(shading_state, points, base_colors, view_pos,
+                                                SPECULAR_STRENGTH, SHININESS_FACTOR, True, rows)
+            shading_state["cull_key"] = None # Buffer giờ lẫn màu của hai góc nhìn
+            if (COLOR_UPLOAD_IN_PLACE and 4 * len(rows) <= len(points)
+                    and (global_lod is None or level == global_lod["active_level"])):
+                # Chỉ công bố các điểm vừa tô, luồng chính ghi rải vào buffer màu đang hiển thị. Ghi rải tốn cỡ 4
+                # lần chép liền mỗi điểm nên chỉ lợi khi tô ít hơn 1/4 cloud; chỉ số phẳng tính sẵn ở đây.
+                element_index = (rows[:, np.newaxis] * 3 + np.arange(3)).ravel()
+                return colors[rows].astype(np.float64).ravel(), element_index
+        elif ((cull is not None and len(cull["dirty_cells"]) == 0)
+              or (cull is None and shading_state.get("cull_key") == params_key
+                  and not np.any(shading_state.get("cull_dirty", False)))):
+            # Mọi điểm (trong tầm nhìn) đã được tô với tham số hiện tại: chỉ công bố khi phải đổi mức LOD
+            if global_lod is None or level == global_lod["active_level"]:
+                return None
+            colors = shading_state["colors"]
+        elif cull is not None and len(cull["dirty_cells"]) <= CULL_MAX_VISIBLE_FRACTION * len(cull["index"]["starts"]):
+            rows = _cell_rows(cull["index"], cull["dirty_cells"])
+            _start_time = time.perf_counter()
+            colors = compute_shaded_colors_rows(shading_state, points, base_colors, view_pos,
+                                                SPECULAR_STRENGTH, SHININESS_FACTOR, specular_on, rows)
+            if specular_on:
+                shading_state["seconds_per_point"] = (time.perf_counter() - _start_time) / len(rows)
+            shading_state["cull_dirty"][cull["dirty_cells"]] = False
         else:
-            print("Lỗi: base_color_rgb_array không hợp lệ. Dùng màu xám.")
-            base_colors_tiled = np.tile(np.array([0.7,0.7,0.7]), (len(points),1))
-        new_colors = base_colors_tiled * shaded_intensities[:, np.newaxis]
+            specular_stale = shading_state["specular_key"] != (tuple(view_pos.tolist()), SHININESS_FACTOR)
+            _start_time = time.perf_counter()
+            colors = compute_shaded_colors(shading_state, points, base_colors, view_pos,
+                                           SPECULAR_STRENGTH, SHININESS_FACTOR, specular_on)
+            if specular_on and specular_stale:
+                shading_state["seconds_per_point"] = (time.perf_counter() - _start_time) / max(len(points), 1)
+            shading_state["cull_key"], shading_state["cull_dirty"] = params_key, None # Đã tô toàn bộ
+        # Ảnh chụp float64 trên luồng nền (buffer của state sẽ bị ghi đè): animation callback chỉ còn một memcpy
+        return colors.astype(np.float64), None
+    except ShadingCancelled:
+        _discard_partial_shading(shading_state)
+        shading_state["cull_key"] = None # Buffer màu đã bị ghi một phần
+        raise
+    finally:
+        shading_state["cancel_check"] = None
+
+def _background_shading_loop(worker):
+    condition = worker["condition"]
+    while True:
+        with condition:
+            while worker["pending"] is None and not worker["stopped"]:
+                condition.wait()
+            if worker["stopped"]:
+                return
+            request, worker["pending"] = worker["pending"], None
+            worker["busy"] = True
+        shaded = None
+        with profiling.stage("background_shading", specular=int(request["specular_on"]),
+                             preview=int(request["preview"])) as bg_stage:
+            try:
+                shaded = _shade_background_request(worker, request) # None: không có gì cần tô lại
+            except ShadingCancelled:
+                bg_stage.count("cancelled") # Có yêu cầu mới hơn: bỏ dở, không công bố
+            except Exception as e_bg:
+                print(f"  Lỗi shading nền: {e_bg}")
+        with condition:
+            worker["busy"] = False
+            if shaded is not None and request["generation"] == worker["generation"]:
+                worker["result"] = {"level": request["level"], "colors": shaded[0], "element_index": shaded[1],
+                                    "seconds": bg_stage.elapsed, "preview": request["preview"]}
+
+def background_shading_animation_handler(vis):
+    worker = global_shading_worker
+    if worker is None:
+        return False
+    with worker["condition"]:
+        result, worker["result"] = worker["result"], None
+    if result is None:
+        return False
+    if global_lod is not None and result["level"] != global_lod["active_level"]:
+        if result["element_index"] is not None:
+            return False # Bản xem trước từng phần của mức chưa hiển thị: bỏ, lần tô đầy đủ sẽ tới sau
+        _show_lod_level(result["level"])
+    upload_colors(global_pcd_display, result["colors"], result["element_index"])
+    vis.update_geometry(global_pcd_display)
+    if not result["preview"]: # Bản xem trước đến mỗi khung hình khi xoay: không in log
+        print(f"  Shading nền: Đã cập nhật màu (tính trong {result['seconds']:.2f}s).")
+    return True
+
+def start_camera_follow(pcd, view_pos):
+    bbox = pcd.get_axis_aligned_bounding_box()
+    return {"view_pos": np.asarray(view_pos, dtype=np.float64),
+            "extrinsic": None,
+            "scene_scale": max(float(np.linalg.norm(bbox.get_max_bound() - bbox.get_min_bound())), 1e-9),
+            "last_move_time": 0.0,
+            "needs_full": False} # Đã gửi bản xem trước, còn nợ một lần tính đầy đủ khi camera dừng
+
+def _cull_cells_pending():
+    # Còn ô chưa tô với tham số hiện tại (nằm ngoài tầm nhìn lúc tô): xoay camera có thể đưa chúng vào khung hình
+    level = None if global_lod is None else global_lod["requested_level"]
+    cull_dirty = _shading_state_for_level(level).get("cull_dirty")
+    return cull_dirty is not None and bool(cull_dirty.any())
+
+def camera_follow_animation_handler(vis):
+    # Đọc camera mỗi khung hình. Specular bám camera: khi đang di chuyển chỉ gửi bản xem trước lấy mẫu lúc
+    # luồng nền rảnh. Frustum culling: khi hướng nhìn đổi, gửi yêu cầu để tô các ô vừa lọt vào tầm nhìn.
+    follow = global_camera_follow
+    if follow is None:
+        return False
+    camera = _current_camera(vis)
+    view_pos = np.linalg.inv(camera["extrinsic"])[:3, 3]
+    now = time.time()
+    moved = (SPECULAR_FOLLOW_CAMERA and global_specular_on and
+             np.linalg.norm(view_pos - follow["view_pos"]) > SPECULAR_FOLLOW_MIN_MOVE * follow["scene_scale"])
+    # Chỉ xoay (không dời) mà specular tắt và không còn ô bẩn thì màu không đổi: không gửi yêu cầu
+    turned = (FRUSTUM_CULLING and follow["extrinsic"] is not None and
+              np.max(np.abs(camera["extrinsic"] - follow["extrinsic"])) > LOD_MOTION_EPSILON and
+              (global_specular_on or _cull_cells_pending()))
+    if follow["extrinsic"] is None:
+        follow["extrinsic"] = camera["extrinsic"]
+    if moved or turned:
+        follow["last_move_time"] = now
+        if not background_shading_busy(global_shading_worker):
+            follow["extrinsic"] = camera["extrinsic"]
+            if moved:
+                follow["view_pos"] = view_pos
+                follow["needs_full"] = True
+            request_background_shading(follow["view_pos"], preview=moved, camera=camera)
+    elif follow["needs_full"] and now - follow["last_move_time"] >= SPECULAR_FOLLOW_SETTLE_SECONDS:
+        follow["view_pos"] = view_pos
+        follow["needs_full"] = False
+        request_background_shading(view_pos, camera=camera)
+    return False
+
+def shade_display_edl(vis):
+    # Chụp depth buffer của khung hình hiện tại rồi nhân hệ số EDL vào màu cơ bản của từng điểm
+    with profiling.stage("edl_refresh", points=len(global_pcd_display.points)) as edl_stage:
+        camera = _current_camera(vis)
+        depth = np.asarray(vis.capture_depth_float_buffer(do_render=True))
+        factors = edl_point_factors(np.asarray(global_pcd_display.points), depth, camera)
+        base_color = np.asarray(_resolve_base_color(), dtype=np.float32).reshape(-1, 3)
+        upload_colors(global_pcd_display, base_color * factors[:, np.newaxis])
+    return edl_stage.elapsed
+
+def edl_animation_handler(vis):
+    # Depth đổi theo camera: tô lại khi camera đã dừng EDL_SETTLE_SECONDS (không chụp depth mỗi khung hình)
+    edl = global_edl
+    if edl is None:
+        return False
+    extrinsic = np.asarray(vis.get_view_control().convert_to_pinhole_camera_parameters().extrinsic)
+    now = time.time()
+    if edl["extrinsic"] is None or np.max(np.abs(extrinsic - edl["extrinsic"])) > LOD_MOTION_EPSILON:
+        edl["extrinsic"] = extrinsic
+        edl["last_move_time"] = now
+        edl["dirty"] = True
+        return False
+    if not edl["dirty"] or now - edl["last_move_time"] < EDL_SETTLE_SECONDS:
+        return False
+    edl["dirty"] = False
+    shade_display_edl(vis)
+    vis.update_geometry(global_pcd_display)
+    return True
+
+
+def _scan_tile_bounds(filepath, stream_chunk=TILED_STREAM_CHUNK):
+    if filepath.lower().endswith(".pcc"):
+        header = open_compact_cloud(filepath)["header"] # Bounding box có sẵn trong header
+        return {"file": os.path.basename(filepath), "num_points": header["num_points"],
+                "bbox_min": header["bbox_min"], "bbox_max": header["bbox_max"]}
+    mapping = memmap_binary_ply(filepath)
+    if mapping is not None:
+        points = mapping["points"]
     else:
-        print("Không có màu cơ bản hợp lệ, tạo màu xám dựa trên cường độ shading.")
-        new_colors = np.tile(shaded_intensities[:, np.newaxis], (1, 3))
+        points = np.asarray(o3d.io.read_point_cloud(filepath).points)
+    bbox_min = np.full(3, np.inf)
+    bbox_max = np.full(3, -np.inf)
+    for start in range(0, len(points), stream_chunk):
+        chunk = np.asarray(points[start:start + stream_chunk], dtype=np.float64)
+        bbox_min = np.minimum(bbox_min, chunk.min(axis=0))
+        bbox_max = np.maximum(bbox_max, chunk.max(axis=0))
+    return {"file": os.path.basename(filepath), "num_points": int(len(points)),
+            "bbox_min": bbox_min.tolist(), "bbox_max": bbox_max.tolist()}
 
-    pcd_target.colors = o3d.utility.Vector3dVector(np.clip(new_colors, 0, 1))
-    
-    _end_shading_time = time.time()
-    print(f"Đã áp dụng shading (trong {_end_shading_time - _start_shading_time:.2f}s).")
-    return pcd_target
+def build_tile_manifest(directory):
+    # Cùng định dạng manifest.json với preprocess_tiled_normals: dùng lại nếu khớp danh sách file và mới hơn chúng
+    manifest_path = os.path.join(directory, "manifest.json")
+    files = sorted(name for name in os.listdir(directory) if name.lower().endswith((".ply", ".pcc")))
+    if not files:
+        print(f"Lỗi: Không có file .ply/.pcc nào trong '{directory}'.")
+        return None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        manifest_mtime = os.path.getmtime(manifest_path)
+        if (sorted(t["file"] for t in manifest.get("tiles", [])) == files
+                and all(os.path.getmtime(os.path.join(directory, name)) <= manifest_mtime for name in files)):
+            print(f"Đã đọc manifest: {len(files)} tile, {manifest['num_points']} điểm.")
+            return manifest
+    print(f"Đang lập manifest cho {len(files)} tile trong '{directory}'...")
+    with profiling.stage("build_tile_manifest", tiles=len(files)) as manifest_stage:
+        # Giữ cả tile rỗng (num_points 0): bỏ đi thì danh sách không bao giờ khớp files và manifest bị lập lại mỗi lần
+        tiles = [_scan_tile_bounds(os.path.join(directory, name)) for name in files]
+        manifest = {"source": os.path.abspath(directory), "num_points": int(sum(t["num_points"] for t in tiles)),
+                    "tiles": tiles}
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+    print(f"Đã ghi manifest: {len(tiles)} tile, {manifest['num_points']} điểm (trong {manifest_stage.elapsed:.2f}s).")
+    return manifest
+
+def open_tile_dataset(directory, memory_budget_mb=DATASET_MEMORY_BUDGET_MB, roi=None):
+    manifest = build_tile_manifest(directory)
+    if manifest is None or manifest["num_points"] == 0:
+        return None
+    tiles = manifest["tiles"]
+    tile_min = np.array([t["bbox_min"] for t in tiles], dtype=np.float64)
+    tile_max = np.array([t["bbox_max"] for t in tiles], dtype=np.float64)
+    num_points = np.array([t["num_points"] for t in tiles], dtype=np.int64)
+    non_empty = num_points > 0
+    bounds_min, bounds_max = tile_min[non_empty].min(axis=0), tile_max[non_empty].max(axis=0)
+    tile_min[~non_empty] = tile_max[~non_empty] = bounds_min # Tile rỗng có bbox ±inf: hộp suy biến, tránh NaN khi lọc
+    viewpoint = (ORIENTATION_VIEWPOINT if ORIENTATION_VIEWPOINT is not None else
+                 _default_view_position_from_bounds(bounds_min, bounds_max))
+    return {
+        "directory": directory,
+        "manifest": manifest,
+        "tile_min": tile_min,
+        "tile_max": tile_max,
+        "num_points": num_points,
+        "viewpoint": np.asarray(viewpoint, dtype=np.float64), # Định hướng pháp tuyến chung cho mọi tile
+        "roi": None if roi is None else (np.asarray(roi[:3], dtype=np.float64), np.asarray(roi[3:], dtype=np.float64)),
+        "resident": OrderedDict(), # Chỉ số tile -> bản ghi đã nạp, thứ tự LRU (ít dùng nhất đứng đầu)
+        "failed": set(),
+        "memory_bytes": 0,
+        "budget_bytes": int(memory_budget_mb * 1024 ** 2),
+        "bytes_per_point": 128.0,  # Ước lượng trước khi nạp tile nào (điểm/pháp tuyến/màu + buffer shading)
+        "wanted": [],              # Tile cần cho khung nhìn hiện tại, gần camera trước
+        "shade_params": None,      # (chỉ số màu, specular, view_pos, mặt trời) cho tile nạp mới
+        "version": 0,              # Tăng mỗi khi tập tile trong bộ nhớ thay đổi
+        "merged_key": None,        # (version, shade_params) của lần ghép gần nhất
+        "merged_time": 0.0,
+        "merged": None,            # Cloud đã ghép trên luồng nạp, chờ animation callback đưa lên màn hình
+        "merged_layout": None,     # Chỉ số các tile trong cloud ghép gần nhất
+        "last_extrinsic": None,
+        "condition": threading.Condition(),
+        "stopped": False,
+        "thread": None,
+    }
+
+def select_tiles(dataset, camera=None, view_pos=None):
+    # Tile giao với ROI và (nếu có camera) với frustum đã nới, gần trước; cắt theo ngân sách bộ nhớ
+    tile_min, tile_max = dataset["tile_min"], dataset["tile_max"]
+    selected = dataset["num_points"] > 0 # Tile rỗng vẫn nằm trong manifest (để manifest khớp thư mục) nhưng không nạp
+    if dataset["roi"] is not None:
+        roi_min, roi_max = dataset["roi"]
+        selected &= np.all((tile_max >= roi_min) & (tile_min <= roi_max), axis=1)
+    if camera is not None:
+        pad = (tile_max - tile_min) * DATASET_VIEW_MARGIN
+        selected &= cells_in_frustum(tile_min - pad, tile_max + pad, camera)
+        view_pos = np.linalg.inv(camera["extrinsic"])[:3, 3]
+    indices = np.flatnonzero(selected)
+    if len(indices) == 0:
+        return []
+    if view_pos is not None:
+        centers = (tile_min[indices] + tile_max[indices]) / 2.0
+        indices = indices[np.argsort(np.linalg.norm(centers - view_pos, axis=1), kind="stable")]
+    costs = np.cumsum(dataset["num_points"][indices] * dataset["bytes_per_point"])
+    return indices[:max(1, int(np.searchsorted(costs, dataset["budget_bytes"], side="right")))].tolist()
+
+def _tile_base_color(tile, color_index):
+    color_name, color_rgb_data = BASE_COLORS_LIST[color_index]
+    if color_name == "Original" and tile["original_colors"] is not None:
+        return tile["original_colors"]
+    return color_rgb_data if color_rgb_data is not None else BASE_COLORS_LIST[0][1]
+
+def shade_tile(tile, shade_params):
+    color_index, specular_on, view_pos, _ = shade_params # Phần tử cuối (hướng mặt trời) chỉ để so khớp
+    base_color = _tile_base_color(tile, color_index)
+    if APPLY_ENHANCED_SHADING and SHADING_MODE == "sun":
+        apply_enhanced_sun_shading(tile["pcd"], base_color_rgb_array=base_color,
+                                   sun_dir=SUN_DIRECTION, view_pos=np.asarray(view_pos),
+                                   ambient_s=AMBIENT_STRENGTH, diffuse_s=DIFFUSE_STRENGTH,
+                                   specular_s=SPECULAR_STRENGTH, shininess=SHININESS_FACTOR,
+                                   use_specular_flag=specular_on, shading_state=tile["shading_state"],
+                                   ambient_occlusion=tile["ambient_occlusion"])
+    elif base_color.ndim == 2:
+        upload_colors(tile["pcd"], base_color)
+    else:
+        tile["pcd"].paint_uniform_color(base_color) # EDL được tô trên cloud đã ghép
+    tile["shade_params"] = shade_params
+
+def _tile_memory_bytes(tile):
+    # Trả về (bộ nhớ của tile, phần của tile trong cloud hiển thị đã ghép). Cloud ghép là bản sao thứ hai của
+    # điểm/pháp tuyến/màu/màu gốc mọi tile trong bộ nhớ nên được tính vào ngân sách cùng tile.
+    pcd = tile["pcd"]
+    cloud_arrays = [np.asarray(pcd.points), np.asarray(pcd.normals), np.asarray(pcd.colors)]
+    if tile["original_colors"] is not None:
+        cloud_arrays.append(tile["original_colors"])
+    state_arrays = [v for v in tile["shading_state"].values() if isinstance(v, np.ndarray)] # Gồm cả AO của tile
+    display_bytes = sum(a.nbytes for a in cloud_arrays)
+    return display_bytes + sum(a.nbytes for a in state_arrays), display_bytes
+
+def load_tile(dataset, index, shade_params):
+    # Mỗi tile đi qua đúng pipeline của một file đơn: đọc (kèm cache pháp tuyến), tiền xử lý, shading
+    tile_info = dataset["manifest"]["tiles"][index]
+    with profiling.stage("load_tile", points=tile_info["num_points"]) as tile_stage:
+        tile_path = os.path.join(dataset["directory"], tile_info["file"])
+        # Định hướng MST/trọng tâm cho dấu khác nhau giữa các tile: dùng viewpoint như preprocess_tiled_normals,
+        # một viewpoint chung cho cả dataset (viewpoint theo bbox từng tile làm dấu lật ở đường nối tile)
+        viewpoint = dataset["viewpoint"]
+        pcd, original_colors, cache_key = read_point_cloud(tile_path, orient_mode="viewpoint", viewpoint=viewpoint)
+        if pcd is None:
+            return None
+        pcd = preprocess_point_cloud_for_shading(pcd, NORMAL_ESTIMATION_RADIUS_FACTOR, NORMAL_ESTIMATION_MAX_NN,
+                                                 ORIENT_NORMALS_K, orient_mode="viewpoint", point_budget=None,
+                                                 estimate_normals=SHADING_MODE == "sun", normal_cache_key=cache_key,
+                                                 orient_viewpoint=viewpoint)
+        ambient_occlusion = None
+        if AMBIENT_OCCLUSION and SHADING_MODE == "sun":
+            # AO trong từng tile: điểm sát biên thiếu lân cận của tile kề nên hơi sáng hơn
+            ambient_occlusion = load_or_compute_ambient_occlusion(
+                pcd, compute_normal_cache_key(tile_path, orient_mode="viewpoint", viewpoint=viewpoint)
+                if NORMAL_CACHE_ENABLED else None)
+        tile = {"pcd": pcd, "original_colors": original_colors, "shading_state": {}, "shade_params": None,
+                "ambient_occlusion": ambient_occlusion}
+        shade_tile(tile, shade_params)
+        tile_bytes, tile["display_bytes"] = _tile_memory_bytes(tile)
+        tile["bytes"] = tile_bytes + tile["display_bytes"] # Ngân sách tính cả phần trong cloud hiển thị
+    print(f"Đã nạp tile {tile_info['file']} ({len(pcd.points)} điểm, {tile['bytes'] / 1024 ** 2:.1f} MB, "
+          f"trong {tile_stage.elapsed:.2f}s).")
+    return tile
+
+def _insert_tile(dataset, index, tile):
+    # Gọi khi đang giữ dataset["condition"]. Đẩy tile LRU ra cho tới khi vừa ngân sách; tile đang cần được giữ
+    resident = dataset["resident"]
+    resident[index] = tile
+    dataset["memory_bytes"] += tile["bytes"]
+    wanted = set(dataset["wanted"])
+    wanted.add(index)
+    for old_index in list(resident):
+        if dataset["memory_bytes"] <= dataset["budget_bytes"]:
+            break
+        if old_index not in wanted:
+            dataset["memory_bytes"] -= resident.pop(old_index)["bytes"]
+            profiling.count("tiles_evicted")
+    dataset["bytes_per_point"] = dataset["memory_bytes"] / max(1, sum(len(t["pcd"].points) for t in resident.values()))
+    dataset["version"] += 1
+
+def load_tiles_now(dataset, indices, shade_params):
+    for index in indices:
+        if index not in dataset["resident"]:
+            tile = load_tile(dataset, index, shade_params)
+            with dataset["condition"]:
+                if tile is None:
+                    dataset["failed"].add(index)
+                else:
+                    _insert_tile(dataset, index, tile)
+
+def _next_missing_tile(dataset):
+    for index in dataset["wanted"]:
+        if index not in dataset["resident"] and index not in dataset["failed"]:
+            return index
+    return None
+
+def _tile_prefetch_loop(dataset):
+    # Luồng nạp tile cũng tô lại và ghép cloud hiển thị (không chặn luồng UI). Ghép lại khi tập tile hoặc tham số
+    # shading đổi, cách nhau ít nhất DATASET_DISPLAY_INTERVAL để tile nạp liên tiếp không bị ghép sau mỗi tile.
+    condition = dataset["condition"]
+    while True:
+        with condition:
+            while not dataset["stopped"]:
+                merge_due = dataset["merged_key"] != (dataset["version"], dataset["shade_params"])
+                wait_seconds = DATASET_DISPLAY_INTERVAL - (time.time() - dataset["merged_time"])
+                index = _next_missing_tile(dataset)
+                if (merge_due and wait_seconds <= 0) or index is not None:
+                    break
+                condition.wait(wait_seconds if merge_due else None)
+            if dataset["stopped"]:
+                return
+            shade_params = dataset["shade_params"]
+        if merge_due and wait_seconds <= 0:
+            publish_merged_tiles(dataset)
+            continue
+        tile = load_tile(dataset, index, shade_params) # Đọc/tiền xử lý ngoài khóa: luồng chính không bị chặn
+        with condition:
+            if tile is None:
+                dataset["failed"].add(index)
+            else:
+                _insert_tile(dataset, index, tile)
+
+def start_tile_prefetch(dataset):
+    dataset["thread"] = threading.Thread(target=_tile_prefetch_loop, args=(dataset,), name="tile-prefetch", daemon=True)
+    dataset["thread"].start()
+
+def stop_tile_prefetch(dataset):
+    with dataset["condition"]:
+        dataset["stopped"] = True
+        dataset["condition"].notify_all()
+    if dataset["thread"] is not None:
+        dataset["thread"].join() # Tile đang nạp dở chạy nốt rồi luồng thoát
+
+def request_tiles(dataset, indices, shade_params=None):
+    with dataset["condition"]:
+        dataset["wanted"] = indices
+        if shade_params is not None:
+            dataset["shade_params"] = shade_params
+        for index in indices:
+            if index in dataset["resident"]:
+                dataset["resident"].move_to_end(index) # Tile trong khung nhìn là tile mới dùng nhất
+        dataset["condition"].notify()
+
+def merge_resident_tiles(dataset):
+    # Ghép mọi tile trong bộ nhớ (đã giới hạn theo ngân sách) thành một cloud; tile tô theo tham số cũ được tô lại.
+    # Tile xếp theo chỉ số (thứ tự LRU đổi không làm đổi cloud ghép). Tập tile không đổi (chỉ tô lại): chỉ ghép màu,
+    # điểm/pháp tuyến/màu gốc của lần ghép trước được giữ nguyên trên cloud hiển thị.
+    with dataset["condition"]:
+        resident = sorted(dataset["resident"].items(), key=lambda item: item[0])
+        shade_params = dataset["shade_params"]
+        dataset["merged_key"] = (dataset["version"], shade_params)
+    tiles = [tile for _, tile in resident]
+    for tile in tiles:
+        if tile["shade_params"] != shade_params:
+            shade_tile(tile, shade_params)
+    layout = tuple(index for index, _ in resident)
+    colors = np.concatenate([np.asarray(t["pcd"].colors) for t in tiles]) if tiles else np.empty((0, 3))
+    if layout == dataset["merged_layout"]:
+        return {"cloud": None, "colors": colors, "original_colors": None}
+    dataset["merged_layout"] = layout
+    merged = o3d.geometry.PointCloud()
+    original_colors = None
+    if tiles:
+        merged.points = o3d.utility.Vector3dVector(np.concatenate([np.asarray(t["pcd"].points) for t in tiles]))
+        if all(t["pcd"].has_normals() for t in tiles):
+            merged.normals = o3d.utility.Vector3dVector(np.concatenate([np.asarray(t["pcd"].normals) for t in tiles]))
+        merged.colors = o3d.utility.Vector3dVector(colors)
+        if all(t["original_colors"] is not None for t in tiles):
+            original_colors = np.concatenate([t["original_colors"] for t in tiles])
+    return {"cloud": merged, "colors": None, "original_colors": original_colors}
+
+def publish_merged_tiles(dataset):
+    # Chạy trên luồng nạp tile: tô lại + ghép, rồi công bố như worker["result"] của shading nền
+    with profiling.stage("merge_tiles") as merge_stage:
+        merged = merge_resident_tiles(dataset)
+    merged["seconds"] = merge_stage.elapsed
+    merged["tiles"] = len(dataset["merged_layout"])
+    with dataset["condition"]:
+        pending = dataset["merged"]
+        if merged["cloud"] is None and pending is not None and pending["cloud"] is not None:
+            # Cloud mới ghép chưa được đưa lên màn hình: chỉ thay màu của nó
+            pending["cloud"].colors = o3d.utility.Vector3dVector(merged["colors"])
+            merged = dict(pending, seconds=pending["seconds"] + merged["seconds"])
+        dataset["merged"] = merged
+        dataset["merged_time"] = time.time()
+
+def show_merged_tiles(dataset):
+    # Animation callback: chỉ đổi buffer của cloud hiển thị sang cloud đã ghép sẵn
+    global global_pcd_original_colors
+    with dataset["condition"]:
+        result, dataset["merged"] = dataset["merged"], None
+    if result is None:
+        return False
+    merged = result["cloud"]
+    if merged is None:
+        upload_colors(global_pcd_display, result["colors"]) # Cùng tập tile: ghi màu tại chỗ, giữ điểm/pháp tuyến
+    else:
+        global_pcd_original_colors = result["original_colors"]
+        global_pcd_display.points = merged.points
+        global_pcd_display.normals = merged.normals
+        global_pcd_display.colors = merged.colors
+    if global_edl is not None:
+        global_edl["dirty"] = True
+    print(f"Hiển thị {result['tiles']} tile, {len(global_pcd_display.points)} điểm, "
+          f"{dataset['memory_bytes'] / 1024 ** 2:.0f}/{dataset['budget_bytes'] / 1024 ** 2:.0f} MB "
+          f"(ghép trong {result['seconds']:.2f}s).")
+    return True
+
+def _dataset_shade_params(view_pos):
+    return (global_current_base_color_index, global_specular_on, tuple(np.asarray(view_pos, dtype=np.float64).tolist()),
+            tuple(np.asarray(SUN_DIRECTION, dtype=np.float64).tolist()))
+
+def dataset_animation_handler(vis):
+    # Camera di chuyển: chọn lại tile theo frustum cho luồng nạp trước; cloud ghép sẵn được đưa lên khi có
+    dataset = global_dataset
+    camera = _current_camera(vis)
+    last_extrinsic = dataset["last_extrinsic"]
+    if last_extrinsic is None or np.max(np.abs(camera["extrinsic"] - last_extrinsic)) > LOD_MOTION_EPSILON:
+        dataset["last_extrinsic"] = camera["extrinsic"]
+        request_tiles(dataset, select_tiles(dataset, camera))
+    if not show_merged_tiles(dataset):
+        return False
+    vis.update_geometry(global_pcd_display)
+    return True
+
+
+def camera_intrinsics(width, height, fov_deg):
+    fov_rad = np.deg2rad(fov_deg)
+    fy = height / (2 * np.tan(fov_rad / 2.0))
+    fx = fy
+    cx = width / 2.0
+    cy = height / 2.0
+    return fx, fy, cx, cy
+
+def look_at_extrinsic(eye, target, up):
+    # Extrinsic world->camera theo quy ước Open3D: trục z nhìn tới, y hướng xuống
+    eye = np.asarray(eye, dtype=np.float64)
+    forward = np.asarray(target, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    if np.linalg.norm(right) < 1e-9: # up song song hướng nhìn
+        right = np.cross(forward, [1.0, 0.0, 0.0])
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    extrinsic = np.eye(4)
+    extrinsic[:3, :3] = np.stack([right, down, forward])
+    extrinsic[:3, 3] = -extrinsic[:3, :3] @ eye
+    return extrinsic
+
+def project_points(points, extrinsic, intrinsics):
+    fx, fy, cx, cy = intrinsics
+    cam = points @ extrinsic[:3, :3].T + extrinsic[:3, 3]
+    z = cam[:, 2]
+    in_front = z > 1e-6
+    z_safe = np.where(in_front, z, 1.0)
+    u = np.floor(fx * cam[:, 0] / z_safe + cx).astype(np.int64)
+    v = np.floor(fy * cam[:, 1] / z_safe + cy).astype(np.int64)
+    return u, v, z, in_front
+
+def rasterize_points(points, colors, extrinsic, width, height, intrinsics,
+                     point_size=1, background=DARK_BG_COLOR, chunk_points=RASTER_CHUNK_POINTS):
+    # Z-buffer vector hóa: lượt 1 scatter-min độ sâu theo chỉ số pixel, lượt 2 ghi màu của điểm thắng
+    print(f"Đang rasterize {len(points)} điểm ({width}x{height}, kích thước điểm {point_size})...")
+    with profiling.stage("rasterize_points", points=len(points)) as raster_stage:
+        size = max(1, int(round(point_size)))
+        offsets = [(dx - size // 2, dy - size // 2) for dy in range(size) for dx in range(size)]
+        depth = np.full(width * height, np.inf)
+        image = np.empty((width * height, 3), dtype=np.float32)
+        image[:] = background
+        for pass_index in range(2):
+            for start in range(0, len(points), chunk_points):
+                u, v, z, in_front = project_points(points[start:start + chunk_points], extrinsic, intrinsics)
+                for du, dv in offsets:
+                    us, vs = u + du, v + dv
+                    visible = np.flatnonzero(in_front & (us >= 0) & (us < width) & (vs >= 0) & (vs < height))
+                    pixel = vs[visible] * width + us[visible]
+                    if pass_index == 0:
+                        np.minimum.at(depth, pixel, z[visible])
+                    else:
+                        winner = z[visible] <= depth[pixel]
+                        image[pixel[winner]] = colors[start + visible[winner]]
+    print(f"Đã rasterize (trong {raster_stage.elapsed:.2f}s).")
+    return image.reshape(height, width, 3), depth.reshape(height, width)
+
+def _edl_neighbor_offsets(radius):
+    return [(dy * radius, dx * radius) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+
+def eye_dome_lighting(depth, strength=EDL_STRENGTH, radius=EDL_RADIUS):
+    # Eye-Dome Lighting: điểm sâu hơn các lân cận trên màn hình (log2 độ sâu) bị tối đi. depth: (h, w),
+    # nền là inf hoặc 0. Trả về hệ số sáng (h, w) float32 trong (0, 1], nền = 1.
+    valid = np.isfinite(depth) & (depth > 0)
+    log_depth = np.zeros(depth.shape, dtype=np.float32)
+    np.log2(depth, out=log_depth, where=valid)
+    # Lân cận là nền được coi như ở vô cực: không che điểm đang xét
+    padded = np.pad(np.where(valid, log_depth, np.inf).astype(np.float32), radius, constant_values=np.inf)
+    height, width = depth.shape
+    obscurance = np.zeros(depth.shape, dtype=np.float32)
+    difference = np.empty(depth.shape, dtype=np.float32)
+    offsets = _edl_neighbor_offsets(radius)
+    for dy, dx in offsets:
+        neighbor = padded[radius + dy:radius + dy + height, radius + dx:radius + dx + width]
+        np.subtract(log_depth, neighbor, out=difference)
+        np.maximum(difference, 0, out=difference)
+        obscurance += difference
+    shade = np.exp(-strength * obscurance / len(offsets)).astype(np.float32)
+    shade[~valid] = 1.0
+    return shade
+
+def edl_point_factors(points, depth, camera, chunk_points=RASTER_CHUNK_POINTS):
+    # Cửa sổ Open3D không có hậu xử lý màn hình: tra hệ số EDL tại pixel chiếu của từng điểm
+    shade = eye_dome_lighting(depth)
+    height, width = shade.shape
+    intrinsic = camera["intrinsic"]
+    intrinsics = (intrinsic[0, 0], intrinsic[1, 1], intrinsic[0, 2], intrinsic[1, 2])
+    factors = np.ones(len(points), dtype=np.float32)
+    for start in range(0, len(points), chunk_points):
+        u, v, _, in_front = project_points(points[start:start + chunk_points], camera["extrinsic"], intrinsics)
+        inside = np.flatnonzero(in_front & (u >= 0) & (u < width) & (v >= 0) & (v < height))
+        factors[start + inside] = shade[v[inside], u[inside]]
+    return factors
+
+def write_png(filepath, image):
+    # Ghi PNG RGB 8 bit bằng zlib, không cần thư viện ảnh ngoài
+    if image.dtype != np.uint8:
+        image = np.round(np.clip(image, 0, 1) * 255).astype(np.uint8)
+    height, width, _ = image.shape
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8) # Byte đầu mỗi dòng: filter 0
+    raw[:, 1:] = image.reshape(height, width * 3)
+
+    def png_chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(filepath, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(png_chunk(b"IEND", b""))
+
+def headless_camera_views(pcd, orbit_views):
+    bbox = pcd.get_axis_aligned_bounding_box()
+    center = bbox.get_center()
+    if orbit_views <= 1:
+        eye = estimate_default_view_position(pcd)
+        return [(eye, look_at_extrinsic(eye, center, [0.0, 1.0, 0.0]))]
+    distance = max(np.max(bbox.get_extent()), 1e-6) * 2.5
+    elevation = np.deg2rad(HEADLESS_ORBIT_ELEVATION_DEG)
+    views = []
+    for i in range(orbit_views):
+        azimuth = 2 * np.pi * i / orbit_views
+        eye = center + distance * np.array([np.cos(azimuth) * np.cos(elevation),
+                                            np.sin(azimuth) * np.cos(elevation),
+                                            np.sin(elevation)])
+        views.append((eye, look_at_extrinsic(eye, center, [0.0, 0.0, 1.0])))
+    return views
+
+def render_headless(pcd, output_path, width, height, orbit_views=1):
+    print("\n[Bước Kết Xuất Không Cửa Sổ]")
+    intrinsics = camera_intrinsics(width, height, CAMERA_FIELD_OF_VIEW_DEG)
+    background = DARK_BG_COLOR if INITIAL_BACKGROUND_IS_DARK else LIGHT_BG_COLOR
+    points = np.asarray(pcd.points)
+    views = headless_camera_views(pcd, orbit_views)
+    root, ext = os.path.splitext(output_path)
+    output_paths = []
+    for i, (eye, extrinsic) in enumerate(views):
+        if APPLY_ENHANCED_SHADING and SHADING_MODE == "edl":
+            # EDL: rasterize màu cơ bản, rồi làm tối theo độ sâu của chính ảnh này
+            base_color = _resolve_base_color()
+            colors = base_color if base_color.ndim == 2 else np.broadcast_to(base_color, (len(points), 3))
+            image, depth = rasterize_points(points, colors, extrinsic, width, height, intrinsics,
+                                            point_size=INITIAL_POINT_SIZE, background=background)
+            with profiling.stage("eye_dome_lighting"):
+                image *= eye_dome_lighting(depth)[:, :, np.newaxis]
+        else:
+            if APPLY_ENHANCED_SHADING:
+                # Specular phụ thuộc góc nhìn: shading state giữ phần còn lại giữa các góc nhìn
+                apply_enhanced_sun_shading(pcd, base_color_rgb_array=_resolve_base_color(),
+                                           sun_dir=SUN_DIRECTION, view_pos=eye,
+                                           ambient_s=AMBIENT_STRENGTH, diffuse_s=DIFFUSE_STRENGTH,
+                                           specular_s=SPECULAR_STRENGTH, shininess=SHININESS_FACTOR,
+                                           use_specular_flag=global_specular_on,
+                                           shading_state=global_shading_state,
+                                           ambient_occlusion=global_ambient_occlusion)
+            image, _ = rasterize_points(points, np.asarray(pcd.colors), extrinsic, width, height, intrinsics,
+                                        point_size=INITIAL_POINT_SIZE, background=background)
+        path = output_path if len(views) == 1 else f"{root}_{i:03d}{ext or '.png'}"
+        write_png(path, image)
+        output_paths.append(path)
+        print(f"  Đã ghi ảnh: {path}")
+    return output_paths
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Point Cloud Renderer với Open3D")
+    parser.add_argument("--input", default=POINT_CLOUD_FILE_PATH,
+                        help="Đường dẫn file point cloud, hoặc thư mục các tile PLY (chế độ bộ dữ liệu)")
+    parser.add_argument("--save-compact", metavar="PATH",
+                        help="Ghi cloud đã tiền xử lý ra file nén .pcc (mở lại nhanh bằng --input PATH)")
+    parser.add_argument("--tiled-preprocess", action="store_true", default=RUN_TILED_PREPROCESS,
+                        help="Ước lượng pháp tuyến theo khối (out-of-core) cho PLY nhị phân không vừa bộ nhớ, "
+                             "ghi các tile PLY + manifest.json rồi thoát")
+    parser.add_argument("--tiled-output", default=TILED_OUTPUT_DIR,
+                        help="Thư mục ghi tile (chế độ --tiled-preprocess); mở lại bằng --input THƯ_MỤC")
+    parser.add_argument("--tile-points", type=int, default=TILED_BLOCK_POINTS,
+                        help="Số điểm mục tiêu mỗi khối, chưa tính halo (chế độ --tiled-preprocess)")
+    parser.add_argument("--memory-budget", type=float, default=DATASET_MEMORY_BUDGET_MB,
+                        help="Giới hạn bộ nhớ (MB) cho các tile đã nạp kèm cloud hiển thị ghép từ chúng (chế độ bộ dữ liệu)")
+    parser.add_argument("--roi", type=float, nargs=6, metavar=("XMIN", "YMIN", "ZMIN", "XMAX", "YMAX", "ZMAX"),
+                        help="Chỉ nạp các tile giao với hộp này (chế độ bộ dữ liệu)")
+    parser.add_argument("--headless", action="store_true", help="Kết xuất ra PNG bằng rasterizer NumPy, không mở cửa sổ")
+    parser.add_argument("--output", default=HEADLESS_OUTPUT_PATH, help="File PNG đầu ra (chế độ --headless)")
+    parser.add_argument("--width", type=int, default=WINDOW_WIDTH)
+    parser.add_argument("--height", type=int, default=WINDOW_HEIGHT)
+    parser.add_argument("--orbit", type=int, default=1, help="Số góc nhìn quanh cloud (ghi <output>_NNN.png)")
+    parser.add_argument("--shading", choices=["sun", "edl"], default=SHADING_MODE,
+                        help="sun: Lambert/specular theo pháp tuyến; edl: Eye-Dome Lighting, không cần pháp tuyến")
+    parser.add_argument("--shadows", action="store_true", default=SUN_SHADOWS,
+                        help="Bóng đổ của mặt trời qua shadow map trực giao (tính lại khi đổi hướng mặt trời)")
+    parser.add_argument("--ambient-occlusion", action="store_true", default=AMBIENT_OCCLUSION,
+                        help="Làm tối ambient ở khe/hốc theo lân cận KD-tree (tính một lần, lưu cache cạnh pháp tuyến)")
+    parser.add_argument("--lighting", choices=["direct", "sh"], default=LIGHTING_MODE,
+                        help="sh: lưu 9 hệ số SH mỗi điểm để đổi hướng mặt trời (phím mũi tên) gần như tức thì")
+    parser.add_argument("--adaptive-normals", action="store_true", default=ADAPTIVE_NORMAL_RADIUS,
+                        help="Bán kính pháp tuyến riêng từng điểm theo mật độ cục bộ (cloud mật độ không đều)")
+    parser.add_argument("--point-budget", type=int, default=DOWNSAMPLE_POINT_BUDGET,
+                        help="Giảm mẫu voxel xuống tối đa số điểm này trước khi ước lượng pháp tuyến")
+    parser.add_argument("--profile", action="store_true", default=PROFILING_ENABLED,
+                        help="Đo thời gian/bộ nhớ từng giai đoạn, in bảng tổng kết và ghi trace JSON")
+    parser.add_argument("--profile-trace", default=PROFILING_TRACE_PATH, help="File trace JSON (chế độ --profile)")
+    return parser.parse_args()
+
+def _memory_report_entries():
+    # (tên, mảng) của mọi dữ liệu theo số điểm mà phiên đang giữ
+    entries = []
+    clouds = [("display", global_pcd_display)]
+    if global_pcd_full is not None and global_pcd_full is not global_pcd_display:
+        clouds.append(("full", global_pcd_full))
+    for name, pcd in clouds:
+        if pcd is None:
+            continue
+        for field in ("points", "normals", "colors"):
+            entries.append((f"{name}.{field}", np.asarray(getattr(pcd, field)))) # View, không sao chép
+    entries += [("original_colors", global_pcd_original_colors), ("ambient_occlusion", global_ambient_occlusion)]
+    states = [("shading", global_shading_state)]
+    if global_lod is not None:
+        states += [(f"shading[lod {level}]", state) for level, state in global_lod["states"].items()]
+        entries += [(f"lod.levels[{i}]", indices) for i, indices in enumerate(global_lod["levels"])]
+        for level, arrays in global_lod["level_arrays"].items():
+            entries += [(f"lod.points[{level}]", arrays[0]), (f"lod.normals[{level}]", arrays[1])]
+        entries += [(f"lod.ambient_occlusion[{level}]", a) for level, a in global_lod["level_ambient_occlusion"].items()]
+    for name, state in states:
+        for key, value in state.items():
+            if key == "work":
+                entries += [(f"{name}.work[{i}].{buffer_name}", buffer)
+                            for i, work in enumerate(value) for buffer_name, buffer in work.items()]
+            elif isinstance(value, np.ndarray):
+                entries.append((f"{name}.{key}", value))
+    for level, cull_index in global_cull_indices.items():
+        entries += [(f"cull[{level}].{key}", value) for key, value in cull_index.items()]
+    return [(name, array) for name, array in entries if isinstance(array, np.ndarray) and array.nbytes > 0]
+
+def _array_memory_address(array):
+    # Địa chỉ buffer gốc: view NumPy và các lần np.asarray trên cùng Vector3dVector cho cùng giá trị
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array.__array_interface__["data"][0]
+
+def report_memory():
+    if not MEMORY_REPORT_ENABLED:
+        return
+    print("\n[Bộ Nhớ Theo Mảng]")
+    print(f"  {'Mảng':<34}{'Kiểu':>9}{'Hình dạng':>18}{'MB':>10}")
+    seen = {}
+    total = 0
+    for name, array in sorted(_memory_report_entries(), key=lambda entry: -entry[1].nbytes):
+        # Mảng dùng chung buffer với mảng đã liệt kê (view, cloud chung) chỉ tính một lần
+        address = _array_memory_address(array)
+        owner = seen.get(address)
+        if owner is None:
+            seen[address] = name
+            total += array.nbytes
+        print(f"  {name:<34}{str(array.dtype):>9}{str(array.shape):>18}{array.nbytes / 1024 ** 2:>10.1f}"
+              f"{'' if owner is None else f'  (chung với {owner})'}")
+    if global_dataset is not None:
+        # Phần cloud hiển thị của tile đã được liệt kê ở display.*: chỉ cộng bộ nhớ riêng của tile
+        with global_dataset["condition"]:
+            tiles = list(global_dataset["resident"].values())
+        tile_bytes = sum(tile["bytes"] - tile["display_bytes"] for tile in tiles)
+        print(f"  {'tile (cloud + shading state)':<34}{'':>9}{len(tiles):>18}{tile_bytes / 1024 ** 2:>10.1f}")
+        total += tile_bytes
+    rss = profiling.rss_mb()
+    print(f"  Tổng: {total / 1024 ** 2:.1f} MB" + ("" if rss is None else f", RSS tiến trình: {rss:.1f} MB"))
+
+def report_profiling(trace_path):
+    if not profiling.is_enabled():
+        return
+    print("\n[Tổng Kết Profiling]")
+    print(profiling.format_summary())
+    profiling.export_chrome_trace(trace_path)
+    print(f"Đã ghi trace: {trace_path} (mở bằng chrome://tracing hoặc ui.perfetto.dev)")
 
 
 # --- CALLBACKS CHO VISUALIZER ---
@@ -205,29 +2835,28 @@ def toggle_background_color_cb(vis):
 def _refresh_shading(vis):
     # ... (Giữ nguyên) ...
     global global_pcd_display, global_specular_on, global_current_base_color_index, global_pcd_original_colors
+    if global_dataset is not None:
+        # Mỗi tile giữ shading state riêng: luồng nạp tile tô lại từng tile rồi ghép; tile nạp sau dùng tham số mới
+        request_tiles(global_dataset, global_dataset["wanted"], _dataset_shade_params(_current_view_position(vis)))
+        print("  Callback: Đã gửi yêu cầu tô lại các tile cho luồng nạp tile.")
+        return
+    if SHADING_MODE == "edl":
+        _paint_display_base_color()
+        global_edl["dirty"] = True
+        global_edl["last_move_time"] = 0.0 # Tô lại ngay ở khung hình kế tiếp
+        print("  Callback: Sẽ tô lại EDL ở khung hình kế tiếp.")
+        return
+    if global_shading_worker is not None:
+        request_background_shading(_current_view_position(vis), camera=_current_camera(vis))
+        print("  Callback: Đã gửi yêu cầu làm mới shading cho luồng nền.")
+        return
     print("  Callback: Đang làm mới shading...")
-    _start_refresh_time = time.time()
-    color_name, color_rgb_data = BASE_COLORS_LIST[global_current_base_color_index]
-    base_color_to_use = None
-    if color_name == "Original" and global_pcd_original_colors is not None:
-        base_color_to_use = global_pcd_original_colors
-    else:
-        base_color_to_use = color_rgb_data if color_rgb_data is not None else BASE_COLORS_LIST[0][1]
-    view_control = vis.get_view_control()
-    cam_params = view_control.convert_to_pinhole_camera_parameters()
-    ext_inv = np.linalg.inv(cam_params.extrinsic)
-    view_pos_current = ext_inv[:3, 3]
-    apply_enhanced_sun_shading(global_pcd_display,
-                               base_color_rgb_array=base_color_to_use,
-                               sun_dir=SUN_DIRECTION, view_pos=view_pos_current,
-                               ambient_s=AMBIENT_STRENGTH, diffuse_s=DIFFUSE_STRENGTH,
-                               specular_s=SPECULAR_STRENGTH, shininess=SHININESS_FACTOR,
-                               use_specular_flag=global_specular_on)
-    vis.update_geometry(global_pcd_display)
-    vis.poll_events() # Cần thiết để các thay đổi được áp dụng trước khi update_renderer
-    vis.update_renderer()
-    _end_refresh_time = time.time()
-    print(f"  Callback: Hoàn thành làm mới shading (trong {_end_refresh_time - _start_refresh_time:.2f}s).")
+    with profiling.stage("refresh_shading") as refresh_stage:
+        shade_display(_current_view_position(vis))
+        vis.update_geometry(global_pcd_display)
+        vis.poll_events() # Cần thiết để các thay đổi được áp dụng trước khi update_renderer
+        vis.update_renderer()
+    print(f"  Callback: Hoàn thành làm mới shading (trong {refresh_stage.elapsed:.2f}s).")
 
 
 def cycle_base_color_cb(vis):
@@ -237,89 +2866,157 @@ def cycle_base_color_cb(vis):
     global_current_base_color_index = (global_current_base_color_index + 1) % len(BASE_COLORS_LIST)
     color_name, _ = BASE_COLORS_LIST[global_current_base_color_index]
     print(f"Đổi màu cơ bản sang: {color_name}")
-    if APPLY_ENHANCED_SHADING:
+    if APPLY_ENHANCED_SHADING or global_dataset is not None:
         _refresh_shading(vis)
     else:
-        _start_color_change_time = time.time()
-        color_name_new, color_rgb_data_new = BASE_COLORS_LIST[global_current_base_color_index]
-        if color_name_new == "Original" and global_pcd_original_colors is not None:
-            global_pcd_display.colors = o3d.utility.Vector3dVector(global_pcd_original_colors)
-        elif color_rgb_data_new is not None:
-            global_pcd_display.paint_uniform_color(color_rgb_data_new)
-        else:
-             global_pcd_display.paint_uniform_color(BASE_COLORS_LIST[0][1])
-        vis.update_geometry(global_pcd_display)
-        vis.poll_events()
-        vis.update_renderer()
-        _end_color_change_time = time.time()
-        print(f"  Callback: Thay đổi màu cơ bản (không shading) hoàn thành (trong {_end_color_change_time - _start_color_change_time:.2f}s).")
+        with profiling.stage("change_base_color") as color_stage:
+            _paint_display_base_color()
+            vis.update_geometry(global_pcd_display)
+            vis.poll_events()
+            vis.update_renderer()
+        print(f"  Callback: Thay đổi màu cơ bản (không shading) hoàn thành (trong {color_stage.elapsed:.2f}s).")
     return False
 
 def toggle_specular_cb(vis):
     # ... (Giữ nguyên, _refresh_shading đã có timing) ...
     global global_specular_on, global_pcd_display
-    if global_pcd_display is None or not APPLY_ENHANCED_SHADING:
-        print("Specular toggle chỉ hoạt động khi APPLY_ENHANCED_SHADING là True.")
+    if global_pcd_display is None or not APPLY_ENHANCED_SHADING or SHADING_MODE != "sun":
+        print("Specular toggle chỉ hoạt động khi APPLY_ENHANCED_SHADING là True và SHADING_MODE là 'sun'.")
         return False
     global_specular_on = not global_specular_on
     print(f"Specular shading {'BẬT' if global_specular_on else 'TẮT'}.")
     _refresh_shading(vis)
     return False
 
+def rotate_sun(azimuth_step_deg, elevation_step_deg):
+    # Xoay vị trí mặt trời (ngược hướng chiếu) quanh trục Z; độ cao giữ trong (-90°, 90°)
+    global SUN_DIRECTION
+    position = -np.asarray(SUN_DIRECTION, dtype=np.float64)
+    position /= np.linalg.norm(position)
+    azimuth = np.degrees(np.arctan2(position[1], position[0])) + azimuth_step_deg
+    elevation = np.clip(np.degrees(np.arcsin(np.clip(position[2], -1.0, 1.0))) + elevation_step_deg, -89.0, 89.0)
+    az, el = np.radians(azimuth), np.radians(elevation)
+    SUN_DIRECTION = -np.array([np.cos(el) * np.cos(az), np.cos(el) * np.sin(az), np.sin(el)])
+    return (azimuth + 180.0) % 360.0 - 180.0, elevation
+
+def rotate_sun_cb(vis, azimuth_step_deg, elevation_step_deg):
+    if global_pcd_display is None or not APPLY_ENHANCED_SHADING or SHADING_MODE != "sun":
+        print("Xoay mặt trời chỉ hoạt động khi APPLY_ENHANCED_SHADING là True và SHADING_MODE là 'sun'.")
+        return False
+    azimuth, elevation = rotate_sun(azimuth_step_deg, elevation_step_deg)
+    print(f"Mặt trời: phương vị {azimuth:.0f}°, độ cao {elevation:.0f}° "
+          f"({'SH, chỉ tính lại lambert' if LIGHTING_MODE == 'sh' else 'direct, dựng lại shading state'}).")
+    _refresh_shading(vis)
+    return False
+
 # --- CHƯƠNG TRÌNH CHÍNH ---
 if __name__ == "__main__":
+    args = parse_command_line()
+    if args.profile:
+        profiling.enable(trace_memory=PROFILING_TRACE_MEMORY)
+    DOWNSAMPLE_POINT_BUDGET = args.point_budget # Khóa cache pháp tuyến phụ thuộc giá trị này
+    SHADING_MODE = args.shading
+    LIGHTING_MODE = args.lighting
+    AMBIENT_OCCLUSION = args.ambient_occlusion
+    SUN_SHADOWS = args.shadows
+    ADAPTIVE_NORMAL_RADIUS = args.adaptive_normals
+    RUN_TILED_PREPROCESS = args.tiled_preprocess
+    TILED_OUTPUT_DIR = args.tiled_output
+    TILED_BLOCK_POINTS = args.tile_points
     overall_start_time = time.time()
     print("--- Point Cloud Renderer with Timing & Customization ---")
 
-    pcd_original_loaded = load_point_cloud(POINT_CLOUD_FILE_PATH)
-    if pcd_original_loaded is None:
+    if RUN_TILED_PREPROCESS:
+        preprocess_tiled_normals(args.input, TILED_OUTPUT_DIR,
+                                 radius_factor=NORMAL_ESTIMATION_RADIUS_FACTOR,
+                                 max_nn=NORMAL_ESTIMATION_MAX_NN, block_points=TILED_BLOCK_POINTS)
+        report_profiling(args.profile_trace)
         exit()
 
-    # Tạo bản sao để xử lý
-    pcd_processed = o3d.geometry.PointCloud(pcd_original_loaded)
-    pcd_processed = preprocess_point_cloud_for_shading(pcd_processed,
-                                                       radius_factor=NORMAL_ESTIMATION_RADIUS_FACTOR,
-                                                       max_nn=NORMAL_ESTIMATION_MAX_NN,
-                                                       orient_k=ORIENT_NORMALS_K)
+    if os.path.isdir(args.input):
+        print("\n[Bước Mở Bộ Dữ Liệu Nhiều Tile]")
+        global_dataset = open_tile_dataset(args.input, args.memory_budget, roi=args.roi)
+        if global_dataset is None:
+            exit()
+        roi_bounds = global_dataset["roi"] or (global_dataset["tile_min"].min(axis=0), global_dataset["tile_max"].max(axis=0))
+        initial_view_pos_est = _default_view_position_from_bounds(*roi_bounds)
+        # Các tile gần vị trí nhìn ban đầu (trong ROI) được nạp đồng bộ để cửa sổ mở với dữ liệu
+        initial_tiles = select_tiles(global_dataset, view_pos=initial_view_pos_est)
+        request_tiles(global_dataset, initial_tiles, _dataset_shade_params(initial_view_pos_est))
+        load_tiles_now(global_dataset, initial_tiles, global_dataset["shade_params"])
+        merged = merge_resident_tiles(global_dataset)
+        pcd_processed, global_pcd_original_colors = merged["cloud"], merged["original_colors"]
+        if not pcd_processed.has_points():
+            print("Lỗi: Không nạp được tile nào.")
+            exit()
+    else:
+        # Một bản cloud duy nhất: tiền xử lý sửa tại chỗ (giảm mẫu trả về cloud mới, bản gốc được giải phóng)
+        pcd_processed = load_point_cloud(args.input)
+        if pcd_processed is None:
+            exit()
+        pcd_processed = preprocess_point_cloud_for_shading(pcd_processed,
+                                                           radius_factor=NORMAL_ESTIMATION_RADIUS_FACTOR,
+                                                           max_nn=NORMAL_ESTIMATION_MAX_NN,
+                                                           orient_k=ORIENT_NORMALS_K,
+                                                           point_budget=DOWNSAMPLE_POINT_BUDGET,
+                                                           estimate_normals=not (APPLY_ENHANCED_SHADING and SHADING_MODE == "edl"),
+                                                           normal_cache_key=global_normal_cache_key)
+        if AMBIENT_OCCLUSION and APPLY_ENHANCED_SHADING and SHADING_MODE == "sun":
+            print("\n[Bước Tính Che Khuất Môi Trường (AO)]")
+            global_ambient_occlusion = load_or_compute_ambient_occlusion(
+                pcd_processed, compute_normal_cache_key(args.input) if NORMAL_CACHE_ENABLED else None)
+        if args.save_compact:
+            write_compact_cloud(args.save_compact, np.asarray(pcd_processed.points),
+                                np.asarray(pcd_processed.normals) if pcd_processed.has_normals() else None,
+                                global_pcd_original_colors)
+
+    if args.headless:
+        render_headless(pcd_processed, args.output, args.width, args.height, orbit_views=args.orbit)
+        global_pcd_display = pcd_processed # Để bảng bộ nhớ liệt kê cloud đã kết xuất
+        report_memory()
+        print(f"\n--- Kết thúc kết xuất không cửa sổ (Tổng thời gian chạy script: {time.time() - overall_start_time:.2f}s) ---")
+        report_profiling(args.profile_trace)
+        exit()
     
-    global_pcd_display = o3d.geometry.PointCloud(pcd_processed) # Gán cho biến toàn cục
+    if LOD_ENABLED and global_dataset is None and len(pcd_processed.points) > LOD_POINT_BUDGET:
+        global_pcd_full = pcd_processed
+        global_lod = build_lod_pyramid(np.asarray(pcd_processed.points), LOD_POINT_BUDGET)
+        register_animation_handler(lod_animation_handler)
+
+    if global_lod is not None:
+        # Đổi mức LOD thay points của cloud hiển thị nên nó phải là cloud riêng; màu chỉ tô trên cloud hiển thị,
+        # cloud đầy đủ không cần giữ buffer màu
+        global_pcd_display = o3d.geometry.PointCloud(pcd_processed)
+        global_pcd_full.colors = o3d.utility.Vector3dVector()
+    else:
+        global_pcd_display = pcd_processed # Dùng chung buffer, không sao chép
+    del pcd_processed
 
-    if APPLY_ENHANCED_SHADING:
+    if APPLY_ENHANCED_SHADING and SHADING_MODE == "edl":
+        _paint_display_base_color() # EDL cần depth của cửa sổ: tô ở khung hình đầu tiên
+        global_edl = {"extrinsic": None, "last_move_time": 0.0, "dirty": True}
+        register_animation_handler(edl_animation_handler)
+    elif APPLY_ENHANCED_SHADING and global_dataset is None: # Tile đã được tô khi nạp
         print("\n[Bước Áp Dụng Shading Ban Đầu]")
         # Ước lượng view_pos ban đầu cho shading
-        bbox = global_pcd_display.get_axis_aligned_bounding_box()
-        center = bbox.get_center()
-        extent_max = np.max(bbox.get_extent())
-        if extent_max < 1e-6 : extent_max = 1.0
-        initial_view_pos_est = center + np.array([0.0, 0.0, extent_max * 2.5])
-
-        base_color_to_use = None
-        color_name_init, color_rgb_data_init = BASE_COLORS_LIST[global_current_base_color_index]
-        if color_name_init == "Original" and global_pcd_original_colors is not None:
-            base_color_to_use = global_pcd_original_colors
-        else:
-            base_color_to_use = color_rgb_data_init if color_rgb_data_init is not None else BASE_COLORS_LIST[0][1]
-
-        apply_enhanced_sun_shading(global_pcd_display,
-                                   base_color_rgb_array=base_color_to_use,
-                                   sun_dir=SUN_DIRECTION,
-                                   view_pos=initial_view_pos_est,
-                                   ambient_s=AMBIENT_STRENGTH,
-                                   diffuse_s=DIFFUSE_STRENGTH,
-                                   specular_s=SPECULAR_STRENGTH,
-                                   shininess=SHININESS_FACTOR,
-                                   use_specular_flag=global_specular_on)
+        initial_view_pos_est = estimate_default_view_position(global_pcd_display)
+        shade_display(initial_view_pos_est)
     # else:
     # (Phần gán màu ban đầu nếu không shading có thể bỏ qua vì preprocess đã gán màu mặc định)
 
     geometries_to_draw = [global_pcd_display]
+    report_memory()
 
     print("\n--- KHỞI ĐỘNG OPEN3D VISUALIZER ---")
     # ... (Hướng dẫn phím bấm giữ nguyên) ...
-    print("  - Phím 'L': Chuyển đổi giữa các chế độ chiếu sáng. **TÌM CHẾ ĐỘ EDL**.")
+    print("  - Phím 'L': Bật/tắt chiếu sáng tích hợp của Open3D (shading thủ công tự tắt nó).")
+    print(f"  - Shading thủ công: {SHADING_MODE.upper() if APPLY_ENHANCED_SHADING else 'TẮT'}"
+          f"{' (Eye-Dome Lighting, tô lại khi camera dừng; chọn bằng --shading edl)' if SHADING_MODE == 'edl' else ''}.")
     print("  - Phím 'B': Đổi màu nền (Sáng/Tối).")
     print("  - Phím 'X': Duyệt qua các màu cơ bản của Point Cloud.")
     print("  - Phím 'K': Bật/Tắt hiệu ứng Specular (nếu Shading thủ công được bật).")
+    print(f"  - Phím mũi tên: Xoay mặt trời (trái/phải: phương vị, lên/xuống: độ cao, bước {SUN_ROTATE_STEP_DEG:g}°"
+          f"{'; nhanh hơn nhiều với --lighting sh' if LIGHTING_MODE == 'direct' else ''}).")
     print("  - Phím 'P' / '+': Tăng kích thước điểm.  'M' / '-': Giảm kích thước điểm.")
     print("  - Kéo chuột trái: Xoay camera.")
     print("  - Lăn chuột: Zoom.")
@@ -352,30 +3049,41 @@ if __name__ == "__main__":
     global_vis.register_key_callback(ord('B'), toggle_background_color_cb)
     global_vis.register_key_callback(ord('X'), cycle_base_color_cb)
     global_vis.register_key_callback(ord('K'), toggle_specular_cb)
+    global_vis.register_key_callback(262, lambda vis: rotate_sun_cb(vis, SUN_ROTATE_STEP_DEG, 0.0)) # GLFW_KEY_RIGHT
+    global_vis.register_key_callback(263, lambda vis: rotate_sun_cb(vis, -SUN_ROTATE_STEP_DEG, 0.0)) # GLFW_KEY_LEFT
+    global_vis.register_key_callback(264, lambda vis: rotate_sun_cb(vis, 0.0, -SUN_ROTATE_STEP_DEG)) # GLFW_KEY_DOWN
+    global_vis.register_key_callback(265, lambda vis: rotate_sun_cb(vis, 0.0, SUN_ROTATE_STEP_DEG)) # GLFW_KEY_UP
+    if global_dataset is not None:
+        global_dataset["merged_time"] = time.time() # Cloud ban đầu vừa được ghép đồng bộ
+        start_tile_prefetch(global_dataset)
+        register_animation_handler(dataset_animation_handler)
+    elif APPLY_ENHANCED_SHADING and SHADING_MODE == "sun" and BACKGROUND_SHADING:
+        global_shading_worker = start_background_shading()
+        register_animation_handler(background_shading_animation_handler)
+        if SPECULAR_FOLLOW_CAMERA or FRUSTUM_CULLING:
+            global_camera_follow = start_camera_follow(global_pcd_display, initial_view_pos_est)
+            register_animation_handler(camera_follow_animation_handler)
+    if global_animation_handlers:
+        global_vis.register_animation_callback(_animation_dispatch_cb)
 
     # --- Thiết lập Camera Parameters ---
     print("\n[Bước Thiết Lập Camera Ban Đầu]")
-    _start_cam_setup_time = time.time()
-    view_control = global_vis.get_view_control()
-    fov_rad = np.deg2rad(CAMERA_FIELD_OF_VIEW_DEG)
-    fy = WINDOW_HEIGHT / (2 * np.tan(fov_rad / 2.0))
-    fx = fy
-    cx = WINDOW_WIDTH / 2.0
-    cy = WINDOW_HEIGHT / 2.0
-    new_intrinsic = o3d.camera.PinholeCameraIntrinsic(WINDOW_WIDTH, WINDOW_HEIGHT, fx, fy, cx, cy)
-    
-    global_vis.poll_events() # Quan trọng để visualizer kịp cập nhật
-    global_vis.update_renderer() # và tính toán extrinsic ban đầu
+    with profiling.stage("camera_setup") as cam_stage:
+        view_control = global_vis.get_view_control()
+        fx, fy, cx, cy = camera_intrinsics(WINDOW_WIDTH, WINDOW_HEIGHT, CAMERA_FIELD_OF_VIEW_DEG)
+        new_intrinsic = o3d.camera.PinholeCameraIntrinsic(WINDOW_WIDTH, WINDOW_HEIGHT, fx, fy, cx, cy)
 
-    current_pinhole_params = view_control.convert_to_pinhole_camera_parameters()
-    current_extrinsic = current_pinhole_params.extrinsic
-    
-    new_cam_params = o3d.camera.PinholeCameraParameters()
-    new_cam_params.intrinsic = new_intrinsic
-    new_cam_params.extrinsic = current_extrinsic
-    view_control.convert_from_pinhole_camera_parameters(new_cam_params, allow_arbitrary=True)
-    _end_cam_setup_time = time.time()
-    print(f"  Đã cố gắng đặt Field of View ~{CAMERA_FIELD_OF_VIEW_DEG} độ (trong {_end_cam_setup_time - _start_cam_setup_time:.2f}s).")
+        global_vis.poll_events() # Quan trọng để visualizer kịp cập nhật
+        global_vis.update_renderer() # và tính toán extrinsic ban đầu
+
+        current_pinhole_params = view_control.convert_to_pinhole_camera_parameters()
+        current_extrinsic = current_pinhole_params.extrinsic
+
+        new_cam_params = o3d.camera.PinholeCameraParameters()
+        new_cam_params.intrinsic = new_intrinsic
+        new_cam_params.extrinsic = current_extrinsic
+        view_control.convert_from_pinhole_camera_parameters(new_cam_params, allow_arbitrary=True)
+    print(f"  Đã cố gắng đặt Field of View ~{CAMERA_FIELD_OF_VIEW_DEG} độ (trong {cam_stage.elapsed:.2f}s).")
 
     overall_setup_time = time.time() - overall_start_time
     print(f"\nTổng thời gian chuẩn bị trước khi chạy Visualizer: {overall_setup_time:.2f}s")
@@ -384,8 +3092,14 @@ if __name__ == "__main__":
     global_vis.run() # Hàm này block
     
     print("\nCửa sổ Visualizer đã đóng.")
+    if global_shading_worker is not None:
+        stop_background_shading(global_shading_worker)
+        global_shading_worker = None
+    if global_dataset is not None:
+        stop_tile_prefetch(global_dataset)
     global_vis.destroy_window()
     global_vis = None
 
     overall_end_time = time.time()
-    print(f"\n--- Kết thúc hiển thị (Tổng thời gian chạy script: {overall_end_time - overall_start_time:.2f}s) ---")
\ No newline at end of file
+    print(f"\n--- Kết thúc hiển thị (Tổng thời gian chạy script: {overall_end_time - overall_start_time:.2f}s) ---")
+    report_profiling(args.profile_trace)
\ No newline at end of file